@@ -34,8 +34,8 @@ class Archive:
         data = self.fetcher.fetch_json(
             url,
             headers=configs.headers,
-            request_cooldown_sec=configs.request_cooldown_sec,
             add_random=configs.add_random,
+            board=self.board,
         )
 
         if not data:
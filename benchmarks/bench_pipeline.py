@@ -0,0 +1,332 @@
+"""
+Benchmarks each stage of `process_board()` against the recorded fixtures in `tests/test_files`,
+scaled up to many boards of full threads. No network requests are made.
+
+Run from the repo root, see `benchmarks/README.md`,
+
+    python -m benchmarks.bench_pipeline
+    python -m benchmarks.bench_pipeline --boards 8 --threads 150 --posts 300
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+from functools import partial
+from types import SimpleNamespace
+from typing import Callable
+from unittest.mock import AsyncMock
+
+import msgspec
+
+import configs
+import db.ritual
+import state as state_module
+from catalog import Catalog
+from db.ritual import RitualDb
+from filter import Filter
+from loop import Loop
+from state import State
+from state_store import SqliteStateStore
+from tests.conftest import create_test_sqlite_db
+from utils import (
+    ChanPost,
+    ChanThread,
+    catalog_decoder,
+    convert_to_asagi_comment,
+    extract_text_from_html_stdlib,
+    get_d_board,
+    html_to_text,
+    make_path,
+    thread_decoder
+)
+
+# catalog-only fields, not found on thread OPs
+CATALOG_ONLY_KEYS = ('last_replies', 'omitted_posts', 'omitted_images', 'last_modified')
+THREADS_PER_PAGE = 15
+
+
+def read_fixture(filename: str):
+    with open(make_path('tests', 'test_files', filename), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def make_board_fixtures(catalog_json: list[dict], thread_json: dict, n_threads: int, n_posts: int, board_i: int) -> tuple[bytes, dict[int, bytes]]:
+    """
+    Scales up the fixtures to `n_threads` threads of `n_posts` posts, cycling through the recorded threads and replies.
+    Returns the board's catalog and threads as response bytes.
+    """
+    thread_templates = [thread for page in catalog_json for thread in page['threads']]
+    reply_templates = thread_json['posts'][1:] + [reply for thread in thread_templates for reply in thread.get('last_replies', [])]
+
+    now = int(time.time())
+    tid_start = 100_000_000 * (board_i + 1)
+
+    threads = []
+    tid_2_thread_bytes = dict()
+    for t in range(n_threads):
+        tid = tid_start + t * (n_posts + 1)
+        template = thread_templates[t % len(thread_templates)]
+
+        op = {k: v for k, v in template.items() if k not in CATALOG_ONLY_KEYS}
+        op.update(no=tid, resto=0, time=now - 3600, replies=n_posts - 1)
+
+        posts = [op]
+        for p in range(1, n_posts):
+            reply = dict(reply_templates[(t + p) % len(reply_templates)])
+            reply.update(no=tid + p, resto=tid, time=now - 3600 + p)
+            posts.append(reply)
+
+        tid_2_thread_bytes[tid] = msgspec.json.encode({'posts': posts})
+        threads.append(op | {'last_modified': now - t, 'last_replies': posts[-5:]})
+
+    pages = [
+        {'page': i // THREADS_PER_PAGE + 1, 'threads': threads[i:i + THREADS_PER_PAGE]}
+        for i in range(0, len(threads), THREADS_PER_PAGE)
+    ]
+    return msgspec.json.encode(pages), tid_2_thread_bytes
+
+
+def run_stage(name: str, n_posts: int, setup: Callable[[], tuple], stage: Callable, trace_memory: bool) -> dict:
+    """Times `stage(*setup())`, then reruns it with tracemalloc for its peak memory, since tracing slows it down."""
+    args = setup()
+    start = time.perf_counter()
+    stage(*args)
+    elapsed = time.perf_counter() - start
+
+    peak = None
+    if trace_memory:
+        args = setup()
+        tracemalloc.start()
+        stage(*args)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return dict(name=name, elapsed=elapsed, posts_per_sec=n_posts / elapsed if elapsed else 0.0, peak=peak)
+
+
+def create_ritual_dbs(boards: list[str], db_path: str, pragmas: dict | None=None) -> dict[str, RitualDb]:
+    """In-memory databases are one per board, on-disk boards share one database, like a live archive."""
+    if db_path == ':memory:':
+        return {board: RitualDb(create_test_sqlite_db(board)) for board in boards}
+
+    for board in boards:
+        create_test_sqlite_db(board, db_path).close()
+
+    ritual_db = RitualDb(create_test_sqlite_db(boards[0], db_path, pragmas))
+    return {board: ritual_db for board in boards}
+
+
+def create_state(tmp_dir: str, backend: str) -> State:
+    """An empty state, saved to its own directory."""
+    cache_dir = tempfile.mkdtemp(dir=tmp_dir)
+    configs.state_backend = backend
+    state_module.SqliteStateStore = partial(SqliteStateStore, os.path.join(cache_dir, 'state.db'))
+
+    state = State(Loop())
+    for name in ('thread_cache', 'http_cache', 'thread_stats', 'thread_meta'):
+        setattr(state, f'{name}_filepath', os.path.join(cache_dir, f'{name}.json'))
+
+    # drop anything read from ./cache
+    state.read()
+    for dirty in (state.dirty_thread_cache, state.dirty_http_cache, state.dirty_thread_stats, state.dirty_thread_meta):
+        dirty.clear()
+    return state
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the per-board pipeline against recorded fixtures.')
+    parser.add_argument('--boards', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=150, help='threads per board')
+    parser.add_argument('--posts', type=int, default=300, help='posts per thread')
+    parser.add_argument('--no-memory', action='store_true', help="skip the tracemalloc runs, they double the run time")
+    parser.add_argument('--sqlite-db', help='also time writes to this database, e.g. a copy of your archive. Boards b0, b1, ... are written to it')
+    args = parser.parse_args()
+
+    # quiet, and with every board archived
+    configs.logger = SimpleNamespace(info=lambda s: None, warning=lambda s: None, error=lambda s: None)
+    boards = [f'b{i}' for i in range(args.boards)]
+    configs.boards = {board: {'thread_text': True} for board in boards}
+    configs.ignore_thread_cache = True
+    configs.unescape_data_b4_db_write = True
+
+    # tables are created by create_test_sqlite_db(), not asagi-tables
+    db.ritual.execute_action = AsyncMock()
+    db.ritual.asagi_close_pool = AsyncMock()
+
+    catalog_json = read_fixture('catalog.json')
+    thread_json = read_fixture('thread.json')
+
+    print(f'Building fixtures: {args.boards} board(s) x {args.threads} thread(s) x {args.posts} post(s)')
+    board_2_fixtures = {
+        board: make_board_fixtures(catalog_json, thread_json, args.threads, args.posts, i)
+        for i, board in enumerate(boards)
+    }
+    board_2_catalog = {board: catalog_decoder.decode(catalog_bytes) for board, (catalog_bytes, _) in board_2_fixtures.items()}
+    board_2_threads = {
+        board: [thread_decoder.decode(thread_bytes) for thread_bytes in tid_2_thread_bytes.values()]
+        for board, (_, tid_2_thread_bytes) in board_2_fixtures.items()
+    }
+    all_posts = [post for threads in board_2_threads.values() for thread in threads for post in thread.posts]
+    n_posts = len(all_posts)
+    n_threads = args.boards * args.threads
+
+    tmp_dir = tempfile.mkdtemp(prefix='ritual_bench_')
+    trace_memory = not args.no_memory
+    results = []
+
+    def decode_stdlib():
+        for catalog_bytes, tid_2_thread_bytes in board_2_fixtures.values():
+            for page in json.loads(catalog_bytes):
+                for thread in page['threads']:
+                    msgspec.convert(thread, ChanThread)
+            for thread_bytes in tid_2_thread_bytes.values():
+                for post in json.loads(thread_bytes)['posts']:
+                    msgspec.convert(post, ChanPost)
+
+    def decode_msgspec():
+        for catalog_bytes, tid_2_thread_bytes in board_2_fixtures.values():
+            catalog_decoder.decode(catalog_bytes)
+            for thread_bytes in tid_2_thread_bytes.values():
+                thread_decoder.decode(thread_bytes)
+
+    results.append(run_stage('decode (json + convert)', n_posts, tuple, decode_stdlib, trace_memory))
+    results.append(run_stage('decode (msgspec decoder)', n_posts, tuple, decode_msgspec, trace_memory))
+
+    def setup_filter():
+        state = create_state(tmp_dir, 'json')
+        board_2_filter = {board: Filter(None, None, board, state) for board in boards}
+        board_2_catalog_obj = dict()
+        for board in boards:
+            catalog = Catalog(None, board)
+            catalog.catalog = board_2_catalog[board]
+            board_2_catalog_obj[board] = catalog
+        return board_2_filter, board_2_catalog_obj
+
+    def filter_catalogs(board_2_filter: dict, board_2_catalog_obj: dict):
+        for board in boards:
+            board_2_filter[board].filter_catalog(board_2_catalog_obj[board])
+
+    # filtering only reads catalog threads, so its rate is per thread
+    results.append(run_stage('filter catalog (threads)', n_threads, setup_filter, filter_catalogs, trace_memory))
+
+    comments = [post.com for post in all_posts if post.com]
+
+    def html_text_stdlib():
+        for comment in comments:
+            extract_text_from_html_stdlib(comment)
+
+    def html_text_regex():
+        for comment in comments:
+            html_to_text(comment)
+
+    n_mismatches = sum(html_to_text(comment) != extract_text_from_html_stdlib(comment) for comment in comments)
+    results.append(run_stage('html to text (html.parser)', len(comments), tuple, html_text_stdlib, trace_memory))
+    results.append(run_stage(f'html to text (regex, {n_mismatches} mismatches)', len(comments), tuple, html_text_regex, trace_memory))
+
+    def asagi_comments():
+        for post in all_posts:
+            convert_to_asagi_comment(post.com)
+
+    def asagi_rows():
+        for post in all_posts:
+            get_d_board(post)
+
+    results.append(run_stage('convert_to_asagi_comment', n_posts, tuple, asagi_comments, trace_memory))
+    results.append(run_stage('get_d_board', n_posts, tuple, asagi_rows, trace_memory))
+
+    def upsert_board_posts(ritual_db: RitualDb, board: str):
+        for thread in board_2_threads[board]:
+            ritual_db.upsert_posts(board, thread.posts)
+
+    def upsert_board_thread_stats(ritual_db: RitualDb, board: str):
+        for thread in board_2_threads[board]:
+            op = thread.posts[0]
+            ritual_db.upsert_thread_stats(board, {
+                'thread_num': op.no,
+                'time_op': op.time,
+                'time_last': thread.posts[-1].time,
+                'time_bump': thread.posts[-1].time,
+                'time_last_modified': thread.posts[-1].time,
+                'nreplies': len(thread.posts) - 1,
+                'nimages': 0,
+                'sticky': 0,
+                'locked': 0,
+            })
+
+    def upsert_posts(board_2_ritual_db: dict):
+        for board, ritual_db in board_2_ritual_db.items():
+            upsert_board_posts(ritual_db, board)
+
+    def upsert_thread_stats(board_2_ritual_db: dict):
+        for board, ritual_db in board_2_ritual_db.items():
+            upsert_board_thread_stats(ritual_db, board)
+
+    def upsert_posts_and_thread_stats(board_2_ritual_db: dict):
+        for board, ritual_db in board_2_ritual_db.items():
+            upsert_board_posts(ritual_db, board)
+            upsert_board_thread_stats(ritual_db, board)
+
+    def upsert_in_unit_of_work(board_2_ritual_db: dict):
+        for board, ritual_db in board_2_ritual_db.items():
+            with ritual_db.unit_of_work(board):
+                upsert_board_posts(ritual_db, board)
+                upsert_board_thread_stats(ritual_db, board)
+
+    # SQLite's defaults are set explicitly, journal_mode is persisted in the database file
+    profile_2_pragmas = {
+        'default pragmas': {'journal_mode': 'delete', 'synchronous': 'full'},
+        'tuned pragmas': configs.db_sqlite_pragmas,
+    }
+
+    db_label_2_setup = {'memory': lambda: (create_ritual_dbs(boards, ':memory:'),)}
+    for profile, pragmas in profile_2_pragmas.items():
+        db_label_2_setup[f'disk, {profile}'] = partial(
+            lambda pragmas: (create_ritual_dbs(boards, os.path.join(tmp_dir, f'ritual_{time.monotonic_ns()}.db'), pragmas),),
+            pragmas,
+        )
+
+    for db_label, setup_db in db_label_2_setup.items():
+        results.append(run_stage(f'upsert posts (sqlite {db_label})', n_posts, setup_db, upsert_posts, trace_memory))
+        results.append(run_stage(f'upsert thread stats (sqlite {db_label}, threads)', n_threads, setup_db, upsert_thread_stats, trace_memory))
+        results.append(run_stage(f'upsert posts + stats (sqlite {db_label})', n_posts, setup_db, upsert_posts_and_thread_stats, trace_memory))
+        results.append(run_stage(f'upsert posts + stats, unit of work (sqlite {db_label})', n_posts, setup_db, upsert_in_unit_of_work, trace_memory))
+
+    if args.sqlite_db:
+        # written once first, so every profile updates the same existing rows
+        upsert_in_unit_of_work(create_ritual_dbs(boards, args.sqlite_db))
+
+        for profile, pragmas in profile_2_pragmas.items():
+            setup_db = partial(lambda pragmas: (create_ritual_dbs(boards, args.sqlite_db, pragmas),), pragmas)
+            results.append(run_stage(f'upsert posts + stats, unit of work ({args.sqlite_db}, {profile})', n_posts, setup_db, upsert_in_unit_of_work, trace_memory))
+
+    def setup_state(backend: str) -> tuple[State]:
+        state = create_state(tmp_dir, backend)
+        for board, threads in board_2_threads.items():
+            tid_2_page = dict()
+            tid_2_thread = dict()
+            for i, thread in enumerate(threads):
+                op = thread.posts[0]
+                state.is_thread_modified_cache_update(board, {'no': op.no, 'last_modified': thread.posts[-1].time})
+                state.set_thread_stats(board, op.no, replies=len(thread.posts) - 1, images=0, most_recent_reply_no=thread.posts[-1].no)
+                state.set_http_last_modified(configs.url_thread.format(board=board, thread_id=op.no), 'Wed, 21 Oct 2015 07:28:00 GMT')
+                tid_2_page[op.no] = i // THREADS_PER_PAGE + 1
+                tid_2_thread[op.no] = {'last_modified': thread.posts[-1].time}
+            state.update_thread_meta(board, tid_2_page, tid_2_thread)
+        return (state,)
+
+    for backend in ('json', 'sqlite'):
+        results.append(run_stage(f'state save ({backend}, threads)', n_threads, lambda backend=backend: setup_state(backend), State.save, trace_memory))
+
+    print(f'{"stage":<72} {"seconds":>9} {"posts/sec":>12} {"peak MiB":>9}')
+    for result in results:
+        peak = f'{result["peak"] / 1024 / 1024:.1f}' if result['peak'] is not None else '-'
+        print(f'{result["name"]:<72} {result["elapsed"]:>9.3f} {result["posts_per_sec"]:>12,.0f} {peak:>9}')
+
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
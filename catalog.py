@@ -1,8 +1,8 @@
 import msgspec
 
 import configs
-from fetcher import Fetcher
-from utils import ChanThread
+from fetcher import Fetcher, NotModified
+from utils import CatalogPage, ChanThread, catalog_decoder
 
 
 class Catalog:
@@ -10,15 +10,20 @@ class Catalog:
         self.fetcher = fetcher
 
         self.board: str = board
-        self.catalog: list[dict] = []
-        self.tid_2_thread: dict[int, dict] = dict()
+        self.catalog: list[CatalogPage] = []
+        self.tid_2_thread: dict[int, ChanThread] = dict()
         self.tid_2_page: dict[int, int] = dict()
         self.tid_2_last_replies: dict[int, list[dict]] = dict()
 
+        # set when the catalog hasn't changed since the last fetch, see `fetch_catalog()`
+        self.not_modified: bool = False
+
 
     def validate_threads(self):
         for thread in self.tid_2_thread.values():
-            msgspec.convert(thread, ChanThread)
+            # decoded threads were validated by the decoder
+            if not isinstance(thread, ChanThread):
+                msgspec.convert(thread, ChanThread)
 
 
     def fetch_catalog(self) -> bool:
@@ -26,14 +31,21 @@ class Catalog:
         - fetches catalog from api
         - validates catalog from api
         - returns `True` if successful
+        - returns `False` with `not_modified` set if it hasn't changed since the last fetch
         '''
         self.catalog = self.fetcher.fetch_json(
             configs.url_catalog.format(board=self.board),
             headers=configs.headers,
-            request_cooldown_sec=configs.request_cooldown_sec,
             add_random=configs.add_random,
+            decoder=catalog_decoder,
+            board=self.board,
         )
 
+        if isinstance(self.catalog, NotModified):
+            self.not_modified = True
+            configs.logger.info(f'[{self.board}] Catalog not modified')
+            return False
+
         configs.logger.info(f'[{self.board}] Downloaded catalog')
 
         if not self.catalog:
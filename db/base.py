@@ -1,4 +1,9 @@
+import functools
+import threading
 from abc import ABC, abstractmethod
+from collections import namedtuple
+from contextlib import contextmanager
+from typing import Iterator
 
 
 class DotDict(dict):
@@ -7,8 +12,29 @@ class DotDict(dict):
     __delattr__ = dict.__delitem__
 
 
+@functools.lru_cache(maxsize=128)
+def get_row_type(columns: tuple[str, ...]) -> type:
+    """A namedtuple for a query's columns, built on the query's first row, and reused for every query with the same columns."""
+    return namedtuple('Row', columns, rename=True)
+
+
+def get_named_rows(cursor, rows: list[tuple]) -> list[tuple]:
+    if not rows:
+        return rows
+
+    row_type = get_row_type(tuple(col[0] for col in cursor.description))
+    return [row_type._make(row) for row in rows]
+
+
 class BaseDb(ABC):
     placeholder: str
+    lock: threading.RLock
+
+    # rows per `executemany()`, see `RitualDb.upsert_many()`
+    batch_size: int = 500
+
+    # a unit of work's statements per commit, `None` commits them all at once, see `RitualDb.flush_unit_of_work()`
+    statements_per_transaction: int | None = None
 
     @abstractmethod
     def get_upsert_clause(self, conflict_col: str, update_cols: list[str]) -> str:
@@ -18,6 +44,30 @@ class BaseDb(ABC):
     def save(self):
         pass
 
+    @abstractmethod
+    def begin(self):
+        pass
+
+    @abstractmethod
+    def commit(self):
+        pass
+
+    @abstractmethod
+    def rollback(self):
+        pass
+
+    @contextmanager
+    def transaction(self):
+        """Queries in the block are committed together, or rolled back together. Holds `self.lock` throughout."""
+        with self.lock:
+            self.begin()
+            try:
+                yield
+            except BaseException:
+                self.rollback()
+                raise
+            self.commit()
+
     @abstractmethod
     def close(self):
         pass
@@ -34,6 +84,14 @@ class BaseDb(ABC):
     def run_query_dict(self, sql_string: str, params: tuple=None, commit: bool=False):
         pass
 
+    @abstractmethod
+    def iter_query(self, sql_string: str, params: tuple=None, arraysize: int=1000, named: bool=False) -> Iterator[tuple]:
+        """
+        Yields rows as they're fetched, `arraysize` rows at a time, so large reads run in constant memory.
+        Rows are tuples, or namedtuples when `named` is set. Close the iterator, or exhaust it, to release the cursor.
+        """
+        pass
+
     @abstractmethod
     def run_query_many(self, sql_string: str, params: tuple=None, commit: bool=False, dict_row=False):
         pass
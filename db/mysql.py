@@ -1,15 +1,43 @@
 import functools
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
 import mysql.connector
+from mysql.connector.pooling import MySQLConnectionPool, PooledMySQLConnection
 
-from db.base import BaseDb, DotDict
+from db.base import BaseDb, DotDict, get_named_rows
 
 
 class MysqlDb(BaseDb):
+    """
+    Connections are checked out of a pool for each query, or for each transaction, so boards processed
+    concurrently don't wait on one connection. Connections idle for longer than `ping_after_idle_s` are pinged,
+    and reconnected if the server closed them, e.g. after `wait_timeout`.
+    """
     placeholder = '%s'
-
-
-    def __init__(self, host: str, user: str, password: str, database: str, port: int=3306, sql_echo: bool=False):
-        self.conn = mysql.connector.connect(
+    ping_after_idle_s = 60
+    checkout_timeout_s = 30
+
+
+    def __init__(
+        self,
+        host: str,
+        user: str,
+        password: str,
+        database: str,
+        port: int=3306,
+        sql_echo: bool=False,
+        pool_size: int=8,
+        batch_size: int=500,
+        statements_per_transaction: int | None=1,
+    ):
+        self.pool = MySQLConnectionPool(
+            pool_name=f'ritual_{id(self)}',
+            pool_size=pool_size,
+            # sessions are left clean, queries are committed or rolled back before a connection is returned
+            pool_reset_session=False,
             host=host,
             user=user,
             password=password,
@@ -18,6 +46,84 @@ class MysqlDb(BaseDb):
             autocommit=False
         )
         self.sql_echo = sql_echo
+        self.batch_size = batch_size
+        self.statements_per_transaction = statements_per_transaction
+
+        # the calling thread's connection and lock
+        self.local = threading.local()
+
+        self.connection_id_2_last_used: dict[int, float] = dict()
+        self.connection_id_lock = threading.Lock()
+
+
+    @property
+    def lock(self) -> threading.RLock:
+        # each thread has its own connection, so there's nothing to share across threads
+        if not hasattr(self.local, 'lock'):
+            self.local.lock = threading.RLock()
+        return self.local.lock
+
+
+    def checkout(self) -> PooledMySQLConnection:
+        deadline = time.monotonic() + self.checkout_timeout_s
+        while True:
+            try:
+                conn = self.pool.get_connection()
+                break
+            except mysql.connector.errors.PoolError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+
+        with self.connection_id_lock:
+            last_used = self.connection_id_2_last_used.pop(conn.connection_id, None)
+
+        if last_used is None or time.monotonic() - last_used > self.ping_after_idle_s:
+            conn.ping(reconnect=True, attempts=3, delay=1)
+
+        return conn
+
+
+    def checkin(self, conn: PooledMySQLConnection):
+        with self.connection_id_lock:
+            self.connection_id_2_last_used[conn.connection_id] = time.monotonic()
+
+        # returns it to the pool
+        conn.close()
+
+
+    @contextmanager
+    def connection(self):
+        """The calling thread's connection, checked out for the outermost block."""
+        if conn := getattr(self.local, 'conn', None):
+            yield conn
+            return
+
+        conn = self.checkout()
+        self.local.conn = conn
+        try:
+            yield conn
+        except BaseException:
+            try:
+                conn.rollback()
+            except Exception:
+                # e.g. the server dropped the connection, the original error is the one raised
+                pass
+            raise
+        finally:
+            self.local.conn = None
+            self.checkin(conn)
+
+
+    @contextmanager
+    def transaction(self):
+        with self.connection():
+            self.local.in_transaction = True
+            try:
+                with super().transaction():
+                    yield
+            finally:
+                self.local.in_transaction = False
 
 
     @functools.lru_cache(maxsize=128)
@@ -26,11 +132,22 @@ class MysqlDb(BaseDb):
 
 
     def save(self):
-        self.conn.commit()
+        # queries outside a transaction are committed as they run
+        pass
 
 
     def close(self):
-        self.conn.close()
+        """Closes the pool's connections, once every connection is returned, e.g. after the boards are done."""
+        # idle connections are checked out, and closed rather than returned, until the pool has none left
+        while True:
+            try:
+                conn = self.pool.get_connection()
+            except mysql.connector.Error:
+                break
+            conn.disconnect()
+
+        with self.connection_id_lock:
+            self.connection_id_2_last_used.clear()
 
 
     def save_and_close(self):
@@ -38,26 +155,44 @@ class MysqlDb(BaseDb):
         self.close()
 
 
+    def begin(self):
+        # autocommit is off, a transaction is always open
+        pass
+
+
+    def commit(self):
+        self.local.conn.commit()
+
+
+    def rollback(self):
+        self.local.conn.rollback()
+
+
     def _row_to_dict(self, cursor, row: tuple) -> DotDict:
         keys = [col[0] for col in cursor.description]
         return DotDict(zip(keys, row))
 
 
-    def _run_query(self, sql_string: str, params: tuple=None, commit: bool=False, dict_row: bool=True):
+    def _run_query(self, sql_string: str, params: tuple=None, commit: bool=False, dict_row: bool=True, many: bool=False):
         if self.sql_echo:
             print(f'{sql_string=}\n{params=}')
 
-        cursor = self.conn.cursor()
-        cursor.execute(sql_string, params or ())
-        results = cursor.fetchall()
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            if many:
+                cursor.executemany(sql_string, params or ())
+            else:
+                cursor.execute(sql_string, params or ())
+            results = cursor.fetchall()
 
-        if dict_row:
-            results = [self._row_to_dict(cursor, row) for row in results]
+            if dict_row:
+                results = [self._row_to_dict(cursor, row) for row in results]
 
-        cursor.close()
+            cursor.close()
 
-        if commit:
-            self.conn.commit()
+            # a connection goes back to the pool without an open transaction, or row locks
+            if not getattr(self.local, 'in_transaction', False):
+                conn.commit()
 
         return results
 
@@ -70,20 +205,28 @@ class MysqlDb(BaseDb):
         return self._run_query(sql_string, params, commit=commit, dict_row=True)
 
 
-    def run_query_many(self, sql_string: str, params: tuple=None, commit: bool=False, dict_row=False):
+    def iter_query(self, sql_string: str, params: tuple=None, arraysize: int=1000, named: bool=False) -> Iterator[tuple]:
+        """
+        Rows are streamed from the server with an unbuffered cursor. The connection can't run other queries
+        until the rows are read, so it's checked out separately from the thread's connection.
+        """
         if self.sql_echo:
             print(f'{sql_string=}\n{params=}')
 
-        cursor = self.conn.cursor()
-        cursor.executemany(sql_string, params or ())
-        results = cursor.fetchall()
+        conn = self.checkout()
+        try:
+            cursor = conn.cursor()
+            cursor.arraysize = arraysize
+            cursor.execute(sql_string, params or ())
 
-        if dict_row:
-            results = [self._row_to_dict(cursor, row) for row in results]
+            while rows := cursor.fetchmany(arraysize):
+                yield from get_named_rows(cursor, rows) if named else rows
+        finally:
+            # drops any rows left unread when the iterator is closed early
+            conn.consume_results()
+            conn.commit()
+            self.checkin(conn)
 
-        cursor.close()
 
-        if commit:
-            self.conn.commit()
-
-        return results
+    def run_query_many(self, sql_string: str, params: tuple=None, commit: bool=False, dict_row=False):
+        return self._run_query(sql_string, params, commit=commit, dict_row=dict_row, many=True)
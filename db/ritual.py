@@ -1,20 +1,46 @@
 import asyncio
 import time
+from contextlib import contextmanager
+from typing import Callable
+
 import configs
 from db.base import BaseDb
 from db.mysql import MysqlDb
 from db.sqlite import SqliteDb
-from utils import get_d_board
+from db.thread_index import ThreadIndex
+from utils import get_d_board, get_post_fingerprint
 
 # Run ./install_asagi_tables.sh to install asagi-tables
 from asagi_tables.main import execute_action
 from asagi_tables.db import close_pool as asagi_close_pool
 
 
+class UnitOfWork:
+    """A board's deferred writes, see `RitualDb.unit_of_work()`."""
+    def __init__(self):
+        # (sql, params, is_many), see `RitualDb.execute()` and `RitualDb.execute_many()`
+        self.statements: list[tuple[str, tuple | list[tuple], bool]] = []
+
+        # only the latest stats for a thread are written
+        self.tid_2_thread_stats_params: dict[int, tuple] = dict()
+
+        # run once the writes are committed
+        self.on_commit: list[Callable[[], None]] = []
+
+
 class RitualDb:
     def __init__(self, db: BaseDb):
         self.db = db
 
+        # boards can be processed concurrently, each with its own unit of work
+        self.board_2_unit_of_work: dict[str, UnitOfWork] = dict()
+
+        # board -> pid -> fingerprint of the post as last written, see `upsert_posts()`
+        self.board_2_pid_2_fingerprint: dict[str, dict[int, int]] = dict()
+
+        # answers the per-loop thread lookups without querying the board table
+        self.thread_index = ThreadIndex(self.db, configs.thread_index_warm_since_sec)
+
         boards_list = list(configs.boards.keys())
         side_tables = ['threads', 'images', 'deleted', 'users', 'daily']
 
@@ -38,24 +64,91 @@ class RitualDb:
         self.db.save()
 
 
+    @contextmanager
+    def unit_of_work(self, board: str):
+        """
+        Defers the board's writes until the block exits, then commits them in one transaction (see `BaseDb.statements_per_transaction`).
+        Thread stats are written with a single `executemany()`.
+        Nothing is written if the block raises. Reads in the block don't see the deferred writes.
+        """
+        if board in self.board_2_unit_of_work:
+            yield self.board_2_unit_of_work[board]
+            return
+
+        uow = UnitOfWork()
+        self.board_2_unit_of_work[board] = uow
+        try:
+            yield uow
+        finally:
+            del self.board_2_unit_of_work[board]
+
+        self.flush_unit_of_work(board, uow)
+
+
+    def flush_unit_of_work(self, board: str, uow: UnitOfWork):
+        statements = list(uow.statements)
+        if uow.tid_2_thread_stats_params:
+            statements.append((self.get_thread_stats_sql(board), list(uow.tid_2_thread_stats_params.values()), True))
+
+        if not statements:
+            return
+
+        # shorter transactions hold row locks for less time, for databases shared with e.g. a web frontend
+        n = self.db.statements_per_transaction or len(statements)
+        for i in range(0, len(statements), n):
+            with self.db.transaction():
+                for sql, params, is_many in statements[i:i + n]:
+                    if is_many:
+                        self.db.run_query_many(sql, params)
+                    else:
+                        self.db.run_query_tuple(sql, params=params)
+
+        for callback in uow.on_commit:
+            callback()
+
+        configs.logger.info(f'[{board}] Committed {len(uow.statements)} statement(s) and {len(uow.tid_2_thread_stats_params)} thread stat(s)')
+
+
+    def execute(self, board: str, sql: str, params: tuple):
+        """Runs and commits the write, or defers it to the board's unit of work."""
+        if uow := self.board_2_unit_of_work.get(board):
+            uow.statements.append((sql, params, False))
+            return
+
+        self.db.run_query_tuple(sql, params=params, commit=True)
+
+
+    def execute_many(self, board: str, sql: str, params: list[tuple]):
+        """`execute()` with `executemany()`, the statement is prepared once for all rows."""
+        if uow := self.board_2_unit_of_work.get(board):
+            uow.statements.append((sql, params, True))
+            return
+
+        with self.db.transaction():
+            self.db.run_query_many(sql, params)
+
+
+    def after_write(self, board: str, callback: Callable[[], None]):
+        if uow := self.board_2_unit_of_work.get(board):
+            uow.on_commit.append(callback)
+            return
+
+        callback()
+
+
     def get_tid_2_existing_pids(self, board: str, tids: list[int]) -> dict[int, set[int]]:
         if not tids:
             return {}
 
-        ph = self.db.placeholder
-        placeholders = ','.join([ph] * len(tids))
-        sql = f'select thread_num, num from `{board}` where thread_num in ({placeholders})'
-        rows = self.db.run_query_tuple(sql, params=tuple(tids))
-
-        result: dict[int, set[int]] = {tid: set() for tid in tids}
-        if rows:
-            for thread_num, num in rows:
-                result[thread_num].add(num)
-        return result
+        return self.thread_index.get_tid_2_pids(board, tids)
 
 
     def get_recently_active_thread_ids(self, board: str, since_seconds: int = 3600) -> set[int]:
         # 1 hour is a long time for an OP to withstand being deleted by a mod
+        tids = self.thread_index.get_recently_active_tids(board, since_seconds)
+        if tids is not None:
+            return tids
+
         # utc epoch seconds
         cutoff = int(time.time()) - since_seconds
         sql = f'select distinct thread_num from `{board}` where thread_num = num and deleted = 0 and locked != 1 and timestamp > {self.db.placeholder}'
@@ -70,7 +163,9 @@ class RitualDb:
         ph = self.db.placeholder
         placeholders = ','.join([ph] * len(pids))
         sql = f"update `{board}` set deleted = 1 where num in ({placeholders});"
-        self.db.run_query_tuple(sql, params=tuple(pids), commit=True)
+        self.execute(board, sql, tuple(pids))
+        self.forget_post_fingerprints(board, pids)
+        self.after_write(board, lambda: self.thread_index.set_deleted(board, pids))
 
 
     def set_threads_deleted(self, board: str, tids: list[int]) -> None:
@@ -80,7 +175,9 @@ class RitualDb:
         ph = self.db.placeholder
         placeholders = ','.join([ph] * len(tids))
         sql = f"update `{board}` set deleted = 1 where num in ({placeholders});"
-        self.db.run_query_tuple(sql, params=tuple(tids), commit=True)
+        self.execute(board, sql, tuple(tids))
+        self.forget_post_fingerprints(board, tids)
+        self.after_write(board, lambda: self.thread_index.set_deleted(board, tids))
 
 
     def set_threads_expired(self, board: str, tids: list[int]) -> None:
@@ -91,7 +188,7 @@ class RitualDb:
         placeholders = ','.join([ph] * len(tids))
         now = int(time.time())
         sql = f"update `{board}` set timestamp_expired = {ph} where thread_num in ({placeholders}) and timestamp_expired = 0;"
-        self.db.run_query_tuple(sql, params=(now, *tids), commit=True)
+        self.execute(board, sql, (now, *tids))
 
 
     def set_threads_archived(self, board: str, tids: list[int]) -> None:
@@ -101,25 +198,28 @@ class RitualDb:
         ph = self.db.placeholder
         placeholders = ','.join([ph] * len(tids))
         sql = f"update `{board}` set locked = 1 where num in ({placeholders}) and thread_num = num;"
-        self.db.run_query_tuple(sql, params=tuple(tids), commit=True)
+        self.execute(board, sql, tuple(tids))
+        self.after_write(board, lambda: self.thread_index.set_locked(board, tids))
 
 
-    def upsert_many(self, board: str, rows: list[dict], conflict_col: str, batch_size: int=500):
+    def upsert_many(self, board: str, rows: list[dict], conflict_col: str, batch_size: int | None=None):
         if not rows:
             return
 
-        keys = list(rows[0])
+        batch_size = batch_size or self.db.batch_size
+
+        # one row per statement, so the statement is the same for every batch, and is prepared once
+        keys = tuple(rows[0])
         ph = self.db.placeholder
-        placeholder = '(' + ','.join([ph] * len(keys)) + ')'
+        placeholders = ','.join([ph] * len(keys))
         sql_cols = ', '.join(keys)
-        sql_conflict = self.db.get_upsert_clause(conflict_col, tuple(keys))
+        sql_conflict = self.db.get_upsert_clause(conflict_col, keys)
+        sql = f"insert into `{board}` ({sql_cols}) values ({placeholders}) {sql_conflict};"
 
-        for i in range(0, len(rows), batch_size):
-            chunk = rows[i:i + batch_size]
-            placeholders = ', '.join([placeholder] * len(chunk))
-            sql = f"insert into `{board}` ({sql_cols}) values {placeholders} {sql_conflict};"
-            flat_values = [v for row in chunk for v in row.values()]
-            self.db.run_query_tuple(sql, params=tuple(flat_values), commit=True)
+        # batches are committed together
+        with self.unit_of_work(board):
+            for i in range(0, len(rows), batch_size):
+                self.execute_many(board, sql, [tuple(row.values()) for row in rows[i:i + batch_size]])
 
 
     def get_existing_media_hashes(self, board: str, media_hashes: list[str]) -> set[str]:
@@ -157,6 +257,18 @@ class RitualDb:
         return set([row[0] for row in rows if row[0]])
 
 
+    def get_recent_media(self, board: str, limit: int) -> list[tuple[str, str]]:
+        """`(media_hash, media)` of the most recently added images, with a saved file."""
+        sql = f"""
+            select media_hash, media
+            from `{board}_images`
+            where media is not null and banned = 0
+            order by media_id desc
+            limit {int(limit)};
+        """
+        return self.db.run_query_tuple(sql) or []
+
+
     def upsert_image(self, board: str, media_hash: str, media: str | None):
         if not media_hash:
             return
@@ -171,49 +283,98 @@ class RitualDb:
             values ({ph}, {ph}, 1, 0)
             {conflict_clause};
         """
-        self.db.run_query_tuple(sql, params=(media_hash, media), commit=True)
+        self.execute(board, sql, (media_hash, media))
 
 
     def upsert_posts(self, board: str, posts: list[dict]):
+        """Only new posts, and posts that changed since they were last written, are converted and written."""
+        pid_2_fingerprint = self.board_2_pid_2_fingerprint.setdefault(board, dict())
+
         posts_to_insert = []
+        pid_fingerprint_pairs = []
 
         for post in posts:
+            pid = post['no']
+            fingerprint = get_post_fingerprint(post)
+            if pid_2_fingerprint.get(pid) == fingerprint:
+                continue
+
             d_board = get_d_board(post, unescape_data_b4_db_write=configs.unescape_data_b4_db_write)
             posts_to_insert.append(d_board)
+            pid_fingerprint_pairs.append((pid, fingerprint))
 
         self.upsert_many(board, posts_to_insert, 'num, subnum')
 
+        # after the write, so failed writes are retried
+        def remember_posts():
+            pid_2_fingerprint.update(pid_fingerprint_pairs)
+            self.prune_post_fingerprints(board)
+            self.thread_index.add_rows(board, posts_to_insert)
 
-    def upsert_thread_stats(self, board: str, thread_stats: dict):
+        self.after_write(board, remember_posts)
+
+
+    def forget_post_fingerprints(self, board: str, pids: list[int]):
+        """the posts are rewritten when next seen, e.g. after they're marked deleted."""
+        pid_2_fingerprint = self.board_2_pid_2_fingerprint.get(board)
+        if not pid_2_fingerprint:
+            return
+
+        for pid in pids:
+            pid_2_fingerprint.pop(pid, None)
+
+
+    def prune_post_fingerprints(self, board: str):
+        """don't let the dict grow over N entries per board."""
+        pid_2_fingerprint = self.board_2_pid_2_fingerprint[board]
+
+        N = 100_000
+        if (count := len(pid_2_fingerprint)) > N:
+            # the oldest posts are the least likely to be seen again
+            M = count - N + N // 10
+            for pid in sorted(pid_2_fingerprint)[:M]:
+                del pid_2_fingerprint[pid]
+
+
+    def get_thread_stats_sql(self, board: str) -> str:
         ph = self.db.placeholder
         update_cols = ('time_op', 'time_last', 'time_bump', 'time_ghost', 'time_ghost_bump', 'time_last_modified', 'nreplies', 'nimages', 'sticky', 'locked')
         conflict_clause = self.db.get_upsert_clause('thread_num', update_cols)
         placeholders = ', '.join([ph] * (len(update_cols) + 1))
-        sql = f"""
+        return f"""
             insert into `{board}_threads` (
                 thread_num, time_op, time_last, time_bump, time_ghost, time_ghost_bump, time_last_modified, nreplies, nimages, sticky, locked
             )
             values ({placeholders})
             {conflict_clause}
         """
-        self.db.run_query_tuple(
-            sql,
-            params=(
-                thread_stats['thread_num'],
-                thread_stats['time_op'],
-                thread_stats['time_last'],
-                thread_stats['time_bump'],
-                thread_stats.get('time_ghost'),
-                thread_stats.get('time_ghost_bump'),
-                thread_stats['time_last_modified'],
-                thread_stats['nreplies'],
-                thread_stats['nimages'],
-                thread_stats['sticky'],
-                thread_stats['locked'],
-            ),
-            commit=True
+
+
+    def upsert_thread_stats(self, board: str, thread_stats: dict):
+        params = (
+            thread_stats['thread_num'],
+            thread_stats['time_op'],
+            thread_stats['time_last'],
+            thread_stats['time_bump'],
+            thread_stats.get('time_ghost'),
+            thread_stats.get('time_ghost_bump'),
+            thread_stats['time_last_modified'],
+            thread_stats['nreplies'],
+            thread_stats['nimages'],
+            thread_stats['sticky'],
+            thread_stats['locked'],
         )
 
+        if uow := self.board_2_unit_of_work.get(board):
+            uow.tid_2_thread_stats_params[thread_stats['thread_num']] = params
+            return
+
+        self.db.run_query_tuple(self.get_thread_stats_sql(board), params=params, commit=True)
+
+
+    def save(self):
+        self.db.save()
+
 
     def save_and_close(self):
         self.db.save_and_close()
@@ -227,10 +388,13 @@ def create_ritual_db() -> RitualDb:
             password=configs.db_mysql_password,
             database=configs.db_mysql_database,
             port=configs.db_mysql_port,
-            sql_echo=configs.db_echo
+            sql_echo=configs.db_echo,
+            pool_size=configs.db_mysql_pool_size,
+            batch_size=configs.db_mysql_batch_size,
+            statements_per_transaction=configs.db_mysql_statements_per_transaction,
         )
     elif configs.db_type == 'sqlite':
-        db = SqliteDb(configs.db_sqlite_path, configs.db_echo)
+        db = SqliteDb(configs.db_sqlite_path, configs.db_echo, pragmas=configs.db_sqlite_pragmas)
     else:
         raise ValueError(configs.db_type)
 
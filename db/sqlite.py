@@ -1,7 +1,9 @@
 import functools
 import sqlite3
+import threading
+from typing import Iterator
 
-from db.base import BaseDb, DotDict
+from db.base import BaseDb, DotDict, get_named_rows
 
 
 def row_factory(cursor, row: tuple):
@@ -13,11 +15,26 @@ class SqliteDb(BaseDb):
     placeholder = '?'
 
 
-    def __init__(self, db_path: str, sql_echo: bool=False):
+    def __init__(self, db_path: str, sql_echo: bool=False, pragmas: dict | None=None):
         self.db_path = db_path
-        self.conn = sqlite3.connect(self.db_path, autocommit=True)
+        # boards processed concurrently share this connection, see `self.lock`
+        self.conn = sqlite3.connect(self.db_path, autocommit=True, check_same_thread=False)
         self.conn.row_factory = row_factory
         self.sql_echo = sql_echo
+        self.lock = threading.RLock()
+
+        if pragmas:
+            self.set_pragmas(pragmas)
+
+
+    def set_pragmas(self, pragmas: dict):
+        """e.g. `{'journal_mode': 'wal', 'cache_size': -65536}`, see `configs.db_sqlite_pragmas`"""
+        with self.lock:
+            for name, value in pragmas.items():
+                if not name.isidentifier():
+                    raise ValueError(name)
+
+                self.conn.execute(f'pragma {name}={value};').fetchall()
 
 
     @functools.lru_cache(maxsize=128)
@@ -29,6 +46,19 @@ class SqliteDb(BaseDb):
         self.conn.commit()
 
 
+    # the connection is in autocommit mode, so transactions are opened explicitly
+    def begin(self):
+        self.conn.execute('begin')
+
+
+    def commit(self):
+        self.conn.execute('commit')
+
+
+    def rollback(self):
+        self.conn.execute('rollback')
+
+
     def close(self):
         self.conn.close()
 
@@ -52,14 +82,15 @@ class SqliteDb(BaseDb):
         if self.sql_echo:
             print(f'{sql_string=}\n{params=}')
 
-        self._set_row_factory(dict_row)
+        with self.lock:
+            self._set_row_factory(dict_row)
 
-        cursor = self.conn.execute(sql_string, params or ())
-        results = cursor.fetchall()
-        cursor.close()
+            cursor = self.conn.execute(sql_string, params or ())
+            results = cursor.fetchall()
+            cursor.close()
 
-        if commit:
-            self.conn.commit()
+            if commit:
+                self.conn.commit()
 
         return results
 
@@ -72,15 +103,34 @@ class SqliteDb(BaseDb):
         return self._run_query(sql_string, params, commit=commit, dict_row=True)
 
 
+    def iter_query(self, sql_string: str, params: tuple=None, arraysize: int=1000, named: bool=False) -> Iterator[tuple]:
+        if self.sql_echo:
+            print(f'{sql_string=}\n{params=}')
+
+        # held for the whole iteration, so other boards can't begin or commit on the shared connection midway
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.row_factory = None
+            cursor.arraysize = arraysize
+            cursor.execute(sql_string, params or ())
+
+            try:
+                while rows := cursor.fetchmany():
+                    yield from get_named_rows(cursor, rows) if named else rows
+            finally:
+                cursor.close()
+
+
     def run_query_many(self, sql_string: str, params: tuple=None, commit: bool=False, dict_row=False):
         if self.sql_echo:
             print(f'{sql_string=}\n{params=}')
 
-        self._set_row_factory(dict_row)
+        with self.lock:
+            self._set_row_factory(dict_row)
 
-        results = self.conn.executemany(sql_string, params or ()).fetchall()
+            results = self.conn.executemany(sql_string, params or ()).fetchall()
 
-        if commit:
-            self.conn.commit()
+            if commit:
+                self.conn.commit()
 
         return results
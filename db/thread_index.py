@@ -0,0 +1,194 @@
+import threading
+import time
+
+import configs
+from db.base import BaseDb
+
+
+class IndexedThread:
+    __slots__ = ('pids', 'op_time', 'deleted', 'locked', 'last_seen')
+
+    def __init__(self):
+        self.pids: set[int] = set()
+
+        # from the OP's row, `None` until the OP is written
+        self.op_time: int | None = None
+        self.deleted: bool = False
+        self.locked: bool = False
+
+        # monotonic, see `ThreadIndex.prune()`
+        self.last_seen: float = time.monotonic()
+
+
+class ThreadIndex:
+    """
+    Per board, the post ids written for each thread, and the OP's timestamp and deleted/locked flags.
+
+    A board is warmed from the database on first use, with every thread whose OP was posted in the last
+    `warm_since_seconds`. Afterwards it's kept up to date by `RitualDb`'s writes, and threads it doesn't know are
+    read from the database once, then kept. An indexed thread always has every post id in the database.
+
+    The database is read without holding the lock, so boards don't wait on each other's reads. A read that overlapped
+    a write to its board answers the lookup, but isn't kept, since it may be missing that write.
+    """
+    def __init__(self, db: BaseDb, warm_since_seconds: int):
+        self.db = db
+        self.warm_since_seconds = warm_since_seconds
+        self.lock = threading.RLock()
+        self.board_2_tid_2_thread: dict[str, dict[int, IndexedThread]] = dict()
+
+        # writes applied per board, see `add_rows()`, `set_deleted()`, and `set_locked()`
+        self.board_2_write_count: dict[str, int] = dict()
+
+
+    def get_tid_2_thread(self, board: str) -> dict[int, IndexedThread]:
+        with self.lock:
+            if (tid_2_thread := self.board_2_tid_2_thread.get(board)) is not None:
+                return tid_2_thread
+            write_count = self.board_2_write_count.get(board, 0)
+
+        tid_2_thread = self.warm(board)
+
+        with self.lock:
+            # warmed by another board worker meanwhile
+            if board in self.board_2_tid_2_thread:
+                return self.board_2_tid_2_thread[board]
+
+            if self.board_2_write_count.get(board, 0) == write_count:
+                self.board_2_tid_2_thread[board] = tid_2_thread
+            return tid_2_thread
+
+
+    def count_write(self, board: str):
+        self.board_2_write_count[board] = self.board_2_write_count.get(board, 0) + 1
+
+
+    def warm(self, board: str) -> dict[int, IndexedThread]:
+        cutoff = int(time.time()) - self.warm_since_seconds
+        sql = f'select thread_num, num, op, timestamp, deleted, locked from `{board}` where timestamp > {self.db.placeholder}'
+
+        tid_2_thread = self.read_threads(sql, (cutoff,))
+
+        # a thread's posts come after its OP, so threads with an OP in the window have all their posts in it
+        tid_2_thread = {tid: thread for tid, thread in tid_2_thread.items() if thread.op_time is not None}
+
+        configs.logger.info(f'[{board}] Thread index warmed with {len(tid_2_thread)} thread(s)')
+        return tid_2_thread
+
+
+    def read_threads(self, sql: str, params: tuple) -> dict[int, IndexedThread]:
+        tid_2_thread: dict[int, IndexedThread] = dict()
+        for thread_num, num, op, timestamp, deleted, locked in self.db.iter_query(sql, params=params):
+            if not (thread := tid_2_thread.get(thread_num)):
+                thread = tid_2_thread[thread_num] = IndexedThread()
+
+            thread.pids.add(num)
+            if op:
+                self.set_op(thread, timestamp, deleted, locked)
+        return tid_2_thread
+
+
+    def set_op(self, thread: IndexedThread, timestamp: int, deleted: int, locked: int):
+        thread.op_time = timestamp
+        thread.deleted = bool(deleted)
+        thread.locked = locked == 1
+
+
+    def get_tid_2_pids(self, board: str, tids: list[int]) -> dict[int, set[int]]:
+        tid_2_thread = self.get_tid_2_thread(board)
+
+        with self.lock:
+            tids_missing = [tid for tid in tids if tid not in tid_2_thread]
+            write_count = self.board_2_write_count.get(board, 0)
+
+        tid_2_thread_read = dict()
+        if tids_missing:
+            ph = self.db.placeholder
+            placeholders = ','.join([ph] * len(tids_missing))
+            sql = f'select thread_num, num, op, timestamp, deleted, locked from `{board}` where thread_num in ({placeholders})'
+            tid_2_thread_read = self.read_threads(sql, tuple(tids_missing))
+
+        with self.lock:
+            is_kept = self.board_2_write_count.get(board, 0) == write_count
+
+            tid_2_thread_missing = dict()
+            for tid in tids_missing:
+                # read by another board worker meanwhile
+                if tid in tid_2_thread:
+                    continue
+
+                thread = tid_2_thread_read.get(tid) or IndexedThread()
+                if is_kept:
+                    tid_2_thread[tid] = thread
+                else:
+                    tid_2_thread_missing[tid] = thread
+
+            now = time.monotonic()
+            tid_2_pids = dict()
+            for tid in tids:
+                thread = tid_2_thread.get(tid) or tid_2_thread_missing[tid]
+                thread.last_seen = now
+                tid_2_pids[tid] = set(thread.pids)
+
+            if board in self.board_2_tid_2_thread:
+                self.prune(board)
+            return tid_2_pids
+
+
+    def get_recently_active_tids(self, board: str, since_seconds: int) -> set[int] | None:
+        """Returns `None` when `since_seconds` reaches further back than the index."""
+        if since_seconds > self.warm_since_seconds:
+            return None
+
+        cutoff = int(time.time()) - since_seconds
+        tid_2_thread = self.get_tid_2_thread(board)
+        with self.lock:
+            return {
+                tid
+                for tid, thread in tid_2_thread.items()
+                if thread.op_time is not None and thread.op_time > cutoff and not thread.deleted and not thread.locked
+            }
+
+
+    def add_rows(self, board: str, rows: list[dict]):
+        """Rows written with `RitualDb.upsert_posts()`. Only updates threads the index already has."""
+        with self.lock:
+            self.count_write(board)
+            tid_2_thread = self.board_2_tid_2_thread.get(board)
+            if tid_2_thread is None:
+                return
+
+            for row in rows:
+                if not (thread := tid_2_thread.get(row['thread_num'])):
+                    continue
+
+                thread.pids.add(row['num'])
+                if row['op']:
+                    self.set_op(thread, row['timestamp'], row['deleted'], row['locked'])
+
+
+    def set_deleted(self, board: str, pids: list[int]):
+        with self.lock:
+            self.count_write(board)
+            tid_2_thread = self.board_2_tid_2_thread.get(board, {})
+            for pid in pids:
+                # only OPs have their deleted flag kept
+                if thread := tid_2_thread.get(pid):
+                    thread.deleted = True
+
+
+    def set_locked(self, board: str, tids: list[int]):
+        with self.lock:
+            self.count_write(board)
+            tid_2_thread = self.board_2_tid_2_thread.get(board, {})
+            for tid in tids:
+                if thread := tid_2_thread.get(tid):
+                    thread.locked = True
+
+
+    def prune(self, board: str):
+        """Drops threads that haven't been looked up in `warm_since_seconds`, they're read again if they come back."""
+        tid_2_thread = self.board_2_tid_2_thread[board]
+        cutoff = time.monotonic() - self.warm_since_seconds
+        for tid in [tid for tid, thread in tid_2_thread.items() if thread.last_seen < cutoff]:
+            del tid_2_thread[tid]
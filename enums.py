@@ -6,6 +6,10 @@ class MediaType(Enum):
     thumbnail = 'thumb'
 
 
+class PollStatus(Enum):
+    not_modified = 'not_modified' # the board's catalog hasn't changed since its last poll
+
+
 class DeletionType(Enum):
     inconclusive = 'inconclusive' # do nothing
     archived = 'archived' # marked as locked
@@ -1,16 +1,53 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+import msgspec
 from requests import JSONDecodeError, Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 import configs
+from rate_limiter import RateLimiter
 from state import State
-from utils import sleep
+
+
+def create_session() -> Session:
+    """
+    Connections are pooled per host and kept alive between requests, and loops.
+    `pool_block` makes workers wait for a free connection rather than opening extra ones.
+    """
+    # only retries connection errors, e.g. a kept-alive connection the server already closed
+    retries = Retry(total=2, connect=2, read=0, status=0, backoff_factor=0.5)
+    adapter = HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=configs.http_pool_size,
+        pool_block=True,
+        max_retries=retries,
+    )
+
+    session = Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class NotModified(dict):
+    """Returned by `Fetcher.fetch_json()` on a 304. Empty like a failed fetch, but the url hasn't changed since it was last fetched."""
 
 
 class Fetcher:
     def __init__(self, state: State | None = None):
-        self.session: Session = Session()
+        self.session: Session = create_session()
         self.state = state
 
-    def fetch_json(self, url, headers=None, request_cooldown_sec: float=None, add_random: bool=False) -> dict | None:
+        # shared by every board worker and by media downloads
+        self.rate_limiter = RateLimiter(configs.rate_limits, configs.rate_limit_default)
+
+    def fetch_json(self, url, headers=None, add_random: bool=False, decoder: msgspec.json.Decoder | None=None, board: str | None=None) -> dict | msgspec.Struct | list | None:
+        """
+        With a `decoder`, the response bytes are decoded and validated into its type, e.g. `utils.thread_decoder`.
+        `board` is the board the url belongs to, see `State.checkpoint()`.
+        """
         request_headers = dict(headers) if headers else dict()
 
         if not configs.ignore_http_cache and self.state:
@@ -18,36 +55,65 @@ class Fetcher:
             if last_modified:
                 request_headers['If-Modified-Since'] = last_modified
 
-        resp = self.session.get(url, headers=request_headers, timeout=10)
+        self.rate_limiter.acquire(url, add_random=add_random)
 
-        if request_cooldown_sec:
-            sleep(request_cooldown_sec, add_random=add_random)
+        resp = self.session.get(url, headers=request_headers, timeout=10)
 
         if resp.status_code == 304:
             if not configs.ignore_http_cache and self.state:
                 last_modified_header = resp.headers.get('Last-Modified')
                 if last_modified_header:
-                    self.state.set_http_last_modified(url, last_modified_header)
+                    self.state.set_http_last_modified(url, last_modified_header, board=board)
             configs.logger.warning(f'Not modified (304) {url}')
-            return dict()
+            return NotModified()
 
         if resp.status_code == 200:
             if not configs.ignore_http_cache and self.state:
                 last_modified_header = resp.headers.get('Last-Modified')
                 if last_modified_header:
-                    self.state.set_http_last_modified(url, last_modified_header)
+                    self.state.set_http_last_modified(url, last_modified_header, board=board)
             try:
+                if decoder:
+                    return decoder.decode(resp.content)
                 return resp.json()
-            except JSONDecodeError:
+            except msgspec.ValidationError:
+                # invalid API data, raised like msgspec.convert() would
+                raise
+            except (JSONDecodeError, msgspec.DecodeError):
                 configs.logger.warning(f'Failed to parse JSON (200) {url}')
                 return dict()
 
         configs.logger.warning(f'Failed to get JSON ({resp.status_code}) {url}')
         return dict()
 
-    def sleep(self):
-        # Refresh session periodically to prevent stale connections
-        # Also refresh if loop cooldown is long enough to warrant it
-        if configs.loop_cooldown_sec >= 15.0:
+    def fetch_json_many(
+        self,
+        urls: list[str],
+        headers=None,
+        add_random: bool=False,
+        transform: Callable[[str, dict], Any] | None=None,
+        decoder: msgspec.json.Decoder | None=None,
+        board: str | None=None,
+    ) -> dict[str, Any]:
+        """
+        Fetches urls concurrently with `configs.fetch_workers` workers, still within the rate limits.
+        `transform(url, data)` runs on the worker, for non-empty responses, e.g. to validate them.
+        Returns `{url: data}` in the same order as `urls`.
+        """
+        def fetch(url: str) -> Any:
+            data = self.fetch_json(url, headers=headers, add_random=add_random, decoder=decoder, board=board)
+            if data and transform:
+                return transform(url, data)
+            return data
+
+        if configs.fetch_workers <= 1 or len(urls) <= 1:
+            return {url: fetch(url) for url in urls}
+
+        with ThreadPoolExecutor(max_workers=configs.fetch_workers, thread_name_prefix='fetch') as pool:
+            return dict(zip(urls, pool.map(fetch, urls)))
+
+    def sleep(self, sleep_sec: float):
+        # Connections are kept alive across loops, unless the sleep before the next one outlasts the server's idle timeout
+        if sleep_sec >= configs.http_keep_alive_sec:
             self.session.close()
-            self.session = Session()
+            self.session = create_session()
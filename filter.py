@@ -1,4 +1,5 @@
 import re
+from functools import lru_cache
 
 import configs
 from catalog import Catalog
@@ -6,12 +7,41 @@ from db.ritual import RitualDb
 from fetcher import Fetcher
 from state import State
 from utils import (
+    compile_rule,
     extract_text_from_html,
     fullmatch_sub_and_com,
     post_has_file,
 )
 
 
+class BoardRules:
+    """A board's configs, with patterns compiled once. Patterns are `re.Pattern`, bools, or `None` when unset."""
+    def __init__(self, board_configs: dict):
+        self.op_comment_min_chars: int | None = board_configs.get('op_comment_min_chars')
+        self.op_comment_min_chars_unique: int | None = board_configs.get('op_comment_min_chars_unique')
+
+        self.blacklist = compile_rule(board_configs.get('blacklist'))
+        self.whitelist = compile_rule(board_configs.get('whitelist'))
+
+        self.dl_fm_op = compile_rule(board_configs.get('dl_fm_op'))
+        self.dl_fm_post = compile_rule(board_configs.get('dl_fm_post'))
+        self.dl_fm_thread = compile_rule(board_configs.get('dl_fm_thread'))
+
+        self.dl_th_op = compile_rule(board_configs.get('dl_th_op'))
+        self.dl_th_post = compile_rule(board_configs.get('dl_th_post'))
+        self.dl_th_thread = compile_rule(board_configs.get('dl_th_thread'))
+
+
+@lru_cache(maxsize=256)
+def get_cached_board_rules(board_config_items: tuple) -> BoardRules:
+    return BoardRules(dict(board_config_items))
+
+
+def get_board_rules(board_configs: dict) -> BoardRules:
+    """Compiled once per board config, and reused by every loop's `Filter`. A changed config is compiled again."""
+    return get_cached_board_rules(tuple(sorted(board_configs.items())))
+
+
 class Filter:
     """
     - 'thread' are OP posts from the catalog, https://github.com/4chan/4chan-API/blob/master/pages/Catalog.md
@@ -31,6 +61,11 @@ class Filter:
 
         self.banned_media_hashes: set[str] = set()
 
+        self.rules = get_board_rules(configs.boards[board])
+
+        # pid -> comment text, so each post's html is parsed once across all rules
+        self.pid_2_com_text: dict[int, str] = dict()
+
 
     def set_tid_2_posts(self, tid_2_posts: dict[int, list[dict]]):
         self.tid_2_posts = tid_2_posts
@@ -49,11 +84,8 @@ class Filter:
             for thread in page['threads']:
                 tid = thread['no']
 
-                subject = thread.get('sub', '')
-                comment = thread.get('com', '')
-
-                subject_text = extract_text_from_html(subject)
-                comment_text = extract_text_from_html(comment)
+                subject_text = extract_text_from_html(thread.get('sub', ''))
+                comment_text = self.get_com_text(thread)
 
                 if not self.should_archive(subject_text, comment_text):
                     continue
@@ -85,39 +117,47 @@ class Filter:
         - If only a whitelist is specified, archive whitelisted posts, and skip everything else.
         - If no lists are specified, archive everything.
         """
-        op_comment_min_chars = configs.boards[self.board].get('op_comment_min_chars')
+        op_comment_min_chars = self.rules.op_comment_min_chars
         if op_comment_min_chars and len(comment) < op_comment_min_chars:
             return False
 
-        op_comment_min_chars_unique = configs.boards[self.board].get('op_comment_min_chars_unique')
+        op_comment_min_chars_unique = self.rules.op_comment_min_chars_unique
         if op_comment_min_chars_unique and len(set(comment)) < op_comment_min_chars_unique:
             return False
 
-        blacklist_post_filter = configs.boards[self.board].get('blacklist') if blacklist is None else blacklist
-        if blacklist_post_filter:
-            if subject and re.search(blacklist_post_filter, subject, re.IGNORECASE):
+        blacklist_pattern = self.rules.blacklist if blacklist is None else compile_rule(blacklist)
+        if blacklist_pattern:
+            if subject and blacklist_pattern.search(subject):
                 return False
-            if comment and re.search(blacklist_post_filter, comment, re.IGNORECASE):
+            if comment and blacklist_pattern.search(comment):
                 return False
 
-        whitelist_post_filter = configs.boards[self.board].get('whitelist') if whitelist is None else whitelist
-        if whitelist_post_filter:
-            if subject and re.search(whitelist_post_filter, subject, re.IGNORECASE):
+        whitelist_pattern = self.rules.whitelist if whitelist is None else compile_rule(whitelist)
+        if whitelist_pattern:
+            if subject and whitelist_pattern.search(subject):
                 return True
-            if comment and re.search(whitelist_post_filter, comment, re.IGNORECASE):
+            if comment and whitelist_pattern.search(comment):
                 return True
             return False
 
         return True
 
 
-    def is_media_needed_conf(self, post: dict, pattern_or_bool: str | bool) -> bool:
+    def get_com_text(self, post: dict) -> str:
+        pid = post['no']
+        if pid not in self.pid_2_com_text:
+            self.pid_2_com_text[pid] = extract_text_from_html(post.get('com', ''))
+        return self.pid_2_com_text[pid]
+
+
+    def is_media_needed_conf(self, post: dict, pattern_or_bool: re.Pattern | str | bool | None) -> bool:
         """Determines whether media should be downloaded based on a regex or bool from configs."""
         if isinstance(pattern_or_bool, bool):
             return pattern_or_bool
 
-        if isinstance(pattern_or_bool, str):
-            return fullmatch_sub_and_com(post, pattern_or_bool)
+        if isinstance(pattern_or_bool, (re.Pattern, str)) and pattern_or_bool:
+            com_text = self.get_com_text(post) if post.get('com') else None
+            return fullmatch_sub_and_com(post, pattern_or_bool, com_text=com_text)
 
         return False
 
@@ -128,13 +168,13 @@ class Filter:
         """
         make_thumbnails = configs.make_thumbnails
 
-        dl_fm_op = configs.boards[self.board].get('dl_fm_op')
-        dl_fm_post = configs.boards[self.board].get('dl_fm_post')
-        dl_fm_thread = configs.boards[self.board].get('dl_fm_thread')
+        dl_fm_op = self.rules.dl_fm_op
+        dl_fm_post = self.rules.dl_fm_post
+        dl_fm_thread = self.rules.dl_fm_thread
 
-        dl_th_op = configs.boards[self.board].get('dl_th_op')
-        dl_th_post = configs.boards[self.board].get('dl_th_post')
-        dl_th_thread = configs.boards[self.board].get('dl_th_thread')
+        dl_th_op = self.rules.dl_th_op
+        dl_th_post = self.rules.dl_th_post
+        dl_th_thread = self.rules.dl_th_thread
 
         media_hashes = []
         for posts in self.tid_2_posts.values():
@@ -8,21 +8,36 @@ class Loop:
     def __init__(self):
         self.loop_i: int = 1
         self.start_time: float | None = None
+        self.board_2_start_time: dict[str, float] = dict()
         self.board_2_duration: dict[str, float] = dict()
+        self.loop_start_time: float = time.time()
+        self.loop_duration: float | None = None
         configs.logger.info(f'Loop #{self.loop_i} Started')
 
     @property
     def is_first_loop(self) -> bool:
         return self.loop_i == 1
 
-    def set_start_time(self):
+    def start_pass(self):
+        """Called before each pass over the boards, whichever way the previous pass slept."""
+        self.loop_start_time = time.time()
+
+        # boards skipped this pass, e.g. not due with adaptive polling, don't report last pass's durations
+        self.board_2_start_time.clear()
+        self.board_2_duration.clear()
+
+    def set_start_time(self, board: str | None = None):
+        """Boards processed concurrently keep their own start time."""
         self.start_time = time.time()
+        if board:
+            self.board_2_start_time[board] = self.start_time
 
-    def get_duration_minutes(self) -> float:
-        return round((time.time() - self.start_time) / 60, 2)
+    def get_duration_minutes(self, board: str | None = None) -> float:
+        start_time = self.board_2_start_time.get(board, self.start_time)
+        return round((time.time() - start_time) / 60, 2)
 
     def set_board_duration_minutes(self, board: str):
-        self.board_2_duration[board] = self.get_duration_minutes()
+        self.board_2_duration[board] = self.get_duration_minutes(board)
 
     def log_board_durations(self):
         s = 'Duration for each board:\n'
@@ -32,13 +47,18 @@ class Loop:
 
         total_duration = round(sum(self.board_2_duration.values()), 1)
         s += f'Total Duration: {total_duration}m\n'
+
+        # with concurrent boards, this is less than the total duration
+        if self.loop_duration is not None:
+            s += f'Wall-clock Duration: {self.loop_duration:.1f}m\n'
+
         configs.logger.info(s)
 
     def increment_loop(self):
         configs.logger.info(f'Loop #{self.loop_i} Completed\n')
+        self.loop_duration = round((time.time() - self.loop_start_time) / 60, 2)
         self.loop_i += 1
 
     def sleep(self):
         configs.logger.info(f'Doing loop cooldown sleep for {configs.loop_cooldown_sec}s\n')
         time.sleep(configs.loop_cooldown_sec)
-
@@ -1,16 +1,19 @@
 import os
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 import configs
 from archive import Archive
 from catalog import Catalog
 from db.ritual import RitualDb, create_ritual_db
+from enums import PollStatus
 from scanner.scanner import ScannerDb
 from fetcher import Fetcher
-from filter import Filter
+from filter import Filter, get_board_rules
 from loop import Loop
 from media_fp import AsagiMediaFP, SutraMediaFP, MediaFP
 from posts import Posts
+from scheduler import BoardScheduler
 from state import State
 from utils import (
     fetch_and_save_boards_json,
@@ -41,12 +44,20 @@ class Init:
 
         configs.logger.info(f'{len(configs.boards_with_archive)} boards have archive support')
 
+        # compiles every board's filter rules up front, so a bad pattern fails at startup
+        for board_configs in configs.boards.values():
+            get_board_rules(board_configs)
 
-def process_board(board: str, db: RitualDb, fetcher: Fetcher, loop: Loop, state: State, media_fp: MediaFP):
-    loop.set_start_time()
+
+def process_board(board: str, db: RitualDb, fetcher: Fetcher, loop: Loop, state: State, media_fp: MediaFP) -> Posts | PollStatus | None:
+    """Returns `None` if the catalog could not be fetched, and `PollStatus.not_modified` if it hasn't changed."""
+    loop.set_start_time(board)
 
     catalog = Catalog(fetcher, board)
     if not catalog.fetch_catalog():
+        if catalog.not_modified:
+            loop.set_board_duration_minutes(board)
+            return PollStatus.not_modified
         return
 
     state.update_thread_meta(board, catalog.tid_2_page, catalog.tid_2_thread)
@@ -57,11 +68,18 @@ def process_board(board: str, db: RitualDb, fetcher: Fetcher, loop: Loop, state:
     filter = Filter(fetcher, db, board, state)
     filter.filter_catalog(catalog)
 
-    posts = Posts(db, fetcher, board, filter.tid_2_thread, state, catalog)
-    posts.fetch_posts(archive)
+    # the board's post, thread and deletion writes are committed together
+    try:
+        with db.unit_of_work(board):
+            posts = Posts(db, fetcher, board, filter.tid_2_thread, state, catalog)
+            posts.fetch_posts(archive)
 
-    if configs.boards[board].get('thread_text') != False:
-        posts.save_posts()
+            if configs.boards[board].get('thread_text') != False:
+                posts.save_posts()
+    except BaseException:
+        # rolled back, so its threads mustn't be saved as seen
+        state.discard_board_changes(board)
+        raise
 
     filter.set_tid_2_posts(posts.tid_2_posts)
     filter.get_pids_for_download()
@@ -69,16 +87,86 @@ def process_board(board: str, db: RitualDb, fetcher: Fetcher, loop: Loop, state:
     media_fp.download_media_for_ids(board, posts.pid_2_post, filter.full_pids, filter.thumb_pids)
     media_fp.flush(board)
 
+    # after the board's unit of work commits, never before
+    if configs.state_checkpoint_each_board:
+        state.checkpoint(board)
+
     loop.set_board_duration_minutes(board)
 
+    return posts
+
+
+def process_boards(boards: list[str], db: RitualDb, fetcher: Fetcher, loop: Loop, state: State, media_fp: MediaFP) -> dict[str, Posts | PollStatus | None]:
+    """
+    Runs `process_board()` for each board, one after another, or concurrently when `configs.concurrent_boards` is set.
+    Concurrent boards share the fetcher, so requests still respect each host's rate limits.
+    """
+    if not configs.concurrent_boards:
+        return {board: process_board(board, db, fetcher, loop, state, media_fp) for board in boards}
+
+    pool = ThreadPoolExecutor(max_workers=configs.board_workers, thread_name_prefix='board')
+    try:
+        board_2_future = {board: pool.submit(process_board, board, db, fetcher, loop, state, media_fp) for board in boards}
+
+        # a failed board doesn't stop the others, its exception is re-raised once they're done
+        board_2_posts = dict()
+        first_error = None
+        for board, future in board_2_future.items():
+            try:
+                board_2_posts[board] = future.result()
+            except Exception as e:
+                configs.logger.error(f'[{board}] Failed: {e}')
+                configs.logger.error(''.join(traceback.format_exception(e)))
+                board_2_posts[board] = None
+                first_error = first_error or e
+
+        if first_error:
+            raise first_error
+
+        return board_2_posts
+    finally:
+        # let running boards finish before state is saved, skip boards that haven't started, e.g. on KeyboardInterrupt
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def update_board_scheduler(board_scheduler: BoardScheduler, board_2_posts: dict[str, Posts | PollStatus | None]):
+    for board, posts in board_2_posts.items():
+        if posts is PollStatus.not_modified:
+            # a successful poll that found nothing new, so quiet boards back off
+            board_scheduler.update(board, 0, 0)
+        elif posts:
+            board_scheduler.update(board, posts.new_post_count, posts.missing_thread_count)
+        else:
+            board_scheduler.update(board, None, None)
 
-def save_on_error(state: State, ritual_db: RitualDb, scanner_db: ScannerDb | None, media_fp: MediaFP, board: str):
+
+def save_on_error(state: State, ritual_db: RitualDb, scanner_db: ScannerDb | None, media_fp: MediaFP):
+    """Saves what's done so far, the loop carries on afterwards, so nothing is shut down."""
+    configs.logger.info('Saving State...')
+    state.save()
+    configs.logger.info('  Done')
+
+    configs.logger.info('Flushing MediaFP...')
+    media_fp.flush_all()
+    configs.logger.info('  Done')
+
+    configs.logger.info('Saving RitualDb...')
+    ritual_db.save()
+    configs.logger.info('  Done')
+
+    if scanner_db and scanner_db.conn:
+        configs.logger.info('Saving ScannerDb...')
+        scanner_db.conn.commit()
+        configs.logger.info('  Done')
+
+
+def save_on_exit(state: State, ritual_db: RitualDb, scanner_db: ScannerDb | None, media_fp: MediaFP):
     configs.logger.info('Saving State...')
     state.save()
     configs.logger.info('  Done')
 
     configs.logger.info('Shutting down MediaFP...')
-    media_fp.shutdown(board)
+    media_fp.shutdown()
     configs.logger.info('  Done')
 
     configs.logger.info('Shutting down RitualDb...')
@@ -113,29 +201,42 @@ def main():
 
     media_fp = get_media_fp(fetcher, ritual_db, scanner_db)
 
+    # polls each board when it's due, rather than every board each loop
+    board_scheduler = BoardScheduler(list(configs.boards)) if configs.adaptive_polling else None
+
     critical_error_count = 0
-    board = ''
     while True:
         try:
-            for board in configs.boards:
-                process_board(board, ritual_db, fetcher, loop, state, media_fp)
+            loop.start_pass()
+            boards = board_scheduler.get_due_boards() if board_scheduler else list(configs.boards)
+
+            board_2_posts = process_boards(boards, ritual_db, fetcher, loop, state, media_fp)
 
-            fetcher.sleep()
             state.save()
 
             loop.increment_loop()
             loop.log_board_durations()
-            loop.sleep()
+            media_fp.media_queue.log_stats()
+            if configs.make_thumbnails:
+                media_fp.thumbnail_queue.log_stats()
+
+            if board_scheduler:
+                update_board_scheduler(board_scheduler, board_2_posts)
+                board_scheduler.log_intervals()
+                fetcher.sleep(board_scheduler.get_sleep_sec())
+                board_scheduler.sleep()
+            else:
+                fetcher.sleep(configs.loop_cooldown_sec)
+                loop.sleep()
 
         except KeyboardInterrupt:
             configs.logger.info('Received interrupt signal')
-            save_on_error(state, ritual_db, scanner_db, media_fp, board)
             break
 
         except Exception as e:
             configs.logger.error(f'Critical error in main loop: {e}')
             configs.logger.error(traceback.format_exc())
-            save_on_error(state, ritual_db, scanner_db, media_fp, board)
+            save_on_error(state, ritual_db, scanner_db, media_fp)
             critical_error_count += 1
             n_critical_errors = 5
             if critical_error_count >= n_critical_errors:
@@ -146,6 +247,8 @@ def main():
             configs.logger.info(f'Sleeping for {sleep_for}s, maybe the issue will resolve itself by then...')
             sleep(sleep_for)
 
+    save_on_exit(state, ritual_db, scanner_db, media_fp)
+    state.close()
     configs.logger.info('Exited while loop, ending program.')
 
 
@@ -1,44 +1,104 @@
 import os
+import threading
+import time
 from abc import ABC, abstractmethod
-from requests import Session
+from contextlib import closing
+from itertools import islice
 
 import configs
 from enums import MediaType
 from fetcher import Fetcher
 from db.ritual import RitualDb
+from media_index import MediaIndex
+from media_queue import MediaQueue
 from scanner.scanner import ScannerDb
+from thumbnails import ThumbnailQueue
 from utils import (
-    create_thumbnail,
-    fetch_media_bytes,
+    fetch_media_to_file,
     get_media_url,
-    sleep,
     get_md5_b64_hash,
     get_fs_safe_b64,
+    is_video_path,
     log_util,
     makedir_p,
 )
 
 
-def wrap_fetch_media_bytes(session: Session, url: str, ext: str) -> bytes | None:
-    return fetch_media_bytes(
+# temp files older than this aren't being downloaded to anymore
+stale_tmp_age_s = 60 * 60
+
+
+def iter_filenames(dirpath: str):
+    """Every filename under `dirpath`, from directory listings only, files aren't stat'd. Stale temp files are removed."""
+    for root, _, filenames in os.walk(dirpath):
+        for filename in filenames:
+            if filename.endswith('.tmp'):
+                remove_stale_tmp(os.path.join(root, filename))
+                continue
+            yield filename
+
+
+def remove_stale_tmp(filepath: str):
+    """Left by downloads that didn't finish, e.g. the process was killed. Recent ones may still be downloading."""
+    try:
+        if time.time() - os.path.getmtime(filepath) > stale_tmp_age_s:
+            os.remove(filepath)
+    except OSError:
+        # renamed into place, or removed, meanwhile
+        pass
+
+
+def wrap_fetch_media_to_file(fetcher: Fetcher, url: str, ext: str, dirpath: str, filename: str) -> tuple[str, int, str] | None:
+    # videos are bigger, so they take more of the media host's budget
+    tokens = configs.video_cooldown_sec / configs.image_cooldown_sec if is_video_path(ext) else 1.0
+
+    return fetch_media_to_file(
         url,
-        ext,
-        video_cooldown_sec=configs.video_cooldown_sec,
-        image_cooldown_sec=configs.image_cooldown_sec,
+        dirpath,
+        filename,
         headers=configs.headers,
         logger=configs.logger,
-        session=session,
+        session=fetcher.session,
         max_bytes=configs.fsize_upper_limit if (configs.enforce_fsize_upper_limit and configs.fsize_upper_limit) else None,
+        rate_limiter=fetcher.rate_limiter,
+        tokens=tokens,
     )
 
 
 class MediaFP(ABC):
+    # for layouts that save the same file under several paths, see `link_saved_duplicate()`
+    link_duplicates = False
+
     def __init__(self, fetcher: Fetcher, media_save_path: str, ritual_db: RitualDb, scanner_db: ScannerDb | None):
         self.fetcher = fetcher
         self.media_save_path = media_save_path
         self.ritual_db = ritual_db
         self.scanner_db = scanner_db
-        self.ritual_queue = []
+
+        # kept per board, boards can be processed concurrently
+        self.board_2_ritual_queue: dict[str, list[tuple[str, str]]] = dict()
+        self.ritual_queue_lock = threading.Lock()
+
+        # downloads run on their own workers, see `download_media_for_ids()`
+        self.media_queue = MediaQueue(configs.media_workers, configs.media_queue_size)
+
+        # with configs.make_thumbnails, see `make_thumbnail()`
+        self.thumbnail_queue = ThumbnailQueue(
+            configs.thumbnail_workers,
+            configs.thumbnail_max_pending,
+            configs.thumbnail_backlog_size,
+            configs.thumbnail_max_attempts,
+            configs.thumbnail_retry_delay_sec,
+        )
+
+        # saved media, see `is_saved()`
+        self.media_index = MediaIndex(
+            configs.media_index_max_per_board,
+            configs.media_index_path,
+            max_md5s=configs.media_index_max_md5s if self.link_duplicates else 0,
+        )
+        self.media_index.load()
+        self.md5_warmed_boards: set[str] = set()
 
 
     def flush(self, board: str):
@@ -46,17 +106,31 @@ class MediaFP(ABC):
             self.flush_ritual_db_images(board)
 
 
-    def shutdown(self, board: str):
-        """`flush(board)` and close any non-RitualDb connections."""
-        if board:
-            self.flush(board)
+    def flush_all(self):
+        """`flush()` every board with queued images, and save the media index. Downloads and thumbnails keep running."""
+        for queued_board in list(self.board_2_ritual_queue):
+            self.flush(queued_board)
+
+        self.media_index.save()
+
+
+    def shutdown(self):
+        """Stops downloads and thumbnails, then `flush_all()`. Only for exiting, they can't be restarted."""
+        # downloads in progress finish, queued ones are picked up again next run
+        self.media_queue.shutdown()
+        self.thumbnail_queue.shutdown()
+
+        self.flush_all()
 
 
     def flush_ritual_db_images(self, board: str):
         """
         Writes to <board>_images table.
         """
-        if not self.ritual_queue:
+        # media workers add to the queue, images downloaded after this are flushed with the board's next flush
+        with self.ritual_queue_lock:
+            ritual_queue = self.board_2_ritual_queue.pop(board, None)
+        if not ritual_queue:
             return
 
         sql = f'''
@@ -66,8 +140,7 @@ class MediaFP(ABC):
             total = total + 1,
             media = coalesce(media, excluded.media)
         ;'''
-        self.ritual_db.db.run_query_many(sql, self.ritual_queue, commit=True)
-        self.ritual_queue = []
+        self.ritual_db.db.run_query_many(sql, ritual_queue, commit=True)
 
 
     @abstractmethod
@@ -75,34 +148,171 @@ class MediaFP(ABC):
         pass
 
 
-    def save(self, post: dict, board: str, media_type: MediaType, content: bytes, dirpath: str=None, filename: str=None):
+    @abstractmethod
+    def get_media_root(self, board: str, media_type: MediaType) -> str:
+        """The directory holding every file of `media_type` for `board`."""
+        pass
+
+
+    def get_index_board(self, board: str) -> str:
+        """The `MediaIndex` board that `board`'s media is indexed under."""
+        return board
+
+
+    def is_saved(self, board: str, media_type: MediaType, dirpath: str, filename: str) -> bool:
+        """Checks the media index, and only checks the disk on a miss."""
+        index_board = self.get_index_board(board)
+        self.warm_media_index(board, media_type)
+
+        if self.media_index.has(index_board, media_type, filename):
+            return True
+
+        if os.path.isfile(os.path.join(dirpath, filename)):
+            self.media_index.add(index_board, media_type, filename)
+            return True
+
+        return False
+
+
+    def warm_media_index(self, board: str, media_type: MediaType):
         """
-        Overwrites any existing files.
+        Fills a table of the media index on first use, unless it was loaded from `configs.media_index_path`.
+        - `scanner_db`: full media recorded in ScannerDb.hashtab
+        - `directory`: a listing of the board's media directory
+
+        The listing is read without holding the index's lock, other boards' lookups carry on meanwhile.
+        Until it's added, lookups for this table miss, and check the disk.
+        """
+        index_board = self.get_index_board(board)
+
+        # only the first caller warms the table
+        if not self.media_index.create_table(index_board, media_type):
+            return
+
+        media_root = self.get_media_root(board, media_type)
+        filenames = None
+        if configs.media_index_warm == 'scanner_db' and self.scanner_db and media_type == MediaType.full_media:
+            # without directories, hashtab only tells us filenames, that's enough for Sutra's shared directories
+            dirpath_prefix = media_root if configs.save_directories_in_db else None
+            if dirpath_prefix or index_board == '':
+                filenames = self.scanner_db.iter_filenames(dirpath_prefix=dirpath_prefix)
+
+        elif configs.media_index_warm == 'directory':
+            filenames = iter_filenames(media_root)
+
+        if filenames is None:
+            return
+
+        # no more than the table can hold, closing releases ScannerDb's lock when stopped early
+        with closing(filenames):
+            filenames = list(islice(filenames, self.media_index.max_per_table))
+
+        count = self.media_index.add_many(index_board, media_type, filenames)
+        configs.logger.info(f'[{board}] Media index warmed with {count} {media_type.value} file(s)')
+
+
+    def warm_md5_index(self, board: str):
+        """
+        Adds the board's most recent images from <board>_images to the md5 index, once per run.
+        Each board gets an even share of `configs.media_index_max_md5s`. Rows are only added if their file is saved,
+        known from the media index, or checked on disk. Like `warm_media_index()`, it's read without the index's lock.
+        """
+        with self.media_index.lock:
+            if board in self.md5_warmed_boards:
+                return
+            self.md5_warmed_boards.add(board)
+
+        self.warm_media_index(board, MediaType.full_media)
+        with self.media_index.lock:
+            saved_filenames = set(self.media_index.get_filenames(self.get_index_board(board), MediaType.full_media) or ())
+
+        limit = configs.media_index_max_md5s // max(len(configs.boards), 1)
+
+        md5_relpath_pairs = []
+        for media_hash, media in self.ritual_db.get_recent_media(board, limit):
+            tim, ext = os.path.splitext(media)
+            dirpath, filename = self.get_dirpath_and_filename(board, MediaType.full_media, dict(tim=tim, ext=ext))
+            filepath = os.path.join(dirpath, filename)
+
+            # a row doesn't mean its file is still on disk
+            if filename not in saved_filenames and not os.path.isfile(filepath):
+                continue
+
+            md5_relpath_pairs.append((media_hash, os.path.relpath(filepath, self.media_save_path)))
+
+        # newest first, they're added last so they're evicted last
+        count = self.media_index.add_md5s(reversed(md5_relpath_pairs))
+        configs.logger.info(f'[{board}] Media md5 index warmed with {count} file(s)')
+
+
+    def link_saved_duplicate(self, board: str, post: dict, dirpath: str, filename: str) -> bool:
+        """
+        Hardlinks a file already saved with the same API md5, e.g. from another board, rather than downloading it.
+        Returns `False` if there isn't one, or it can't be linked, e.g. it's on another filesystem.
+        """
+        if not (md5 := post.get('md5')):
+            return False
+
+        self.warm_md5_index(board)
+
+        if not (relpath := self.media_index.get_relpath(md5)):
+            return False
+
+        src_filepath = os.path.join(self.media_save_path, relpath)
+        filepath = os.path.join(dirpath, filename)
+        if src_filepath == filepath:
+            return False
+
+        try:
+            makedir_p(dirpath)
+            os.link(src_filepath, filepath)
+        except OSError as e:
+            if not os.path.isfile(src_filepath):
+                self.media_index.discard_md5(md5)
+            log_util(configs.logger, f'[{board}] Not linked: {src_filepath} -> {filepath} - {e}')
+            return False
+
+        self.media_index.add(self.get_index_board(board), MediaType.full_media, filename)
+        configs.logger.info(f'[{board}] Linked [{MediaType.full_media.value}] {src_filepath} -> {filepath}')
+        return True
+
+
+    def on_full_media_saved(self, board: str, post: dict, dirpath: str, filename: str):
+        if configs.scanner_db_enabled and self.scanner_db:
+            self.scanner_db.insert_from_names(dirpath, filename, configs.save_directories_in_db)
+
+        if post['md5']:
+            media = f"{post.get('tim')}{post.get('ext')}"
+            with self.ritual_queue_lock:
+                self.board_2_ritual_queue.setdefault(board, []).append((post['md5'], media))
+
+            if self.link_duplicates:
+                self.media_index.add_md5(post['md5'], os.path.relpath(os.path.join(dirpath, filename), self.media_save_path))
+
+
+    def save(self, post: dict, board: str, media_type: MediaType, tmp_filepath: str, dirpath: str=None, filename: str=None):
+        """
+        Renames a downloaded temp file into place, overwriting any existing file.
+        The rename is atomic, so a file at its final path is always complete.
         """
         if not (dirpath and filename):
             dirpath, filename = self.get_dirpath_and_filename(board, media_type, post)
 
         filepath = os.path.join(dirpath, filename)
 
-        makedir_p(dirpath)
-
-        with open(filepath, 'wb') as f:
-            f.write(content)
+        os.replace(tmp_filepath, filepath)
+        self.media_index.add(self.get_index_board(board), media_type, filename)
 
         configs.logger.info(f'[{board}] Saved [{media_type.value}] {filepath}')
 
         if configs.make_thumbnails and media_type == MediaType.full_media:
-            sleep(0.1)
-            if os.path.isfile(filepath):
-                dirpath_thumb, filename_thumb = self.get_dirpath_and_filename(board, MediaType.thumbnail, post)
-                filepath_thumb = os.path.join(dirpath_thumb, filename_thumb)
-                makedir_p(dirpath_thumb)
-                create_thumbnail(
-                    post,
-                    filepath,
-                    filepath_thumb,
-                    logger=configs.logger,
-                )
+            self.make_thumbnail(post, board, filepath)
+
+
+    def make_thumbnail(self, post: dict, board: str, filepath: str):
+        """Queues the thumbnail, see `ThumbnailQueue`."""
+        dirpath_thumb, filename_thumb = self.get_dirpath_and_filename(board, MediaType.thumbnail, post)
+        self.thumbnail_queue.submit(filepath, os.path.join(dirpath_thumb, filename_thumb))
 
 
     def should_write_to_disk(
@@ -110,7 +320,7 @@ class MediaFP(ABC):
         url: str,
         post: dict,
         media_type: MediaType,
-        content: bytes,
+        content: bytes | None,
         fsize_computed: int | None=None,
         md5_computed: str | None=None,
     ) -> bool:
@@ -140,43 +350,46 @@ class MediaFP(ABC):
 
     def download_full_media(self, url: str, post: dict, board: str):
         dirpath, filename = self.get_dirpath_and_filename(board, MediaType.full_media, post)
-        filepath = os.path.join(dirpath, filename)
-
-        if os.path.isfile(filepath):
+        if self.is_saved(board, MediaType.full_media, dirpath, filename):
             return
 
-        content = wrap_fetch_media_bytes(self.fetcher.session, url, post['ext'])
-        if not content:
-            return
+        if self.link_duplicates and self.link_saved_duplicate(board, post, dirpath, filename):
+            if configs.make_thumbnails:
+                self.make_thumbnail(post, board, os.path.join(dirpath, filename))
 
-        if not self.should_write_to_disk(url, post, MediaType.full_media, content):
+        elif not self.download(url, post, board, MediaType.full_media, dirpath, filename):
             return
 
-        self.save(post, board, MediaType.full_media, content)
-
-        if configs.scanner_db_enabled and self.scanner_db:
-            self.scanner_db.insert_from_names(dirpath, filename, configs.save_directories_in_db)
-
-        if post['md5']:
-            media = f"{post.get('tim')}{post.get('ext')}"
-            self.ritual_queue.append((post['md5'], media))
+        self.on_full_media_saved(board, post, dirpath, filename)
 
 
     def download_thumbnail(self, url: str, post: dict, board: str):
         dirpath, filename = self.get_dirpath_and_filename(board, MediaType.thumbnail, post)
-        filepath = os.path.join(dirpath, filename)
-
-        if os.path.isfile(filepath):
+        if self.is_saved(board, MediaType.thumbnail, dirpath, filename):
             return
 
-        content = wrap_fetch_media_bytes(self.fetcher.session, url, post['ext'])
-        if not content:
-            return
+        self.download(url, post, board, MediaType.thumbnail, dirpath, filename)
 
-        if not self.should_write_to_disk(url, post, MediaType.thumbnail, content):
-            return
 
-        self.save(post, board, MediaType.thumbnail, content)
+    def download(self, url: str, post: dict, board: str, media_type: MediaType, dirpath: str, filename: str) -> bool:
+        """Streams the file to a temp file next to `filename`, then saves it, or removes it if it's rejected."""
+        download = wrap_fetch_media_to_file(self.fetcher, url, post['ext'], dirpath, filename)
+        if not download:
+            return False
+
+        tmp_filepath, fsize, md5_b64 = download
+        self.media_queue.record_download(fsize)
+
+        try:
+            if not self.should_write_to_disk(url, post, media_type, None, fsize_computed=fsize, md5_computed=md5_b64):
+                return False
+
+            self.save(post, board, media_type, tmp_filepath, dirpath=dirpath, filename=filename)
+            return True
+
+        finally:
+            if os.path.isfile(tmp_filepath):
+                os.remove(tmp_filepath)
 
 
     def download_media_for_ids(
@@ -186,6 +399,10 @@ class MediaFP(ABC):
         full_pids: set[int],
         thumb_pids: set[int]
     ):
+        """
+        Queues the downloads, see `MediaQueue`. Returns once they're queued, unless the queue is full.
+        Downloads of the same file are only queued once, e.g. with `SutraMediaFP`, a file posted to two boards.
+        """
         for pid in full_pids:
             if pid not in pid_2_post:
                 configs.logger.info(f'[{board}] Post {pid} not found in pid_2_post, skipping full media download')
@@ -193,7 +410,8 @@ class MediaFP(ABC):
 
             post = pid_2_post[pid]
             url = get_media_url(configs.url_full_media, board, post, MediaType.full_media)
-            self.download_full_media(url, post, board)
+            key = self.get_dirpath_and_filename(board, MediaType.full_media, post)
+            self.media_queue.submit(key, self.download_full_media, url, post, board)
 
         if configs.make_thumbnails:
             return
@@ -205,11 +423,14 @@ class MediaFP(ABC):
 
             post = pid_2_post[pid]
             url = get_media_url(configs.url_thumbnail, board, post, MediaType.thumbnail)
-            self.download_thumbnail(url, post, board)
+            key = self.get_dirpath_and_filename(board, MediaType.thumbnail, post)
+            self.media_queue.submit(key, self.download_thumbnail, url, post, board)
 
 
 class AsagiMediaFP(MediaFP):
     def __init__(self, fetcher: Fetcher, media_save_path: str, ritual_db: RitualDb, scanner_db: ScannerDb | None):
+        # each board has its own directories, so a file posted to several boards is saved several times
+        self.link_duplicates = configs.asagi_link_duplicates
         super().__init__(fetcher, media_save_path, ritual_db, scanner_db)
 
 
@@ -232,6 +453,10 @@ class AsagiMediaFP(MediaFP):
         return dirpath, filename
 
 
+    def get_media_root(self, board: str, media_type: MediaType) -> str:
+        return os.path.join(self.media_save_path, board, 'image' if media_type == MediaType.full_media else 'thumb')
+
+
 class SutraMediaFP(MediaFP):
     def __init__(self, fetcher: Fetcher, media_save_path: str, ritual_db: RitualDb, scanner_db: ScannerDb | None):
         super().__init__(fetcher, media_save_path, ritual_db, scanner_db)
@@ -254,3 +479,12 @@ class SutraMediaFP(MediaFP):
         )
 
         return dirpath, filename
+
+
+    def get_media_root(self, board: str, media_type: MediaType) -> str:
+        return os.path.join(self.media_save_path, 'img' if media_type == MediaType.full_media else 'thb')
+
+
+    def get_index_board(self, board: str) -> str:
+        # every board's media is saved to the same directories
+        return ''
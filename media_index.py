@@ -0,0 +1,156 @@
+import threading
+from collections import OrderedDict
+from typing import Iterable
+
+from enums import MediaType
+from utils import read_json, write_json_obj_to_file
+
+
+class MediaIndex:
+    """
+    Filenames of media known to be saved, per board and media type, so most existence checks don't stat the disk.
+
+    - Each table keeps at most `max_per_table` filenames, the least recently used are dropped first.
+    - A filename missing from the index isn't known to be missing from disk, callers check the disk then `add()` it.
+    - Files deleted from disk by other tools stay in the index until they're evicted, or the index file is removed.
+
+    Tables are created empty on first use, see `MediaFP.warm_media_index()`.
+
+    It also maps API md5s to a saved file's path, relative to the media directory, for layouts that save
+    the same file under several paths, see `MediaFP.link_saved_duplicate()`. At most `max_md5s` are kept.
+    """
+    def __init__(self, max_per_table: int, filepath: str | None=None, max_md5s: int=0):
+        self.max_per_table = max_per_table
+        self.filepath = filepath
+        self.lock = threading.RLock()
+        self.table_2_filenames: dict[tuple[str, MediaType], OrderedDict[str, None]] = dict()
+
+        self.max_md5s = max_md5s
+        self.md5_2_relpath: OrderedDict[str, str] = OrderedDict()
+
+
+    def get_filenames(self, board: str, media_type: MediaType) -> OrderedDict[str, None] | None:
+        return self.table_2_filenames.get((board, media_type))
+
+
+    def create_table(self, board: str, media_type: MediaType) -> bool:
+        """Returns `False` if the table already exists."""
+        with self.lock:
+            if (board, media_type) in self.table_2_filenames:
+                return False
+            self.table_2_filenames[(board, media_type)] = OrderedDict()
+            return True
+
+
+    def has(self, board: str, media_type: MediaType, filename: str) -> bool:
+        with self.lock:
+            filenames = self.get_filenames(board, media_type)
+            if filenames is None or filename not in filenames:
+                return False
+            filenames.move_to_end(filename)
+            return True
+
+
+    def add(self, board: str, media_type: MediaType, filename: str):
+        with self.lock:
+            filenames = self.table_2_filenames.setdefault((board, media_type), OrderedDict())
+            filenames[filename] = None
+            filenames.move_to_end(filename)
+
+            while len(filenames) > self.max_per_table:
+                filenames.popitem(last=False)
+
+
+    def add_many(self, board: str, media_type: MediaType, filenames: Iterable[str]) -> int:
+        """Adds filenames until the table is full, e.g. when warming. Returns how many were added."""
+        with self.lock:
+            table = self.table_2_filenames.setdefault((board, media_type), OrderedDict())
+            count = 0
+            for filename in filenames:
+                if len(table) >= self.max_per_table:
+                    break
+                if filename not in table:
+                    table[filename] = None
+                    count += 1
+            return count
+
+
+    def discard(self, board: str, media_type: MediaType, filename: str):
+        with self.lock:
+            filenames = self.get_filenames(board, media_type)
+            if filenames is not None:
+                filenames.pop(filename, None)
+
+
+    def get_relpath(self, md5: str) -> str | None:
+        with self.lock:
+            relpath = self.md5_2_relpath.get(md5)
+            if relpath is not None:
+                self.md5_2_relpath.move_to_end(md5)
+            return relpath
+
+
+    def add_md5(self, md5: str, relpath: str):
+        if not self.max_md5s:
+            return
+
+        with self.lock:
+            self.md5_2_relpath[md5] = relpath
+            self.md5_2_relpath.move_to_end(md5)
+
+            while len(self.md5_2_relpath) > self.max_md5s:
+                self.md5_2_relpath.popitem(last=False)
+
+
+    def add_md5s(self, md5_relpath_pairs: Iterable[tuple[str, str]]) -> int:
+        """Adds md5s that aren't known yet, the least recently used are dropped once it's full. Returns how many were added."""
+        if not self.max_md5s:
+            return 0
+
+        with self.lock:
+            count = 0
+            for md5, relpath in md5_relpath_pairs:
+                if md5 in self.md5_2_relpath:
+                    continue
+
+                self.md5_2_relpath[md5] = relpath
+                count += 1
+
+                while len(self.md5_2_relpath) > self.max_md5s:
+                    self.md5_2_relpath.popitem(last=False)
+            return count
+
+
+    def discard_md5(self, md5: str):
+        with self.lock:
+            self.md5_2_relpath.pop(md5, None)
+
+
+    def load(self):
+        if not self.filepath:
+            return
+
+        data = read_json(self.filepath)
+        if not data:
+            return
+
+        with self.lock:
+            for table in data['tables']:
+                self.table_2_filenames[(table['board'], MediaType(table['media_type']))] = OrderedDict.fromkeys(table['filenames'][-self.max_per_table:])
+
+            if self.max_md5s:
+                self.md5_2_relpath = OrderedDict(data.get('md5_2_relpath', [])[-self.max_md5s:])
+
+
+    def save(self):
+        if not self.filepath:
+            return
+
+        with self.lock:
+            # least recently used first, like the tables
+            tables = [
+                dict(board=board, media_type=media_type.value, filenames=list(filenames))
+                for (board, media_type), filenames in self.table_2_filenames.items()
+            ]
+            md5_2_relpath = list(self.md5_2_relpath.items())
+        write_json_obj_to_file(self.filepath, dict(tables=tables, md5_2_relpath=md5_2_relpath))
@@ -0,0 +1,154 @@
+import queue
+import threading
+import time
+import traceback
+from collections import deque
+from typing import Callable, Hashable
+
+import configs
+
+
+class MediaQueue:
+    """
+    Runs media downloads on `workers` threads, apart from the board loop, so `process_board()` can queue
+    a board's media and move on to the next board. Downloads still wait on the fetcher's per-host rate limits.
+
+    - The queue holds up to `maxsize` downloads. When it's full, `submit()` blocks until a worker frees a slot.
+    - A download already queued or running, e.g. the same file wanted by two boards, isn't queued again.
+    - With `workers=0`, downloads run in `submit()`, one after another.
+    """
+    # seconds of downloads counted towards bytes/sec
+    rate_window_s = 60.0
+
+    def __init__(self, workers: int, maxsize: int):
+        self.workers = workers
+        self.queue: queue.Queue = queue.Queue(maxsize=maxsize)
+
+        self.lock = threading.Lock()
+        self.keys_pending: set[Hashable] = set()
+        self.in_flight_count = 0
+        self.done_count = 0
+        self.error_count = 0
+
+        # (monotonic time, bytes) of recent downloads
+        self.downloads: deque[tuple[float, int]] = deque()
+
+        self.threads = [
+            threading.Thread(target=self.work, name=f'media_{i}', daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+
+    def submit(self, key: Hashable, fn: Callable, *args) -> bool:
+        """Returns `False` if `key` is already queued or running."""
+        with self.lock:
+            if key in self.keys_pending:
+                return False
+            self.keys_pending.add(key)
+
+        if not self.workers:
+            self.run(key, fn, args)
+            return True
+
+        self.queue.put((key, fn, args))
+        return True
+
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self.run(*item)
+            finally:
+                self.queue.task_done()
+
+
+    def run(self, key: Hashable, fn: Callable, args: tuple):
+        with self.lock:
+            self.in_flight_count += 1
+
+        try:
+            fn(*args)
+            with self.lock:
+                self.done_count += 1
+        except Exception as e:
+            # one failed download shouldn't stop the worker
+            with self.lock:
+                self.error_count += 1
+            configs.logger.error(f'Media download failed {args}: {e}')
+            configs.logger.error(traceback.format_exc())
+        finally:
+            with self.lock:
+                self.in_flight_count -= 1
+                self.keys_pending.discard(key)
+
+
+    def record_download(self, nbytes: int):
+        now = time.monotonic()
+        with self.lock:
+            self.downloads.append((now, nbytes))
+            self.drop_old_downloads(now)
+
+
+    def drop_old_downloads(self, now: float):
+        while self.downloads and self.downloads[0][0] < now - self.rate_window_s:
+            self.downloads.popleft()
+
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            self.drop_old_downloads(time.monotonic())
+            return dict(
+                queue_depth=self.queue.qsize(),
+                in_flight=self.in_flight_count,
+                done=self.done_count,
+                errors=self.error_count,
+                bytes_per_sec=sum(nbytes for _, nbytes in self.downloads) / self.rate_window_s,
+            )
+
+
+    def log_stats(self):
+        stats = self.get_stats()
+        configs.logger.info(
+            f'Media downloads: {stats["queue_depth"]} queued, {stats["in_flight"]} in flight, '
+            f'{stats["done"]} done, {stats["errors"]} failed, {stats["bytes_per_sec"] / 1024:.1f} KiB/s'
+        )
+
+
+    def join(self):
+        """Waits for every queued download."""
+        if self.workers:
+            self.queue.join()
+
+
+    def shutdown(self, cancel_queued: bool=True) -> int:
+        """
+        Stops the workers once their current download is done. Queued downloads are dropped, or run first.
+        Returns the number of dropped downloads.
+        """
+        dropped_count = 0
+        if cancel_queued:
+            while True:
+                try:
+                    key, _, _ = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                with self.lock:
+                    self.keys_pending.discard(key)
+                self.queue.task_done()
+                dropped_count += 1
+
+        if dropped_count:
+            configs.logger.info(f'Dropping {dropped_count} queued download(s)')
+
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        self.workers = 0
+        return dropped_count
@@ -9,8 +9,9 @@ from catalog import Catalog
 from db.ritual import RitualDb
 from enums import DeletionType
 from fetcher import Fetcher
+from scheduler import ThreadScheduler
 from state import State
-from utils import ChanPost
+from utils import ChanPost, thread_decoder
 
 
 class Posts:
@@ -23,17 +24,24 @@ class Posts:
         self.catalog = catalog
         self.tid_2_posts: dict[int, list[dict]] = dict()
         self.pid_2_post: dict[int, dict] = dict()
+        self.tids_deferred: list[int] = []
+
+        # polling stats, see scheduler.BoardScheduler
+        self.new_post_count: int = 0
+        self.missing_thread_count: int = 0
 
 
     def validate_posts(self, posts: list[dict]):
         for post in posts:
-            msgspec.convert(post, ChanPost)
+            # decoded posts were validated by the decoder
+            if not isinstance(post, ChanPost):
+                msgspec.convert(post, ChanPost)
 
 
     def fetch_posts(self, archive: Archive):
         '''
         - detects threads missing from catalog (deleted, pruned, or archived)
-        - fetches posts from api
+        - fetches posts from api, concurrently for threads the catalog can't update
         - validates posts from api
         - marks deleted posts as deleted in the database
         - uses catalog-based incremental updates when possible
@@ -70,7 +78,10 @@ class Posts:
 
         if missing_tids:
             configs.logger.info(f'[{self.board}] {len(missing_tids)} thread(s) no longer in catalog')
+        self.missing_thread_count = len(missing_tids)
 
+        # catalog updates first, so only the remaining threads hit the network
+        tids_to_fetch = []
         for tid in self.tid_2_thread:
             thread_data = self.tid_2_thread[tid]
             thread_stats = self.state.get_thread_stats(self.board, tid)
@@ -90,6 +101,7 @@ class Posts:
                     for post in posts_to_add:
                         if post['no'] not in existing_pids:
                             self.tid_2_posts[tid].append(post)
+                            self.new_post_count += 1
 
                     if self.tid_2_posts[tid]:
                         most_recent_reply_no = max(p['no'] for p in self.tid_2_posts[tid])
@@ -105,13 +117,17 @@ class Posts:
                     self.save_thread_stats(tid)
                     continue
 
-            url = configs.url_thread.format(board=self.board, thread_id=tid)
-            thread = self.fetcher.fetch_json(
-                url,
-                headers=configs.headers,
-                request_cooldown_sec=configs.request_cooldown_sec,
-                add_random=configs.add_random,
-            )
+            tids_to_fetch.append(tid)
+
+        # threads likely to lose posts go first, the rest may wait for the next loop
+        scheduler = ThreadScheduler(self.board, self.state, self.catalog)
+        tids_to_fetch, self.tids_deferred = scheduler.schedule(tids_to_fetch, self.tid_2_thread)
+
+        tid_2_fetched_thread = self.fetch_threads(tids_to_fetch)
+
+        # merged in scheduled order, regardless of which fetch finished first
+        for tid in tids_to_fetch:
+            thread = tid_2_fetched_thread.get(tid)
 
             if not thread:
                 # we already log the issue in the fetch_json() call
@@ -120,19 +136,18 @@ class Posts:
             full_fetch_count += 1
             configs.logger.info(f'[{self.board}] Found thread [{tid}]')
 
-            self.validate_posts(thread['posts'])
-
             pids_found = {post['no'] for post in thread['posts']}
             pids_all = tid_2_existing_pids.get(tid, set())
-            pids_deleted = []
-            for pid in pids_all:
-                if pid not in pids_found:
-                    pids_deleted.append(pid)
+            self.new_post_count += len(pids_found - pids_all)
+            pids_deleted_in_thread = [pid for pid in pids_all if pid not in pids_found]
 
-            if pids_deleted: configs.logger.info(f'[{self.board}] [{tid}] Posts deleted: {pids_deleted}')
+            if pids_deleted_in_thread:
+                configs.logger.info(f'[{self.board}] [{tid}] Posts deleted: {pids_deleted_in_thread}')
+                pids_deleted.extend(pids_deleted_in_thread)
 
             self.tid_2_posts[tid] = thread['posts']
 
+            thread_data = self.tid_2_thread[tid]
             most_recent_reply_no = max((post['no'] for post in thread['posts']), default=None)
             self.state.set_thread_stats(
                 self.board, tid,
@@ -162,6 +177,28 @@ class Posts:
 
         self.set_pid_2_post()
 
+    def fetch_threads(self, tids: list[int]) -> dict[int, dict]:
+        """
+        Fetches threads concurrently, see `Fetcher.fetch_json_many()`.
+        Posts are decoded and validated on the fetch workers.
+        """
+        url_2_tid = {configs.url_thread.format(board=self.board, thread_id=tid): tid for tid in tids}
+
+        url_2_thread = self.fetcher.fetch_json_many(
+            list(url_2_tid),
+            headers=configs.headers,
+            add_random=configs.add_random,
+            transform=self.validate_thread,
+            decoder=thread_decoder,
+            board=self.board,
+        )
+
+        return {url_2_tid[url]: thread for url, thread in url_2_thread.items()}
+
+    def validate_thread(self, url: str, thread: dict) -> dict:
+        self.validate_posts(thread['posts'])
+        return thread
+
     def classify_missing_thread(self, tid: int, archive: Archive) -> DeletionType:
         """
         A 404'd thread could be deleted if all three of these are true:
@@ -250,7 +287,8 @@ class Posts:
         posts_to_add = []
         for reply in new_replies:
             try:
-                msgspec.convert(reply, ChanPost)
+                if not isinstance(reply, ChanPost):
+                    msgspec.convert(reply, ChanPost)
                 posts_to_add.append(reply)
             except msgspec.ValidationError as e:
                 configs.logger.warning(f'[{self.board}] Invalid post in catalog update for thread [{tid}]: {e}')
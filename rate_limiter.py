@@ -0,0 +1,77 @@
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        """
+        - rate: tokens added per second, i.e. the sustained requests per second
+        - burst: max tokens held, i.e. requests that can be made back-to-back after being idle
+        """
+        if rate <= 0 or burst <= 0:
+            raise ValueError(rate, burst)
+
+        self.rate = rate
+        self.burst = burst
+        self.tokens: float = burst
+        self.updated_at: float = time.monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def reserve(self, tokens: float=1.0) -> float:
+        """
+        Takes `tokens` from the bucket, going into debt if there are not enough.
+        Returns the seconds to wait before the request can be made.
+        Debt is paid back in order, so concurrent callers are served first come, first served.
+        """
+        self.refill(time.monotonic())
+        self.tokens -= tokens
+
+        if self.tokens >= 0:
+            return 0.0
+
+        return -self.tokens / self.rate
+
+
+class RateLimiter:
+    def __init__(self, host_2_limit: dict[str, dict], default_limit: dict | None=None):
+        """
+        - host_2_limit: {'a.4cdn.org': {'rate': 0.8, 'burst': 3}, ...}
+        - default_limit: used for hosts not in `host_2_limit`, `None` means unlimited
+        """
+        self.host_2_limit = host_2_limit or dict()
+        self.default_limit = default_limit
+        self.host_2_bucket: dict[str, TokenBucket] = dict()
+        self.lock = threading.Lock()
+
+    def get_bucket(self, host: str) -> TokenBucket | None:
+        if host in self.host_2_bucket:
+            return self.host_2_bucket[host]
+
+        limit = self.host_2_limit.get(host, self.default_limit)
+        if not limit:
+            return None
+
+        bucket = TokenBucket(limit['rate'], limit['burst'])
+        self.host_2_bucket[host] = bucket
+        return bucket
+
+    def acquire(self, url: str, tokens: float=1.0, add_random: bool=False) -> float:
+        """Blocks until the url's host has budget for the request. Returns the seconds waited."""
+        host = urlsplit(url).netloc
+
+        with self.lock:
+            bucket = self.get_bucket(host)
+            wait = bucket.reserve(tokens) if bucket else 0.0
+
+        if add_random:
+            wait += random.uniform(0.0, 1.0)
+
+        if wait > 0:
+            time.sleep(wait)
+
+        return wait
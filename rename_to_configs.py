@@ -2,16 +2,85 @@ import os
 
 from utils import make_path, setup_logger
 
-request_cooldown_sec = 1.2
+request_cooldown_sec = 1.2 # seconds per api request (catalog, thread, archive), on average
 loop_cooldown_sec = 30.0
-video_cooldown_sec = 3.2
-image_cooldown_sec = 2.2
+video_cooldown_sec = 3.2 # seconds per video download, on average
+image_cooldown_sec = 2.2 # seconds per image download, on average
 add_random = False # add random sleep intervals
 
+
+## Rate Limits ##
+# Every request waits on a token bucket for its host, shared by board workers and media downloads.
+# The time a request takes counts towards its cooldown, so slow downloads don't sleep a full cooldown afterwards.
+# - rate: sustained requests per second
+# - burst: requests that can be made back-to-back after being idle
+# Videos take (video_cooldown_sec / image_cooldown_sec) tokens from the media host's bucket.
+rate_limits = {
+    'a.4cdn.org': {'rate': 1 / request_cooldown_sec, 'burst': 3},
+    'i.4cdn.org': {'rate': 1 / image_cooldown_sec, 'burst': 3},
+}
+rate_limit_default = {'rate': 1 / request_cooldown_sec, 'burst': 1} # other hosts e.g. lainchan, None for unlimited
+
 ignore_thread_cache = True # on restarts, ignore thread cache and go through all threads
 ignore_http_cache = False # always ignore http cache and go through all threads (used for testing)
 
 
+## State ##
+# Thread cache, http cache, thread stats, and thread meta are saved between runs.
+# - 'json': every save rewrites ./cache/*.json in full
+# - 'sqlite': ./cache/state.db, saves only write what changed, one transaction per board
+# Switching from 'json' to 'sqlite' carries the JSON caches over on the first run.
+state_backend = 'json'
+# Saves a board's state once its posts are committed, so a crash only redoes the board it happened on.
+# With 'json', only when no other board has unsaved changes, e.g. concurrent_boards = False, otherwise it's saved once per loop.
+state_checkpoint_each_board = True
+state_max_threads_per_board = 3000 # threads kept per board in each cache, the oldest are evicted first
+
+
+## Concurrency ##
+# Process boards concurrently, each board on its own worker thread.
+# Requests from all workers share the same rate limits per host, so the API sees the same request rate.
+# This helps when a few slow boards (big catalogs, many modified threads) hold up the rest.
+concurrent_boards = False
+board_workers = 4
+
+
+## HTTP ##
+# Connections are pooled per host, and kept alive across loops.
+http_pool_size = 8 # max open connections per host
+http_keep_alive_sec = 120.0 # connections are dropped if loop_cooldown_sec is at least this long
+fetch_workers = 4 # concurrent thread fetches per board, still within the rate limits
+
+# Media downloads run on their own workers, so boards don't wait on them. Downloads still respect the media host's rate limit.
+# Boards wait to queue more downloads only once media_queue_size are queued. Set media_workers = 0 to download in the board loop.
+media_workers = 2
+media_queue_size = 2000
+
+# Saved media filenames are kept in memory, per board, so most "is it already saved?" checks don't touch the disk.
+# A file missing from the index is still checked on disk. Sutra's media is indexed as one board.
+media_index_max_per_board = 100_000 # filenames per board and media type, the least recently used are dropped first
+media_index_path = make_path('cache', 'media_index.json') # saved on shutdown, and loaded on startup. None to not save it.
+media_index_warm = 'directory' # fills a board's index on first use, 'directory' (a listing of its media directory), 'scanner_db' (full media only) or None
+
+
+## Thread Scheduling ##
+# Modified threads are fetched in order of risk of losing posts, see scheduler.ThreadScheduler.
+thread_priority_last_pages = 2 # threads on the last N catalog pages are at risk of being pruned
+thread_priority_lookahead_min = 10 # threads predicted to hit the bump limit within N minutes are at risk
+thread_bump_limit = 300 # most boards use 300, some use more
+thread_fetch_budget = None # max thread fetches per board per loop, extra threads wait for the next loop. None for no limit.
+
+
+## Adaptive Polling ##
+# Instead of polling every board and then sleeping loop_cooldown_sec, each board is polled when it's due.
+# A board's poll interval adapts to how many new posts its last polls found, and how many threads left its catalog.
+# Quiet boards get polled less often, fast boards more often.
+adaptive_polling = False
+board_poll_min_sec = 30.0
+board_poll_max_sec = 600.0
+board_poll_target_new_posts = 50 # aim for about this many new posts per poll
+
+
 ## "enforce" results in not saving a file to disk
 
 # Do you want to enforce (downloaded file md5) == (API reported md5) ?
@@ -44,8 +113,8 @@ media_save_path = make_path('media')
 # Saves media to filepaths like,
 # - full media: `<media_save_path>/<board>/image/tim[:4]/tim[4:6]/tim<ext>`
 # - thumbnail:  `<media_save_path>/<board>/thumb/tim[:4]/tim[4:6]/tim<s.jpg>`
-# This is legacy and does not avoid duplicate files being downloaded and saved
-# Duplicate files can be replace with hardlinks or softlinks with the tool https://github.com/pkolaczk/fclones
+# This is legacy and does not avoid duplicate files being downloaded and saved, unless asagi_link_duplicates is on
+# Existing duplicate files can be replace with hardlinks or softlinks with the tool https://github.com/pkolaczk/fclones
 #   For ****example****,
 #     1. mkdir fcc
 #     2. fclones group ./media --cache ./fcc > dupes.txt
@@ -53,6 +122,12 @@ media_save_path = make_path('media')
 
 media_fp = 'asagi' # 'asagi' or 'sutra'
 
+# Before downloading full media, look for a saved file with the same API md5, e.g. on another board, and hardlink it
+# to the Asagi path instead. Falls back to downloading when it can't link, e.g. media_save_path spans filesystems.
+# md5s are read from each board's <board>_images table on first use, and kept in the media index.
+asagi_link_duplicates = False
+media_index_max_md5s = 500_000 # md5s kept in memory, the least recently used are dropped first
+
 
 
 ## Scanner DB ##
@@ -71,10 +146,27 @@ save_directories_in_db = False
 db_type = 'sqlite' # 'sqlite' or 'mysql'
 db_echo = False
 
+# Threads with an OP posted in the last N seconds are kept in memory per board, and are looked up without querying the board table.
+# The catalog only holds threads that were active in about the last hour. Older threads are read from the database when needed.
+thread_index_warm_since_sec = 60 * 60
+
 
 # must have db_type = 'sqlite'
 db_sqlite_path = make_path('ritual.db') # sqlite
 
+# Applied to each new connection. Set to {} to use SQLite's defaults.
+# - wal lets readers (e.g. a web frontend) read while we write, and with synchronous=normal, commits don't wait on fsync
+# - mmap_size (bytes) and cache_size (negative is KiB) keep more of a large archive in memory
+# - busy_timeout (ms) waits for other processes' locks instead of failing with "database is locked"
+db_sqlite_pragmas = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'mmap_size': 1024 ** 3,
+    'cache_size': -64 * 1024,
+    'temp_store': 'memory',
+    'busy_timeout': 5000,
+}
+
 
 # must have db_type = 'mysql'
 db_mysql_host = 'localhost'
@@ -83,6 +175,16 @@ db_mysql_password = 'password'
 db_mysql_database = 'ritual'
 db_mysql_port = 3306
 
+# Connections are shared by boards processed concurrently, see `board_workers`. The pool can't be larger than 32.
+db_mysql_pool_size = 8
+
+# Rows per multi-row `insert ... on duplicate key update` statement
+db_mysql_batch_size = 500
+
+# Commits a board's writes every N statements, rather than all at once. Each commit releases row locks,
+# so keep this low if the database is shared with a web frontend. Set to None to write each board in one transaction.
+db_mysql_statements_per_transaction = 1
+
 
 headers = None
 # headers = {'User-Agent', ''}
@@ -126,6 +228,14 @@ logger = setup_logger(logger_name, log_file=log_file, stdout=True, file_rotate_s
 # and thumbnails will only be created for full media that is downloaded
 make_thumbnails = False
 
+# Thumbnails are made in the background, by ffmpeg/convert processes. Saving media never waits on them.
+# Past thumbnail_max_pending, thumbnails wait in a backlog. Once it's full, the oldest are dropped, see migrations/create_thumbs.py.
+thumbnail_workers = 2 # concurrent ffmpeg/convert processes, 0 to make thumbnails as media is saved
+thumbnail_max_pending = thumbnail_workers * 3
+thumbnail_backlog_size = 10_000
+thumbnail_max_attempts = 3
+thumbnail_retry_delay_sec = 30 # doubles after each failed attempt
+
 # ARCHIVE RULES - What to archive.
 
 # - `op_comment_min_chars` and `op_comment_min_chars_unique` filter everything first.
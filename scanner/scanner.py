@@ -2,6 +2,7 @@ import os
 from itertools import batched
 from functools import lru_cache
 import sqlite3
+import threading
 import time
 import argparse
 
@@ -23,10 +24,13 @@ class SqliteDb:
     def __init__(self, db_path: str):
         self.db_path = db_path
         self.conn: sqlite3.Connection | None = None
+        self.lock = threading.RLock()
 
     def connect(self):
-        if self.conn is None:
-            self.conn = sqlite3.connect(self.db_path)
+        with self.lock:
+            if self.conn is None:
+                # Ritual may insert from several board workers
+                self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
 
     def close(self):
         self.conn.commit()
@@ -89,15 +93,35 @@ class ScannerDb(SqliteDb):
         self.connect()
         sql_insert_hashtab = f'insert or ignore into hashtab (dir_id, filename_no_ext, ext_id, datetime_utc) values (?,?,?,{int(time.time())});'
 
-        dir_id = 0
-        if save_directories_in_db:
-            dir_id = self.get_dir_id(dirname)
+        with self.lock:
+            dir_id = 0
+            if save_directories_in_db:
+                dir_id = self.get_dir_id(dirname)
 
-        filename_no_ext, ext = filename.rsplit('.', maxsplit=1)
-        ext_id = self.get_ext_id(ext)
+            filename_no_ext, ext = filename.rsplit('.', maxsplit=1)
+            ext_id = self.get_ext_id(ext)
 
-        self.conn.execute(sql_insert_hashtab, (dir_id, filename_no_ext, ext_id))
-        self.conn.commit()
+            self.conn.execute(sql_insert_hashtab, (dir_id, filename_no_ext, ext_id))
+            self.conn.commit()
+
+
+    def iter_filenames(self, dirpath_prefix: str | None=None, batch_size: int=5_000):
+        '''
+        Yields `<filename_no_ext>.<ext>` from hashtab.
+        - dirpath_prefix needs save_directories_in_db, rows without a directory are skipped
+        '''
+        self.connect()
+        sql = 'select filename_no_ext, ext from hashtab join extension using (ext_id)'
+        params = ()
+        if dirpath_prefix:
+            sql += ' join directory using (dir_id) where dirpath = ? or dirpath like ?'
+            params = (dirpath_prefix, f'{dirpath_prefix}{os.sep}%')
+
+        with self.lock:
+            cursor = self.conn.execute(sql, params)
+            while rows := cursor.fetchmany(batch_size):
+                for filename_no_ext, ext in rows:
+                    yield f'{filename_no_ext}.{ext}'
 
 
     # don't expect many cache hits, keep low
@@ -0,0 +1,151 @@
+import time
+
+import configs
+from catalog import Catalog
+from state import State
+
+
+class ThreadScheduler:
+    """
+    Orders thread fetches so threads likely to lose posts are fetched first.
+
+    A thread is at risk when,
+    - it's on the last pages of the catalog, and will soon be pruned
+    - it hit the bump limit, and is sinking
+    - at its post rate, it will hit the bump limit within `configs.thread_priority_lookahead_min`
+
+    At risk threads are fetched first, those closest to being pruned leading.
+    The rest are ordered by unseen replies, then by post rate.
+    With a `configs.thread_fetch_budget`, threads past the budget are deferred to the next loop,
+    but at risk threads are never deferred.
+    """
+    def __init__(self, board: str, state: State, catalog: Catalog):
+        self.board = board
+        self.state = state
+        self.catalog = catalog
+        self.last_page = max(catalog.tid_2_page.values(), default=0)
+        self.now = time.time()
+
+    def get_posts_per_hour(self, thread: dict) -> float:
+        """Average post rate over the thread's life."""
+        op_time = thread.get('time')
+        if not op_time:
+            return 0.0
+
+        hours = max((self.now - op_time) / 3600, 1 / 60)
+        return (thread.get('replies', 0) + 1) / hours
+
+    def get_unseen_replies(self, tid: int, thread: dict) -> int:
+        thread_stats = self.state.get_thread_stats(self.board, tid)
+        if not thread_stats:
+            return thread.get('replies', 0) + 1
+        return max(thread.get('replies', 0) - thread_stats.get('replies', 0), 0)
+
+    def is_at_risk(self, tid: int, thread: dict, posts_per_hour: float) -> bool:
+        page = self.catalog.tid_2_page.get(tid)
+        if page and self.last_page and page > self.last_page - configs.thread_priority_last_pages:
+            return True
+
+        if thread.get('bumplimit'):
+            return True
+
+        replies_left = configs.thread_bump_limit - thread.get('replies', 0)
+        return posts_per_hour * configs.thread_priority_lookahead_min / 60 >= replies_left
+
+    def get_priority(self, tid: int, thread: dict) -> tuple:
+        """Sort key, lower is fetched first."""
+        posts_per_hour = self.get_posts_per_hour(thread)
+        at_risk = self.is_at_risk(tid, thread, posts_per_hour)
+        page = self.catalog.tid_2_page.get(tid) or 0
+
+        if at_risk:
+            return (0, -page, -posts_per_hour)
+
+        return (1, -self.get_unseen_replies(tid, thread), -posts_per_hour)
+
+    def schedule(self, tids: list[int], tid_2_thread: dict[int, dict]) -> tuple[list[int], list[int]]:
+        """
+        Returns `(tids_to_fetch, tids_deferred)`, with `tids_to_fetch` in fetch order.
+        Deferred threads are dropped from the thread cache, so the next loop sees them as modified.
+        """
+        tid_2_priority = {tid: self.get_priority(tid, tid_2_thread[tid]) for tid in tids}
+        tids_ordered = sorted(tids, key=tid_2_priority.__getitem__)
+
+        budget = configs.thread_fetch_budget
+        if budget is None or len(tids_ordered) <= budget:
+            return tids_ordered, []
+
+        tids_to_fetch = []
+        tids_deferred = []
+        for tid in tids_ordered:
+            if len(tids_to_fetch) < budget or tid_2_priority[tid][0] == 0:
+                tids_to_fetch.append(tid)
+            else:
+                tids_deferred.append(tid)
+
+        for tid in tids_deferred:
+            self.state.remove_thread_cache(self.board, tid)
+
+        configs.logger.info(f'[{self.board}] Deferred {len(tids_deferred)} thread(s) to the next loop')
+        return tids_to_fetch, tids_deferred
+
+
+class BoardScheduler:
+    """
+    Polls each board on its own interval, instead of polling every board then sleeping `configs.loop_cooldown_sec`.
+
+    After each poll, a board's interval moves towards the interval that would have found
+    `configs.board_poll_target_new_posts` new posts, and shrinks further when threads left the catalog between polls.
+    Intervals stay within `configs.board_poll_min_sec` and `configs.board_poll_max_sec`.
+    """
+    def __init__(self, boards: list[str]):
+        now = time.time()
+        self.board_2_interval: dict[str, float] = {board: configs.board_poll_min_sec for board in boards}
+        self.board_2_due_time: dict[str, float] = {board: now for board in boards}
+        self.board_2_polled_at: dict[str, float] = dict()
+
+    def get_due_boards(self) -> list[str]:
+        """boards due for a poll, most overdue first."""
+        now = time.time()
+        due_boards = [board for board, due_time in self.board_2_due_time.items() if due_time <= now]
+        return sorted(due_boards, key=self.board_2_due_time.__getitem__)
+
+    def get_next_interval(self, board: str, elapsed: float, new_post_count: int, missing_thread_count: int) -> float:
+        interval = self.board_2_interval[board]
+
+        target_interval = elapsed * configs.board_poll_target_new_posts / max(new_post_count, 1)
+
+        # threads are falling off the catalog between polls, so check back sooner
+        target_interval /= 1 + missing_thread_count
+
+        # smoothed, so one quiet or busy poll doesn't swing the interval to the bounds
+        interval = (interval + target_interval) / 2
+        return min(max(interval, configs.board_poll_min_sec), configs.board_poll_max_sec)
+
+    def update(self, board: str, new_post_count: int | None, missing_thread_count: int | None):
+        """`None` counts mean the poll failed, so the interval is kept."""
+        now = time.time()
+
+        if new_post_count is not None:
+            polled_at = self.board_2_polled_at.get(board)
+            elapsed = now - polled_at if polled_at else self.board_2_interval[board]
+            self.board_2_interval[board] = self.get_next_interval(board, elapsed, new_post_count, missing_thread_count or 0)
+            self.board_2_polled_at[board] = now
+
+        self.board_2_due_time[board] = now + self.board_2_interval[board]
+
+    def log_intervals(self):
+        s = 'Poll interval for each board:\n'
+        for board, interval in self.board_2_interval.items():
+            s += f'    - {board:<4} {interval:.0f}s\n'
+        configs.logger.info(s)
+
+    def get_sleep_sec(self) -> float:
+        """seconds until the next board is due."""
+        return max(min(self.board_2_due_time.values()) - time.time(), 0.0)
+
+    def sleep(self):
+        """sleeps until the next board is due."""
+        sleep_for = self.get_sleep_sec()
+        configs.logger.info(f'Sleeping {sleep_for:.1f}s until the next board is due\n')
+        time.sleep(sleep_for)
@@ -1,10 +1,26 @@
+import threading
 import traceback
+from functools import partial
 
 import configs
 from loop import Loop
+from state_store import SqliteStateStore
+from state_tables import BoundedTable, ThreadStats
 from utils import make_path, read_json, write_json_obj_to_file
 
 
+def get_last_modified_rank(last_modified: float | None) -> float:
+    return last_modified or 0.0
+
+
+def get_thread_stats_rank(stats: ThreadStats) -> int:
+    return stats.get('most_recent_reply_no', 0)
+
+
+def get_thread_meta_rank(meta: list | None) -> int:
+    return meta[1] if meta and len(meta) > 1 else 0
+
+
 class State:
     def __init__(self, loop: Loop):
         """
@@ -12,47 +28,213 @@ class State:
 
         - thread_cache: Maps board -> thread_id -> last_modified timestamp from catalog JSON.
         - http_cache: Maps URL -> HTTP Last-Modified header string for conditional requests.
-        - thread_stats: Maps board -> thread_id -> stats dict (replies, images, most_recent_reply_no).
+        - thread_stats: Maps board -> thread_id -> `ThreadStats` (replies, images, most_recent_reply_no).
         - thread_meta: Maps board -> thread_id -> (page, bump_time) for deletion detection.
+
+        Each board's thread_cache, thread_stats, and thread_meta is a `BoundedTable` of up to
+        `configs.state_max_threads_per_board` threads, which evicts the oldest threads first.
+
+        Changes are tracked, so saves skip unchanged caches.
+        With `configs.state_backend = 'sqlite'`, caches are kept in `cache/state.db` instead of JSON files,
+        and saves only write the entries changed since the last save.
         """
         self.thread_cache_filepath = make_path('cache', 'thread_cache.json')
-        self.thread_cache: dict[str, dict[int, float]] = dict()
+        self.thread_cache: dict[str, BoundedTable] = dict()
 
         self.http_cache_filepath = make_path('cache', 'http_cache.json')
         self.http_cache: dict[str, str] = dict()
 
         self.thread_stats_filepath = make_path('cache', 'thread_stats.json')
-        self.thread_stats: dict[str, dict[int, dict]] = dict()
+        self.thread_stats: dict[str, BoundedTable] = dict()
 
         self.thread_meta_filepath = make_path('cache', 'thread_meta.json')
-        self.thread_meta: dict[str, dict[int, list]] = dict()
+        self.thread_meta: dict[str, BoundedTable] = dict()
+
+        # entries changed since the last save, board -> tids (urls for http_cache, `None` for urls without a board)
+        self.dirty_thread_cache: dict[str, set[int]] = dict()
+        self.dirty_http_cache: dict[str | None, set[str]] = dict()
+        self.dirty_thread_stats: dict[str, set[int]] = dict()
+        self.dirty_thread_meta: dict[str, set[int]] = dict()
+
+        self.store = SqliteStateStore() if configs.state_backend == 'sqlite' else None
 
         self.loop = loop
 
+        # boards processed concurrently share this state
+        self.lock = threading.RLock()
+
         self.read()
 
     @property
     def ignore_last_modified(self) -> bool:
         return self.loop.is_first_loop and configs.ignore_thread_cache
 
+    def mark_dirty(self, board_2_dirty: dict[str, set[int]], board: str, tid: int):
+        if board not in board_2_dirty:
+            board_2_dirty[board] = set()
+        board_2_dirty[board].add(tid)
+
+    def get_board_table(self, board_2_table: dict, board_2_dirty: dict[str, set[int]], get_rank, board: str) -> BoundedTable:
+        """The board's table, created for new boards, and for boards read from disk, or set to a plain dict."""
+        table = board_2_table.get(board)
+        if not isinstance(table, BoundedTable):
+            on_evict = partial(self.mark_dirty, board_2_dirty, board)
+            table = board_2_table[board] = BoundedTable(configs.state_max_threads_per_board, get_rank, on_evict=on_evict, data=table)
+        return table
+
+    def get_thread_cache_table(self, board: str) -> BoundedTable:
+        return self.get_board_table(self.thread_cache, self.dirty_thread_cache, get_last_modified_rank, board)
+
+    def get_thread_stats_table(self, board: str) -> BoundedTable:
+        table = self.thread_stats.get(board)
+        if table is not None and not isinstance(table, BoundedTable):
+            self.thread_stats[board] = {tid: self.as_thread_stats(stats) for tid, stats in table.items()}
+        return self.get_board_table(self.thread_stats, self.dirty_thread_stats, get_thread_stats_rank, board)
+
+    def get_thread_meta_table(self, board: str) -> BoundedTable:
+        return self.get_board_table(self.thread_meta, self.dirty_thread_meta, get_thread_meta_rank, board)
+
+    def as_thread_stats(self, stats: dict | ThreadStats) -> ThreadStats:
+        return stats if isinstance(stats, ThreadStats) else ThreadStats(**stats)
+
+    def load_tables(self):
+        with self.lock:
+            for board in list(self.thread_cache):
+                self.get_thread_cache_table(board)
+            for board in list(self.thread_stats):
+                self.get_thread_stats_table(board)
+            for board in list(self.thread_meta):
+                self.get_thread_meta_table(board)
+
+    def mark_all_dirty(self):
+        for board, tid_2_last_modified in self.thread_cache.items():
+            self.dirty_thread_cache.setdefault(board, set()).update(tid_2_last_modified)
+        for board, tid_2_stats in self.thread_stats.items():
+            self.dirty_thread_stats.setdefault(board, set()).update(tid_2_stats)
+        for board, tid_2_meta in self.thread_meta.items():
+            self.dirty_thread_meta.setdefault(board, set()).update(tid_2_meta)
+        self.dirty_http_cache.setdefault(None, set()).update(self.http_cache)
+
     def save(self):
-        '''writes every cache'''
+        '''writes every changed cache, or with the sqlite backend, every changed entry'''
         try:
-            write_json_obj_to_file(self.thread_cache_filepath, self.thread_cache)
-            write_json_obj_to_file(self.http_cache_filepath, self.http_cache)
-            write_json_obj_to_file(self.thread_stats_filepath, self.thread_stats)
-            write_json_obj_to_file(self.thread_meta_filepath, self.thread_meta)
+            with self.lock:
+                if self.store:
+                    for board in self.get_dirty_boards():
+                        self.save_board_to_store(board)
+                    self.save_http_cache_to_store()
+                else:
+                    self.save_to_json()
         except Exception as e:
             configs.logger.error(f'Failed to save state: {e}')
             configs.logger.error(traceback.format_exc())
             raise e
 
+    def checkpoint(self, board: str):
+        """
+        Saves a board's changed entries once its posts are committed, so a crash only redoes the board in progress.
+        Other boards' entries aren't written, their posts may not be committed yet.
+
+        JSON files hold every board, so they're only written when no other board has unsaved changes,
+        e.g. when boards are processed one at a time. Otherwise, they're left to `save()`.
+        """
+        try:
+            with self.lock:
+                if self.store:
+                    self.save_board_to_store(board)
+                    self.save_http_cache_to_store(board)
+                elif not self.get_dirty_boards() - {board}:
+                    self.save_to_json()
+        except Exception as e:
+            # the next checkpoint or save retries, since changes stay dirty until written
+            configs.logger.error(f'[{board}] Failed to checkpoint state: {e}')
+
+    def get_dirty_boards(self) -> set[str]:
+        """Boards with unsaved entries. Urls without a board, e.g. evicted ones, aren't any board's."""
+        boards = set(self.dirty_thread_cache) | set(self.dirty_thread_stats) | set(self.dirty_thread_meta)
+        return boards | {board for board, urls in self.dirty_http_cache.items() if board and urls}
+
+    def discard_board_changes(self, board: str):
+        """
+        Forgets a board's unsaved thread_cache, thread_stats, and http_cache entries, e.g. when its posts weren't committed.
+        Its threads are seen as modified again, and fetched in full, rather than saved as seen.
+        """
+        with self.lock:
+            for tid in self.dirty_thread_cache.get(board, set()):
+                self.thread_cache.get(board, dict()).pop(tid, None)
+            for tid in self.dirty_thread_stats.get(board, set()):
+                self.thread_stats.get(board, dict()).pop(tid, None)
+            for url in self.dirty_http_cache.get(board, set()):
+                self.http_cache.pop(url, None)
+
+    def close(self):
+        if self.store:
+            self.store.close()
+
+    def save_to_json(self):
+        # files are replaced atomically, and only when their cache changed
+        if self.dirty_thread_cache:
+            write_json_obj_to_file(self.thread_cache_filepath, self.thread_cache)
+            self.dirty_thread_cache.clear()
+        if any(self.dirty_http_cache.values()):
+            write_json_obj_to_file(self.http_cache_filepath, self.http_cache)
+            self.dirty_http_cache.clear()
+        if self.dirty_thread_stats:
+            thread_stats = {
+                board: {tid: self.as_thread_stats(stats).to_dict() for tid, stats in tid_2_stats.items()}
+                for board, tid_2_stats in self.thread_stats.items()
+            }
+            write_json_obj_to_file(self.thread_stats_filepath, thread_stats)
+            self.dirty_thread_stats.clear()
+        if self.dirty_thread_meta:
+            write_json_obj_to_file(self.thread_meta_filepath, self.thread_meta)
+            self.dirty_thread_meta.clear()
+
+    def save_board_to_store(self, board: str):
+        if board not in self.dirty_thread_cache and board not in self.dirty_thread_stats and board not in self.dirty_thread_meta:
+            return
+
+        self.store.save_board(
+            board,
+            self.thread_cache.get(board, dict()),
+            self.thread_stats.get(board, dict()),
+            self.thread_meta.get(board, dict()),
+            self.dirty_thread_cache.get(board, set()),
+            self.dirty_thread_stats.get(board, set()),
+            self.dirty_thread_meta.get(board, set()),
+        )
+        # only forget what's committed, so a failed save is retried in full next time
+        self.dirty_thread_cache.pop(board, None)
+        self.dirty_thread_stats.pop(board, None)
+        self.dirty_thread_meta.pop(board, None)
+
+    def save_http_cache_to_store(self, board: str | None=None):
+        """Writes the board's changed urls, or every changed url when `board` isn't given."""
+        boards = [board] if board else list(self.dirty_http_cache)
+        for board in boards:
+            if urls := self.dirty_http_cache.get(board):
+                self.store.save_http_cache(self.http_cache, urls)
+                self.dirty_http_cache.pop(board, None)
+
     def read(self):
         '''reads in every cache'''
+        if self.store and not self.store.is_empty():
+            self.thread_cache = self.store.read_thread_cache()
+            self.http_cache = self.store.read_http_cache()
+            self.thread_stats = self.store.read_thread_stats()
+            self.thread_meta = self.store.read_thread_meta()
+            self.load_tables()
+            return
+
         self.thread_cache = self.get_cached_thread_cache()
         self.http_cache = read_json(self.http_cache_filepath) or dict()
         self.thread_stats = self.get_cached_thread_stats()
         self.thread_meta = self.get_cached_thread_meta()
+        self.load_tables()
+
+        if self.store:
+            # first run on the sqlite backend, carry over the JSON caches
+            self.mark_all_dirty()
 
     def get_cached_thread_cache(self) -> dict[str, dict[int, float]]:
         """{g: {123: 1717755968, 124: 1717755999}, ck: {456: 1717755968}, ...}"""
@@ -91,99 +273,97 @@ class State:
         }
 
     def prune_old_threads(self, board: str):
-        # Don't let the dict grow over N entries per board.
-        if board not in self.thread_cache:
-            return
-
-        N = 200
-        board_cache = self.thread_cache[board]
-        if (count := len(board_cache)) > N:
-            # In case of multiple stickies, or similar special threads, we delete the extras, plus M oldest threads
-            M = count - N + 10
-            tid_timestamp_pairs = [(tid, board_cache.get(tid) or 0.0) for tid in board_cache.keys()]
-            tid_timestamp_pairs.sort(key=self.get_timestamp_from_pair)
-            for stale_id, _ in tid_timestamp_pairs[:M]:
-                del board_cache[stale_id] # prune
+        """tables evict as they're set, this only applies a lowered cap, or tables that were replaced."""
+        with self.lock:
+            if board not in self.thread_cache:
+                return
 
-    def get_timestamp_from_pair(self, pair: tuple[int, float]) -> float:
-        return pair[1]
+            table = self.get_thread_cache_table(board)
+            table.maxlen = configs.state_max_threads_per_board
+            table.evict()
 
     def is_thread_modified_cache_update(self, board: str, thread: dict) -> bool:
         """
         `True` indicates we should download the thread.
         """
+        with self.lock:
+            tid = thread['no']
+            thread_last_modified = thread.get('last_modified')
 
-        tid = thread['no']
-        thread_last_modified = thread.get('last_modified')
+            board_cache = self.get_thread_cache_table(board)
 
-        if board not in self.thread_cache:
-            self.thread_cache[board] = dict()
+            # should come before entry pruning
+            thread_last_modified_cached = board_cache.get(tid)
 
-        # should come before entry pruning
-        thread_last_modified_cached = self.thread_cache[board].get(tid)
+            if tid not in board_cache or thread_last_modified != thread_last_modified_cached:
+                self.mark_dirty(self.dirty_thread_cache, board, tid)
 
-        # last_modified changed
-        if thread_last_modified and thread_last_modified_cached and thread_last_modified != thread_last_modified_cached:
-            # Update the thread's last modified time in thread_cache.
-            self.thread_cache[board][tid] = thread_last_modified
-            return True
+            # last_modified changed
+            if thread_last_modified and thread_last_modified_cached and thread_last_modified != thread_last_modified_cached:
+                # Update the thread's last modified time in thread_cache.
+                board_cache[tid] = thread_last_modified
+                return True
 
-        # new thread
-        if thread_last_modified_cached is None:
-            # Update the thread's last modified time in thread_cache.
-            self.thread_cache[board][tid] = thread_last_modified
-            return True
+            # new thread
+            if thread_last_modified_cached is None:
+                # Update the thread's last modified time in thread_cache.
+                board_cache[tid] = thread_last_modified
+                return True
 
-        # Update the thread's last modified time even if unchanged
-        self.thread_cache[board][tid] = thread_last_modified
+            # Update the thread's last modified time even if unchanged
+            board_cache[tid] = thread_last_modified
 
-        return False
+            return False
 
-    def get_thread_stats(self, board: str, tid: int) -> dict | None:
+    def remove_thread_cache(self, board: str, tid: int):
+        """the thread is seen as modified next loop, e.g. when its fetch is deferred."""
+        with self.lock:
+            if board in self.thread_cache and tid in self.thread_cache[board]:
+                del self.thread_cache[board][tid]
+                self.mark_dirty(self.dirty_thread_cache, board, tid)
+
+    def get_thread_stats(self, board: str, tid: int) -> ThreadStats | None:
         if board not in self.thread_stats:
             return None
         return self.thread_stats[board].get(tid)
 
     def set_thread_stats(self, board: str, tid: int, replies: int | None, images: int | None, most_recent_reply_no: int | None):
-        if board not in self.thread_stats:
-            self.thread_stats[board] = dict()
-        if tid not in self.thread_stats[board]:
-            self.thread_stats[board][tid] = dict()
-        if replies is not None:
-            self.thread_stats[board][tid]['replies'] = replies
-        if images is not None:
-            self.thread_stats[board][tid]['images'] = images
-        if most_recent_reply_no is not None:
-            self.thread_stats[board][tid]['most_recent_reply_no'] = most_recent_reply_no
-
-        self.prune_old_thread_stats(board)
-
-    def prune_old_thread_stats(self, board: str):
-        """don't let the dict grow over N entries per board."""
-        if board not in self.thread_stats:
-            return
-
-        N = 200
-        board_stats = self.thread_stats[board]
-        if (count := len(board_stats)) > N:
-            # delete the oldest threads based on most_recent_reply_no
-            M = count - N + 10
-            tid_reply_pairs = [(tid, stats.get('most_recent_reply_no', 0) or 0) for tid, stats in board_stats.items()]
-            tid_reply_pairs.sort(key=lambda pair: pair[1])
-            for stale_id, _ in tid_reply_pairs[:M]:
-                del board_stats[stale_id]
+        with self.lock:
+            board_stats = self.get_thread_stats_table(board)
+
+            stats = board_stats.get(tid)
+            if stats is None:
+                stats = ThreadStats()
+            if replies is not None:
+                stats.replies = replies
+            if images is not None:
+                stats.images = images
+            if most_recent_reply_no is not None:
+                stats.most_recent_reply_no = most_recent_reply_no
+
+            # set again to re-rank, the oldest threads (by most_recent_reply_no) are evicted first
+            board_stats[tid] = stats
+            self.mark_dirty(self.dirty_thread_stats, board, tid)
 
     def get_http_last_modified(self, url: str) -> str | None:
         return self.http_cache.get(url)
 
-    def set_http_last_modified(self, url: str, last_modified: str | None):
-        if last_modified:
-            self.http_cache[url] = last_modified
-            if len(self.http_cache) > 500:
-                oldest_key = next(iter(self.http_cache))
-                del self.http_cache[oldest_key]
-        elif url in self.http_cache:
-            del self.http_cache[url]
+    def set_http_last_modified(self, url: str, last_modified: str | None, board: str | None=None):
+        """`board` is the board the url belongs to, so `checkpoint()` only writes its own urls."""
+        with self.lock:
+            dirty_urls = self.dirty_http_cache.setdefault(board, set())
+            if last_modified:
+                if self.http_cache.get(url) != last_modified:
+                    dirty_urls.add(url)
+                self.http_cache[url] = last_modified
+                if len(self.http_cache) > 500:
+                    oldest_key = next(iter(self.http_cache))
+                    del self.http_cache[oldest_key]
+                    # written by the next full save
+                    self.dirty_http_cache.setdefault(None, set()).add(oldest_key)
+            elif url in self.http_cache:
+                del self.http_cache[url]
+                dirty_urls.add(url)
 
     def get_thread_url_last_modified(self, board: str, tid: int) -> str | None:
         url = configs.url_thread.format(board=board, thread_id=tid)
@@ -191,32 +371,18 @@ class State:
 
     def update_thread_meta(self, board: str, tid_2_page: dict[int, int], tid_2_thread: dict[int, dict]):
         """update page positions and bump times from catalog data."""
-        if board not in self.thread_meta:
-            self.thread_meta[board] = dict()
-
-        for tid, page in tid_2_page.items():
-            thread = tid_2_thread.get(tid, dict())
-            # last reply time, op time, 0
-            # if 0, no harm done - thread deletion logic still relies on page number, n replies, and not in archive
-            bump_time = thread.get('last_modified', thread.get('time', 0))
-            self.thread_meta[board][tid] = [page, bump_time]
-
-        self.prune_old_thread_meta(board)
-
-    def prune_old_thread_meta(self, board: str):
-        """don't let the dict grow over N entries per board."""
-        if board not in self.thread_meta:
-            return
-
-        N = 200
-        board_meta = self.thread_meta[board]
-        if (count := len(board_meta)) > N:
-            # delete the oldest threads based on bump_time (index 1 in the list)
-            M = count - N + 10
-            tid_bump_pairs = [(tid, meta[1] if meta and len(meta) > 1 else 0) for tid, meta in board_meta.items()]
-            tid_bump_pairs.sort(key=lambda pair: pair[1])
-            for stale_id, _ in tid_bump_pairs[:M]:
-                del board_meta[stale_id]
+        with self.lock:
+            board_meta = self.get_thread_meta_table(board)
+
+            for tid, page in tid_2_page.items():
+                thread = tid_2_thread.get(tid, dict())
+                # last reply time, op time, 0
+                # if 0, no harm done - thread deletion logic still relies on page number, n replies, and not in archive
+                bump_time = thread.get('last_modified', thread.get('time', 0))
+                if board_meta.get(tid) != [page, bump_time]:
+                    # the oldest threads (by bump_time) are evicted first
+                    board_meta[tid] = [page, bump_time]
+                    self.mark_dirty(self.dirty_thread_meta, board, tid)
 
     def get_thread_meta(self, board: str, tid: int) -> list | None:
         """returns [page, bump_time] or None if not tracked."""
@@ -226,5 +392,7 @@ class State:
 
     def remove_thread_meta(self, board: str, tid: int):
         """remove thread from tracking after deletion/archive/prune."""
-        if board in self.thread_meta and tid in self.thread_meta[board]:
-            del self.thread_meta[board][tid]
+        with self.lock:
+            if board in self.thread_meta and tid in self.thread_meta[board]:
+                del self.thread_meta[board][tid]
+                self.mark_dirty(self.dirty_thread_meta, board, tid)
@@ -0,0 +1,144 @@
+import os
+import sqlite3
+import threading
+
+from utils import make_path
+
+
+class SqliteStateStore:
+    """
+    Persists `State` caches in a SQLite database, one row per thread (or url).
+
+    Saves only write the rows that changed since the last save, so they scale with the number of modified threads,
+    not the size of the state. Each board is written in its own transaction, and the database uses WAL,
+    so a crash mid-save leaves the last committed state intact.
+    """
+    def __init__(self, db_path: str=None):
+        self.db_path = db_path or make_path('cache', 'state.db')
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.lock = threading.Lock()
+
+        with self.lock:
+            self.conn.execute('pragma journal_mode=wal;')
+            self.conn.execute('pragma synchronous=normal;')
+            self.create_tables()
+
+    def create_tables(self):
+        with self.conn:
+            self.conn.executescript("""
+                create table if not exists thread_cache (
+                    board text not null,
+                    tid integer not null,
+                    last_modified real,
+                    primary key (board, tid)
+                ) without rowid;
+
+                -- rowid keeps insertion order, which http_cache evicts by
+                create table if not exists http_cache (
+                    url text primary key,
+                    last_modified text not null
+                );
+
+                create table if not exists thread_stats (
+                    board text not null,
+                    tid integer not null,
+                    replies integer,
+                    images integer,
+                    most_recent_reply_no integer,
+                    primary key (board, tid)
+                ) without rowid;
+
+                create table if not exists thread_meta (
+                    board text not null,
+                    tid integer not null,
+                    page integer,
+                    bump_time real,
+                    primary key (board, tid)
+                ) without rowid;
+            """)
+
+    def is_empty(self) -> bool:
+        with self.lock:
+            for table in ('thread_cache', 'http_cache', 'thread_stats', 'thread_meta'):
+                if self.conn.execute(f'select 1 from {table} limit 1;').fetchone():
+                    return False
+            return True
+
+    def read_thread_cache(self) -> dict[str, dict[int, float]]:
+        thread_cache = dict()
+        with self.lock:
+            for board, tid, last_modified in self.conn.execute('select board, tid, last_modified from thread_cache;'):
+                thread_cache.setdefault(board, dict())[tid] = last_modified
+        return thread_cache
+
+    def read_http_cache(self) -> dict[str, str]:
+        with self.lock:
+            return dict(self.conn.execute('select url, last_modified from http_cache order by rowid;'))
+
+    def read_thread_stats(self) -> dict[str, dict[int, dict]]:
+        thread_stats = dict()
+        with self.lock:
+            rows = self.conn.execute('select board, tid, replies, images, most_recent_reply_no from thread_stats;')
+            for board, tid, replies, images, most_recent_reply_no in rows:
+                stats = dict(replies=replies, images=images, most_recent_reply_no=most_recent_reply_no)
+                # State only sets the stats it's given, so keep unset stats absent
+                thread_stats.setdefault(board, dict())[tid] = {k: v for k, v in stats.items() if v is not None}
+        return thread_stats
+
+    def read_thread_meta(self) -> dict[str, dict[int, list]]:
+        thread_meta = dict()
+        with self.lock:
+            for board, tid, page, bump_time in self.conn.execute('select board, tid, page, bump_time from thread_meta;'):
+                thread_meta.setdefault(board, dict())[tid] = [page, bump_time]
+        return thread_meta
+
+    def save_board(self, board: str, thread_cache: dict, thread_stats: dict, thread_meta: dict, tids_thread_cache: set[int], tids_thread_stats: set[int], tids_thread_meta: set[int]):
+        """
+        Writes the given threads of a board in one transaction.
+        A tid no longer in its cache was removed from it, so its row is deleted.
+        """
+        cache_upserts, cache_deletes = [], []
+        for tid in tids_thread_cache:
+            if tid in thread_cache:
+                cache_upserts.append((board, tid, thread_cache[tid]))
+            else:
+                cache_deletes.append((board, tid))
+
+        stats_upserts, stats_deletes = [], []
+        for tid in tids_thread_stats:
+            if tid in thread_stats:
+                stats = thread_stats[tid]
+                stats_upserts.append((board, tid, stats.get('replies'), stats.get('images'), stats.get('most_recent_reply_no')))
+            else:
+                stats_deletes.append((board, tid))
+
+        meta_upserts, meta_deletes = [], []
+        for tid in tids_thread_meta:
+            if tid in thread_meta:
+                page, bump_time = thread_meta[tid]
+                meta_upserts.append((board, tid, page, bump_time))
+            else:
+                meta_deletes.append((board, tid))
+
+        with self.lock, self.conn:
+            self.conn.executemany('insert or replace into thread_cache (board, tid, last_modified) values (?, ?, ?);', cache_upserts)
+            self.conn.executemany('delete from thread_cache where board = ? and tid = ?;', cache_deletes)
+            self.conn.executemany('insert or replace into thread_stats (board, tid, replies, images, most_recent_reply_no) values (?, ?, ?, ?, ?);', stats_upserts)
+            self.conn.executemany('delete from thread_stats where board = ? and tid = ?;', stats_deletes)
+            self.conn.executemany('insert or replace into thread_meta (board, tid, page, bump_time) values (?, ?, ?, ?);', meta_upserts)
+            self.conn.executemany('delete from thread_meta where board = ? and tid = ?;', meta_deletes)
+
+    def save_http_cache(self, http_cache: dict[str, str], urls: set[str]):
+        # new urls are inserted in cache order, so rowids keep the cache's insertion order
+        upserts = [(url, last_modified) for url, last_modified in http_cache.items() if url in urls]
+        deletes = [(url,) for url in urls if url not in http_cache]
+
+        with self.lock, self.conn:
+            # an upsert keeps the row's rowid, like updating a dict key keeps its position
+            self.conn.executemany('insert into http_cache (url, last_modified) values (?, ?) on conflict (url) do update set last_modified = excluded.last_modified;', upserts)
+            self.conn.executemany('delete from http_cache where url = ?;', deletes)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
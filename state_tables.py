@@ -0,0 +1,112 @@
+import heapq
+from typing import Callable, Hashable
+
+import msgspec
+
+from utils import DictLikeStruct
+
+
+class ThreadStats(DictLikeStruct, kw_only=True):
+    """A thread's entry in `State.thread_stats`. Unset stats are `None`, and act like missing keys."""
+    replies: int | None = None
+    images: int | None = None
+    most_recent_reply_no: int | None = None
+
+    def to_dict(self) -> dict:
+        return {k: v for k, v in msgspec.structs.asdict(self).items() if v is not None}
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, dict):
+            return self.to_dict() == other
+        if isinstance(other, ThreadStats):
+            return self.to_dict() == other.to_dict()
+        return NotImplemented
+
+
+class BoundedTable(dict):
+    """
+    A dict of at most `maxlen` entries, that evicts the lowest ranked entries first, e.g. the oldest threads.
+
+    Ranks are kept in a heap, so setting an entry is O(log n), rather than a sort of the whole table.
+    Replacing or deleting an entry leaves its old heap item behind. Stale items are skipped when evicting,
+    and the heap is rebuilt once they outnumber the entries.
+
+    An entry that's changed in place has to be set again to be re-ranked.
+    """
+    def __init__(self, maxlen: int, get_rank: Callable[[object], float], on_evict: Callable[[Hashable], None] | None=None, data: dict | None=None):
+        super().__init__()
+        self.maxlen = maxlen
+        self.get_rank = get_rank
+        self.on_evict = on_evict
+        self.key_2_rank: dict[Hashable, float] = dict()
+        self.heap: list[tuple[float, Hashable]] = []
+
+        if data:
+            for key, value in data.items():
+                self[key] = value
+
+
+    def __setitem__(self, key: Hashable, value):
+        super().__setitem__(key, value)
+
+        rank = self.get_rank(value) or 0
+        if key not in self.key_2_rank or self.key_2_rank[key] != rank:
+            self.key_2_rank[key] = rank
+            heapq.heappush(self.heap, (rank, key))
+
+        if len(self) > self.maxlen:
+            self.evict()
+
+
+    def __delitem__(self, key: Hashable):
+        super().__delitem__(key)
+        del self.key_2_rank[key]
+        self.compact()
+
+
+    def pop(self, key: Hashable, *default):
+        if key not in self:
+            return super().pop(key, *default)
+
+        value = self[key]
+        del self[key]
+        return value
+
+
+    def setdefault(self, key: Hashable, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+
+    def clear(self):
+        super().clear()
+        self.key_2_rank.clear()
+        self.heap.clear()
+
+
+    def evict(self):
+        while len(self) > self.maxlen:
+            rank, key = heapq.heappop(self.heap)
+
+            # replaced or deleted since it was pushed
+            if key not in self.key_2_rank or self.key_2_rank[key] != rank:
+                continue
+
+            super().__delitem__(key)
+            del self.key_2_rank[key]
+            if self.on_evict:
+                self.on_evict(key)
+
+        self.compact()
+
+
+    def compact(self):
+        if len(self.heap) > 2 * len(self) + 64:
+            self.heap = [(rank, key) for key, rank in self.key_2_rank.items()]
+            heapq.heapify(self.heap)
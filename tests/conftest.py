@@ -10,9 +10,9 @@ from db.sqlite import SqliteDb
 from utils import make_path
 
 
-def create_test_sqlite_db(board: str) -> SqliteDb:
+def create_test_sqlite_db(board: str, db_path: str=':memory:', pragmas: dict | None=None) -> SqliteDb:
     """Create a SQLite database with test tables for the given board."""
-    sqlite_db = SqliteDb(':memory:')
+    sqlite_db = SqliteDb(db_path, pragmas=pragmas)
     
     # Create main board table
     sqlite_db.conn.execute(f'''
@@ -1,9 +1,13 @@
+import time
 from types import SimpleNamespace
-from unittest.mock import AsyncMock, patch
+from unittest.mock import AsyncMock, Mock, patch
 
 import pytest
+from mysql.connector.errors import PoolError
 
+from db.mysql import MysqlDb
 from db.ritual import RitualDb
+from db.thread_index import ThreadIndex
 from tests.conftest import create_test_sqlite_db
 
 
@@ -13,6 +17,7 @@ def mock_configs(monkeypatch):
         boards={'test': {}},
         logger=SimpleNamespace(info=lambda s: None),
         unescape_data_b4_db_write=True,
+        thread_index_warm_since_sec=3600,
     )
     monkeypatch.setattr('db.ritual.configs', cfg)
     return cfg
@@ -133,3 +138,211 @@ class TestRitualDb:
             
             rows = db.db.run_query_tuple(f'select num from `test` where num = ?', params=(1,))
             assert len(rows) > 0
+
+    def test_upsert_posts_skips_unchanged(self, db, mock_configs):
+        post = {'no': 1, 'resto': 0, 'time': 1000, 'com': 'Test comment'}
+
+        with patch.object(db, 'upsert_many', wraps=db.upsert_many) as upsert_many:
+            db.upsert_posts('test', [post])
+            db.upsert_posts('test', [post])
+            assert [len(c.args[1]) for c in upsert_many.call_args_list] == [1, 0]
+
+            db.upsert_posts('test', [{**post, 'com': 'Edited'}])
+            assert len(upsert_many.call_args_list[-1].args[1]) == 1
+
+            # deleted posts are written again when they're next seen
+            db.set_posts_deleted('test', [1])
+            db.upsert_posts('test', [{**post, 'com': 'Edited'}])
+            assert len(upsert_many.call_args_list[-1].args[1]) == 1
+
+        rows = db.db.run_query_tuple('select comment from `test` where num = ?', params=(1,))
+        assert rows[0][0] == 'Edited'
+
+    def test_unit_of_work_commits_once(self, db, mock_configs):
+        post = {'no': 1, 'resto': 0, 'time': 1000, 'com': 'Test comment'}
+        thread_stats = {'thread_num': 1, 'time_op': 1000, 'time_last': 1000, 'time_bump': 1000, 'time_last_modified': 0, 'nreplies': 0, 'nimages': 0, 'sticky': 0, 'locked': 0}
+
+        with patch.object(db.db, 'commit', wraps=db.db.commit) as commit:
+            with db.unit_of_work('test'):
+                db.upsert_posts('test', [post])
+                db.upsert_thread_stats('test', thread_stats)
+                db.upsert_thread_stats('test', {**thread_stats, 'nreplies': 5})
+                db.set_threads_archived('test', [1])
+
+                assert db.db.run_query_tuple('select count(*) from `test`')[0][0] == 0
+
+            assert commit.call_count == 1
+
+        assert db.db.run_query_tuple('select locked from `test` where num = 1') == [(1,)]
+        assert db.db.run_query_tuple('select nreplies from `test_threads`') == [(5,)]
+        assert db.board_2_pid_2_fingerprint['test']
+
+    def test_unit_of_work_discards_on_error(self, db, mock_configs):
+        post = {'no': 1, 'resto': 0, 'time': 1000, 'com': 'Test comment'}
+
+        with pytest.raises(ValueError):
+            with db.unit_of_work('test'):
+                db.upsert_posts('test', [post])
+                raise ValueError
+
+        assert db.db.run_query_tuple('select count(*) from `test`')[0][0] == 0
+        assert not db.board_2_pid_2_fingerprint['test']
+
+    def test_iter_query(self, db, mock_configs):
+        db.upsert_posts('test', [{'no': pid, 'resto': 0 if pid == 1 else 1, 'time': 1000} for pid in range(1, 6)])
+
+        rows = db.db.iter_query('select thread_num, num from `test` order by num', arraysize=2)
+        assert next(rows) == (1, 1)
+        rows.close()
+
+        rows = list(db.db.iter_query('select thread_num, num from `test` order by num', arraysize=2, named=True))
+        assert [row.num for row in rows] == [1, 2, 3, 4, 5]
+        assert rows[0]._asdict() == {'thread_num': 1, 'num': 1}
+
+        assert db.get_tid_2_existing_pids('test', [1, 2]) == {1: {1, 2, 3, 4, 5}, 2: set()}
+
+    def test_sqlite_pragmas(self, tmp_path):
+        sqlite_db = create_test_sqlite_db('test', str(tmp_path / 'ritual.db'), pragmas={'journal_mode': 'wal', 'busy_timeout': 1234})
+
+        assert sqlite_db.run_query_tuple('pragma journal_mode;') == [('wal',)]
+        assert sqlite_db.run_query_tuple('pragma busy_timeout;') == [(1234,)]
+
+
+class FakeMysqlConnection:
+    def __init__(self, pool):
+        self.pool = pool
+        self.connection_id = len(pool.connections) + 1
+        self.commits = 0
+        self.pings = 0
+        self.rollback_error = None
+        self.closed = False
+
+    def cursor(self):
+        return Mock(fetchall=Mock(return_value=[]))
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        if self.rollback_error:
+            raise self.rollback_error
+
+    def ping(self, **kwargs):
+        self.pings += 1
+
+    def close(self):
+        self.pool.idle.append(self)
+
+    def disconnect(self):
+        self.closed = True
+
+
+class FakeMysqlPool:
+    def __init__(self, pool_size: int, **kwargs):
+        self.pool_size = pool_size
+        self.connections = []
+        self.idle = []
+
+    def get_connection(self):
+        if self.idle:
+            return self.idle.pop()
+        if len(self.connections) >= self.pool_size:
+            raise PoolError('Failed getting connection; pool exhausted')
+        self.connections.append(FakeMysqlConnection(self))
+        return self.connections[-1]
+
+
+class TestMysqlDb:
+    @pytest.fixture
+    def mysql_db(self, monkeypatch):
+        monkeypatch.setattr('db.mysql.MySQLConnectionPool', FakeMysqlPool)
+        return MysqlDb('localhost', 'user', 'password', 'ritual')
+
+    def test_queries_are_committed_and_returned_to_pool(self, mysql_db):
+        mysql_db.run_query_tuple('select 1')
+        mysql_db.run_query_tuple('select 1')
+
+        conn, = mysql_db.pool.connections
+        assert conn.commits == 2
+        assert mysql_db.pool.idle == [conn]
+
+        # pinged when first checked out, not again while recently used
+        assert conn.pings == 1
+
+    def test_transaction_uses_one_connection(self, mysql_db):
+        with mysql_db.transaction():
+            mysql_db.run_query_tuple('update t set a = 1')
+            mysql_db.run_query_many('insert into t values (%s)', [(1,), (2,)])
+
+        conn, = mysql_db.pool.connections
+        assert conn.commits == 1
+
+    def test_failed_rollback_raises_original_error(self, mysql_db):
+        conn = mysql_db.pool.get_connection()
+        conn.rollback_error = ConnectionError('lost connection')
+        conn.close()
+
+        with pytest.raises(ValueError):
+            with mysql_db.connection():
+                raise ValueError
+
+        assert mysql_db.pool.idle == [conn]
+
+    def test_close_closes_pooled_connections(self, mysql_db):
+        mysql_db.run_query_tuple('select 1')
+        mysql_db.close()
+
+        assert len(mysql_db.pool.connections) == mysql_db.pool.pool_size
+        assert all(conn.closed for conn in mysql_db.pool.connections)
+        assert not mysql_db.pool.idle
+
+
+class TestThreadIndex:
+    def test_answers_from_index_after_warm(self, db, mock_configs):
+        now = int(time.time())
+        old = now - 30 * 24 * 60 * 60
+        db.upsert_posts('test', [
+            {'no': 1, 'resto': 0, 'time': now},
+            {'no': 2, 'resto': 1, 'time': now},
+            {'no': 10, 'resto': 0, 'time': old},
+            {'no': 11, 'resto': 10, 'time': old},
+        ])
+
+        # a restart, the index is warmed from the database
+        db.thread_index = ThreadIndex(db.db, mock_configs.thread_index_warm_since_sec)
+
+        with patch.object(db.db, 'iter_query', wraps=db.db.iter_query) as iter_query:
+            assert db.get_recently_active_thread_ids('test') == {1}
+            assert db.get_tid_2_existing_pids('test', [1, 10, 20]) == {1: {1, 2}, 10: {10, 11}, 20: set()}
+
+            # the warm query, and one for the threads it didn't cover
+            assert iter_query.call_count == 2
+
+            db.upsert_posts('test', [{'no': 20, 'resto': 0, 'time': now}, {'no': 3, 'resto': 1, 'time': now}])
+            db.set_threads_archived('test', [1])
+
+            assert db.get_tid_2_existing_pids('test', [1, 20]) == {1: {1, 2, 3}, 20: {20}}
+            assert db.get_recently_active_thread_ids('test') == {20}
+            assert iter_query.call_count == 2
+
+    def test_read_overlapping_a_write_is_not_kept(self, db, mock_configs):
+        now = int(time.time())
+        db.upsert_posts('test', [{'no': 1, 'resto': 0, 'time': now}])
+        db.thread_index = ThreadIndex(db.db, mock_configs.thread_index_warm_since_sec)
+        db.get_recently_active_thread_ids('test')
+
+        iter_query = db.db.iter_query
+
+        def iter_query_during_write(sql_string, params=None, **kwargs):
+            rows = list(iter_query(sql_string, params, **kwargs))
+            # another board worker's write lands after the read
+            db.thread_index.add_rows('test', [])
+            return iter(rows)
+
+        with patch.object(db.db, 'iter_query', side_effect=iter_query_during_write) as iter_query_mock:
+            assert db.get_tid_2_existing_pids('test', [5]) == {5: set()}
+            assert db.get_tid_2_existing_pids('test', [5]) == {5: set()}
+
+            # read again, since the first read wasn't kept
+            assert iter_query_mock.call_count == 2
+            assert 5 not in db.thread_index.board_2_tid_2_thread['test']
@@ -1,20 +1,24 @@
 import json
 import os
 import tempfile
+import time
 from types import SimpleNamespace
 from unittest.mock import AsyncMock, Mock
 
 import pytest
 
+import filter as filter_module
 from catalog import Catalog
 from db.ritual import RitualDb
-from enums import MediaType
-from fetcher import Fetcher
+from enums import MediaType, PollStatus
+from fetcher import Fetcher, NotModified
 from filter import Filter
 from loop import Loop
 from posts import Posts
+from scheduler import BoardScheduler
 from state import State
 from tests.conftest import create_test_sqlite_db
+from utils import catalog_decoder, get_d_board, thread_decoder
 
 
 class MockMediaFP:
@@ -53,6 +57,7 @@ def mock_configs(monkeypatch):
         media_save_path=tempfile.mkdtemp(),
         db_path=':memory:',
         unescape_data_b4_db_write=True,
+        thread_index_warm_since_sec=3600,
         loop_cooldown_sec=0,
     )
     monkeypatch.setattr('main.configs', cfg)
@@ -118,6 +123,15 @@ class TestCatalog:
         assert result is False
         assert len(catalog.catalog) == 0
 
+    def test_fetch_catalog_not_modified(self, mock_configs, state):
+        fetcher = Fetcher(state)
+        fetcher.fetch_json = Mock(return_value=NotModified())
+
+        catalog = Catalog(fetcher, 'po')
+
+        assert catalog.fetch_catalog() is False
+        assert catalog.not_modified
+
     def test_set_tid_2_thread(self, mock_fetcher, catalog_json, mock_configs):
         catalog = Catalog(mock_fetcher, 'po')
         catalog.catalog = catalog_json
@@ -144,6 +158,27 @@ class TestCatalog:
             assert len(catalog.tid_2_last_replies) > 0
 
 
+    def test_fetch_catalog_decoded(self, state, catalog_json, mock_configs):
+        fetcher = Fetcher(state)
+        fetcher.fetch_json = Mock(return_value=catalog_decoder.decode(json.dumps(catalog_json)))
+
+        catalog = Catalog(fetcher, 'po')
+
+        assert catalog.fetch_catalog()
+        assert fetcher.fetch_json.call_args.kwargs['decoder'] is catalog_decoder
+        for page in catalog_json:
+            for thread in page['threads']:
+                decoded = catalog.tid_2_thread[thread['no']]
+                assert decoded.get('replies', 0) == thread.get('replies', 0)
+                assert ('tim' in decoded) == ('tim' in thread)
+                assert len(catalog.tid_2_last_replies.get(thread['no'], [])) == len(thread.get('last_replies', []))
+
+    def test_decoded_posts_give_same_rows(self, thread_json):
+        posts = thread_decoder.decode(json.dumps(thread_json))['posts']
+
+        assert [get_d_board(post) for post in posts] == [get_d_board(post) for post in thread_json['posts']]
+
+
 class TestState:
     def test_is_thread_modified_new_thread(self, state):
         thread = {'no': 1, 'last_modified': 100}
@@ -175,13 +210,27 @@ class TestState:
         assert result is True
         assert state.thread_cache['po'][1] is None
 
-    def test_prune_old_threads(self, state):
+    def test_prune_old_threads(self, state, monkeypatch):
+        monkeypatch.setattr('state.configs.state_max_threads_per_board', 200)
         board = 'po'
         state.thread_cache[board] = {i: i for i in range(210)}
         state.prune_old_threads(board)
         
         assert len(state.thread_cache[board]) <= 200
 
+    def test_thread_tables_evict_oldest(self, state, monkeypatch):
+        monkeypatch.setattr('state.configs.state_max_threads_per_board', 3)
+        for tid in range(1, 4):
+            state.set_thread_stats('po', tid, replies=1, images=0, most_recent_reply_no=tid * 100)
+
+        # re-ranked by the new reply, so thread 2 is now the oldest
+        state.set_thread_stats('po', 1, replies=2, images=None, most_recent_reply_no=400)
+        state.set_thread_stats('po', 4, replies=1, images=0, most_recent_reply_no=350)
+
+        assert sorted(state.thread_stats['po']) == [1, 3, 4]
+        assert state.get_thread_stats('po', 1) == {'replies': 2, 'images': 0, 'most_recent_reply_no': 400}
+        assert 2 in state.dirty_thread_stats['po']
+
     def test_get_cached_thread_cache(self, state, tmp_path, monkeypatch):
         cache_file = tmp_path / 'cache.json'
         cache_file.parent.mkdir(parents=True, exist_ok=True)
@@ -218,6 +267,49 @@ class TestState:
         assert stats['images'] == 5
         assert stats['most_recent_reply_no'] == 100
 
+    def test_save_only_changed_caches(self, state, tmp_path):
+        for name in ('thread_cache', 'http_cache', 'thread_stats', 'thread_meta'):
+            setattr(state, f'{name}_filepath', str(tmp_path / f'{name}.json'))
+
+        state.set_thread_stats('po', 1, replies=10, images=5, most_recent_reply_no=100)
+
+        state.save()
+        assert os.listdir(tmp_path) == ['thread_stats.json']
+        assert state.get_cached_thread_stats() == {'po': {1: {'replies': 10, 'images': 5, 'most_recent_reply_no': 100}}}
+        assert not state.dirty_thread_stats
+
+    def test_json_checkpoint(self, state, tmp_path):
+        for name in ('thread_cache', 'http_cache', 'thread_stats', 'thread_meta'):
+            setattr(state, f'{name}_filepath', str(tmp_path / f'{name}.json'))
+
+        state.is_thread_modified_cache_update('po', {'no': 1, 'last_modified': 100})
+        state.is_thread_modified_cache_update('g', {'no': 1, 'last_modified': 100})
+
+        # json files hold every board, g's posts may not be committed yet
+        state.checkpoint('po')
+        assert os.listdir(tmp_path) == []
+
+        state.save()
+        state.is_thread_modified_cache_update('po', {'no': 2, 'last_modified': 200})
+        state.checkpoint('po')
+
+        assert state.get_cached_thread_cache() == {'po': {1: 100, 2: 200}, 'g': {1: 100}}
+        assert not state.dirty_thread_cache
+
+    def test_save_failure_keeps_previous_file(self, state, tmp_path, monkeypatch):
+        state.thread_cache_filepath = str(tmp_path / 'thread_cache.json')
+        state.is_thread_modified_cache_update('po', {'no': 1, 'last_modified': 100})
+        state.save()
+
+        state.is_thread_modified_cache_update('po', {'no': 2, 'last_modified': 200})
+        monkeypatch.setattr('utils.json.dump', Mock(side_effect=KeyboardInterrupt))
+        with pytest.raises(KeyboardInterrupt):
+            state.save()
+
+        assert os.listdir(tmp_path) == ['thread_cache.json']
+        assert state.get_cached_thread_cache() == {'po': {1: 100}}
+        assert state.dirty_thread_cache == {'po': {2}}
+
 
 class TestFilter:
     def test_should_archive_whitelist(self, mock_fetcher, db, state, mock_configs, mock_media):
@@ -259,6 +351,32 @@ class TestFilter:
         assert not filter_obj.should_archive('', 'aaaa')
         assert filter_obj.should_archive('', 'abcde')
 
+    def test_rules_compiled_once_per_board_config(self, mock_fetcher, db, state, mock_configs):
+        mock_configs.boards['po'] = {'blacklist': '.*spam.*', 'op_comment_min_chars': 5}
+        rules = Filter(mock_fetcher, db, 'po', state).rules
+
+        assert Filter(mock_fetcher, db, 'po', state).rules is rules
+
+        mock_configs.boards['po'] = {'blacklist': '.*eggs.*', 'op_comment_min_chars': 5}
+        assert Filter(mock_fetcher, db, 'po', state).rules is not rules
+
+    def test_download_rules_parse_html_once(self, mock_fetcher, db, state, mock_configs, monkeypatch):
+        mock_configs.boards['po'] = {'dl_fm_thread': '.*wireguard.*', 'dl_fm_post': '.*WireGuard.*', 'dl_th_post': '.*linux.*'}
+        filter_obj = Filter(mock_fetcher, db, 'po', state)
+        md5 = 'a' * 22 + '=='
+        op = {'no': 1, 'resto': 0, 'tim': 1, 'ext': '.jpg', 'md5': md5, 'com': 'hello'}
+        reply = {'no': 2, 'resto': 1, 'tim': 2, 'ext': '.jpg', 'md5': md5, 'com': 'set up <b>wireguard</b> &amp; linux'}
+        filter_obj.tid_2_thread = {1: op}
+        filter_obj.set_tid_2_posts({1: [op, reply]})
+
+        extract_text_from_html = Mock(side_effect=filter_module.extract_text_from_html)
+        monkeypatch.setattr('filter.extract_text_from_html', extract_text_from_html)
+        filter_obj.get_pids_for_download()
+
+        assert filter_obj.full_pids == {2}
+        assert filter_obj.thumb_pids == {2}
+        assert extract_text_from_html.call_count == 2
+
     def test_is_media_needed_file_exists(self, mock_fetcher, db, state, mock_configs, tmp_path, mock_media):
         mock_configs.media_save_path = str(tmp_path)
         mock_media.media_save_path = str(tmp_path)
@@ -357,6 +475,23 @@ class TestPosts:
         
         assert 628117 not in posts.tid_2_posts
 
+    def test_fetch_posts_merges_in_scheduled_order(self, mock_fetcher, db, mock_configs, state):
+        from main import Archive
+        tids = [628119, 628117, 628118]
+        # none are at risk, so the threads with the most unseen replies are fetched and merged first
+        tid_2_replies = {628119: 3, 628117: 10, 628118: 1}
+        tid_2_thread = {tid: {'no': tid, 'last_modified': 100, 'replies': tid_2_replies[tid], 'images': 0} for tid in tids}
+        catalog = Catalog(mock_fetcher, 'po')
+        catalog.catalog = []
+        catalog.set_tid_2_thread()
+        catalog.set_tid_2_last_replies()
+        posts = Posts(db, mock_fetcher, 'po', tid_2_thread, state, catalog)
+        archive = Archive(mock_fetcher, 'po')
+        posts.fetch_posts(archive)
+
+        assert list(posts.tid_2_posts) == [628117, 628119, 628118]
+        assert mock_fetcher.fetch_json.call_count == len(tids)
+
     def test_set_pid_2_post(self, db, mock_fetcher, thread_json, mock_configs, state, catalog_json):
         tid_2_thread = {628117: {'no': 628117}}
         catalog = Catalog(mock_fetcher, 'po')
@@ -413,6 +548,102 @@ class TestLoop:
         loop.increment_loop()
         assert loop.loop_i == initial + 1
 
+    def test_board_start_times_are_independent(self, loop):
+        loop.set_start_time('po')
+        loop.board_2_start_time['po'] -= 120
+        loop.set_start_time('g')
+
+        loop.set_board_duration_minutes('g')
+        loop.set_board_duration_minutes('po')
+
+        assert loop.board_2_duration['g'] < 1
+        assert loop.board_2_duration['po'] >= 2
+
+    def test_start_pass_resets_durations(self, loop):
+        loop.loop_start_time -= 3600
+        loop.set_start_time('po')
+        loop.set_board_duration_minutes('po')
+
+        loop.start_pass()
+        loop.increment_loop()
+
+        assert loop.board_2_duration == {}
+        assert loop.loop_duration < 1
+
+
+class TestProcessBoards:
+    def test_failed_board_does_not_stop_others(self, mock_configs, loop, monkeypatch):
+        import threading
+        import main
+
+        mock_configs.concurrent_boards = True
+        mock_configs.board_workers = 2
+        bad_started = threading.Event()
+
+        def process_board(board, db, fetcher, loop, state, media_fp):
+            loop.set_start_time(board)
+            if board == 'bad':
+                bad_started.set()
+                raise RuntimeError('catalog exploded')
+
+            # still running when the other board fails
+            bad_started.wait(timeout=5)
+            loop.set_board_duration_minutes(board)
+            return f'{board}_posts'
+
+        monkeypatch.setattr(main, 'process_board', process_board)
+
+        with pytest.raises(RuntimeError, match='catalog exploded'):
+            main.process_boards(['bad', 'good', 'po'], None, None, loop, None, None)
+
+        assert set(loop.board_2_duration) == {'good', 'po'}
+        assert set(loop.board_2_start_time) == {'bad', 'good', 'po'}
+
+
+class TestBoardPolling:
+    def test_not_modified_catalog_backs_off(self, mock_configs, state, loop):
+        import main
+
+        fetcher = Fetcher(state)
+        fetcher.fetch_json = Mock(return_value=NotModified())
+        board_scheduler = BoardScheduler(['po', 'g'])
+
+        for _ in range(3):
+            board_scheduler.board_2_polled_at['po'] = time.time() - board_scheduler.board_2_interval['po']
+            board_2_posts = {'po': main.process_board('po', None, fetcher, loop, state, None), 'g': None}
+            main.update_board_scheduler(board_scheduler, board_2_posts)
+
+        assert board_2_posts['po'] is PollStatus.not_modified
+
+        # a 304 is a quiet poll, a failed poll keeps its interval
+        assert board_scheduler.board_2_interval['po'] > board_scheduler.board_2_interval['g']
+
+
+class TestFetcher:
+    def test_requests_share_rate_limiter(self, state):
+        fetcher = Fetcher(state)
+        fetcher.rate_limiter.acquire('https://a.4cdn.org/po/catalog.json')
+
+        assert 'a.4cdn.org' in fetcher.rate_limiter.host_2_bucket
+
+    def test_fetch_json_many(self, state):
+        fetcher = Fetcher(state)
+        fetcher.fetch_json = Mock(side_effect=lambda url, **kwargs: {'url': url} if url.endswith('1.json') or url.endswith('3.json') else {})
+        urls = [f'https://a.4cdn.org/po/thread/{i}.json' for i in range(1, 5)]
+
+        results = fetcher.fetch_json_many(urls, transform=lambda url, data: data['url'])
+
+        assert list(results) == urls
+        assert results[urls[0]] == urls[0]
+        assert results[urls[1]] == {}
+        assert results[urls[2]] == urls[2]
+
+    def test_sessions_pool_connections(self, state):
+        fetcher = Fetcher(state)
+        adapter = fetcher.session.get_adapter('https://a.4cdn.org/po/catalog.json')
+
+        assert adapter._pool_block is True
+
 
 class TestIntegration:
     def test_full_flow_no_api_calls(self, mock_fetcher, db, state, loop, catalog_json, thread_json, mock_configs, mock_media):
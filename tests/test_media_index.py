@@ -0,0 +1,152 @@
+import os
+import time
+
+import pytest
+
+import configs
+import media_fp as media_fp_module
+from enums import MediaType
+from media_fp import AsagiMediaFP, SutraMediaFP
+from media_index import MediaIndex
+
+
+@pytest.fixture
+def media_fp_configs(monkeypatch, tmp_path):
+    monkeypatch.setattr(configs, 'media_workers', 0)
+    monkeypatch.setattr(configs, 'media_index_max_per_board', 100)
+    monkeypatch.setattr(configs, 'media_index_path', str(tmp_path / 'media_index.json'))
+    monkeypatch.setattr(configs, 'media_index_warm', 'directory')
+    monkeypatch.setattr(configs, 'media_index_max_md5s', 100)
+    monkeypatch.setattr(configs, 'make_thumbnails', False)
+    monkeypatch.setattr(configs, 'scanner_db_enabled', False)
+    return tmp_path
+
+
+class FakeRitualDb:
+    def __init__(self, board_2_media: dict[str, list[tuple[str, str]]]):
+        self.board_2_media = board_2_media
+
+    def get_recent_media(self, board: str, limit: int) -> list[tuple[str, str]]:
+        return self.board_2_media.get(board, [])[:limit]
+
+
+def touch(dirpath: str, filename: str):
+    os.makedirs(dirpath, exist_ok=True)
+    open(os.path.join(dirpath, filename), 'wb').close()
+
+
+class TestMediaIndex:
+    def test_evicts_least_recently_used(self):
+        media_index = MediaIndex(max_per_table=2)
+        media_index.add('g', MediaType.full_media, '1.jpg')
+        media_index.add('g', MediaType.full_media, '2.jpg')
+
+        assert media_index.has('g', MediaType.full_media, '1.jpg')
+        media_index.add('g', MediaType.full_media, '3.jpg')
+
+        assert media_index.has('g', MediaType.full_media, '1.jpg')
+        assert not media_index.has('g', MediaType.full_media, '2.jpg')
+        assert media_index.has('g', MediaType.full_media, '3.jpg')
+
+    def test_tables_per_board_and_media_type(self):
+        media_index = MediaIndex(max_per_table=10)
+        media_index.add('g', MediaType.full_media, '1.jpg')
+
+        assert not media_index.has('g', MediaType.thumbnail, '1.jpg')
+        assert not media_index.has('ck', MediaType.full_media, '1.jpg')
+
+    def test_md5s_evict_least_recently_used(self):
+        media_index = MediaIndex(max_per_table=10, max_md5s=2)
+        media_index.add_md5s([('a==', 'a/1.jpg'), ('b==', 'a/2.jpg')])
+        media_index.get_relpath('a==')
+
+        assert media_index.add_md5s([('c==', 'b/3.jpg'), ('a==', 'b/4.jpg')]) == 1
+        assert media_index.get_relpath('a==') == 'a/1.jpg'
+        assert media_index.get_relpath('b==') is None
+        assert media_index.get_relpath('c==') == 'b/3.jpg'
+
+    def test_save_and_load(self, tmp_path):
+        filepath = str(tmp_path / 'media_index.json')
+        media_index = MediaIndex(max_per_table=10, filepath=filepath)
+        media_index.add('g', MediaType.full_media, '1.jpg')
+        media_index.add('g', MediaType.thumbnail, '1s.jpg')
+        media_index.save()
+
+        loaded = MediaIndex(max_per_table=10, filepath=filepath)
+        loaded.load()
+
+        assert loaded.has('g', MediaType.full_media, '1.jpg')
+        assert loaded.has('g', MediaType.thumbnail, '1s.jpg')
+        assert not loaded.create_table('g', MediaType.full_media)
+
+
+class TestMediaFPIndex:
+    def test_warms_from_directory(self, media_fp_configs):
+        media_fp = AsagiMediaFP(None, str(media_fp_configs), None, None)
+        post = dict(tim=1234567, ext='.jpg')
+        dirpath, filename = media_fp.get_dirpath_and_filename('g', MediaType.full_media, post)
+        touch(dirpath, filename)
+        touch(dirpath, f'{filename}abc.tmp')
+        touch(dirpath, f'{filename}old.tmp')
+        stale_time = time.time() - media_fp_module.stale_tmp_age_s - 1
+        os.utime(os.path.join(dirpath, f'{filename}old.tmp'), (stale_time, stale_time))
+
+        assert media_fp.is_saved('g', MediaType.full_media, dirpath, filename)
+        assert media_fp.media_index.get_filenames('g', MediaType.full_media) == {filename: None}
+
+        # an unfinished download is kept, a stale one is removed
+        assert os.path.isfile(os.path.join(dirpath, f'{filename}abc.tmp'))
+        assert not os.path.isfile(os.path.join(dirpath, f'{filename}old.tmp'))
+
+        # removed behind the index's back, it's still trusted
+        os.remove(os.path.join(dirpath, filename))
+        assert media_fp.is_saved('g', MediaType.full_media, dirpath, filename)
+
+    def test_miss_checks_disk(self, media_fp_configs):
+        media_fp = SutraMediaFP(None, str(media_fp_configs), None, None)
+        post = dict(md5='abc+/def==', ext='.png')
+        dirpath, filename = media_fp.get_dirpath_and_filename('g', MediaType.full_media, post)
+
+        assert not media_fp.is_saved('g', MediaType.full_media, dirpath, filename)
+
+        touch(dirpath, filename)
+        assert media_fp.is_saved('g', MediaType.full_media, dirpath, filename)
+
+        # sutra's files are shared by every board
+        assert media_fp.media_index.has('', MediaType.full_media, filename)
+        assert media_fp.is_saved('ck', MediaType.full_media, dirpath, filename)
+
+
+class TestAsagiLinkDuplicates:
+    def test_links_file_saved_on_another_board(self, media_fp_configs, monkeypatch):
+        monkeypatch.setattr(configs, 'asagi_link_duplicates', True)
+        media_fp = AsagiMediaFP(None, str(media_fp_configs), FakeRitualDb({'a': [('md5==', '1111111.jpg')]}), None)
+
+        src_dirpath, src_filename = media_fp.get_dirpath_and_filename('a', MediaType.full_media, dict(tim=1111111, ext='.jpg'))
+        touch(src_dirpath, src_filename)
+
+        post = dict(tim=2222222, ext='.jpg', md5='md5==')
+        # the fetcher is None, both are linked rather than downloaded
+        media_fp.download_full_media('url', post, 'a')
+        media_fp.download_full_media('url', post, 'b')
+
+        dirpath, filename = media_fp.get_dirpath_and_filename('b', MediaType.full_media, post)
+        assert os.path.samefile(os.path.join(src_dirpath, src_filename), os.path.join(dirpath, filename))
+        assert media_fp.board_2_ritual_queue['b'] == [('md5==', '2222222.jpg')]
+
+    def test_missing_source_falls_back_to_download(self, media_fp_configs, monkeypatch):
+        monkeypatch.setattr(configs, 'asagi_link_duplicates', True)
+        media_fp = AsagiMediaFP(None, str(media_fp_configs), FakeRitualDb({'a': [('md5==', '1111111.jpg')]}), None)
+        media_fp.warm_md5_index('a')
+
+        # the row's file isn't on disk, so it isn't added
+        assert media_fp.media_index.get_relpath('md5==') is None
+
+        src_dirpath, src_filename = media_fp.get_dirpath_and_filename('a', MediaType.full_media, dict(tim=1111111, ext='.jpg'))
+        media_fp.media_index.add_md5('md5==', os.path.relpath(os.path.join(src_dirpath, src_filename), str(media_fp_configs)))
+
+        post = dict(tim=2222222, ext='.jpg', md5='md5==')
+        dirpath, filename = media_fp.get_dirpath_and_filename('b', MediaType.full_media, post)
+
+        assert not media_fp.link_saved_duplicate('b', post, dirpath, filename)
+        assert media_fp.media_index.get_relpath('md5==') is None
@@ -0,0 +1,91 @@
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from media_queue import MediaQueue
+
+
+@pytest.fixture(autouse=True)
+def mock_configs(monkeypatch):
+    cfg = SimpleNamespace(logger=SimpleNamespace(info=lambda s: None, error=lambda s: None))
+    monkeypatch.setattr('media_queue.configs', cfg)
+    return cfg
+
+
+class TestMediaQueue:
+    def test_runs_downloads_on_workers(self):
+        media_queue = MediaQueue(workers=2, maxsize=10)
+        thread_names = []
+
+        for i in range(5):
+            media_queue.submit(i, lambda: thread_names.append(threading.current_thread().name))
+        media_queue.join()
+        media_queue.shutdown()
+
+        assert len(thread_names) == 5
+        assert all(name.startswith('media_') for name in thread_names)
+        assert media_queue.get_stats()['done'] == 5
+
+    def test_skips_pending_duplicates(self):
+        media_queue = MediaQueue(workers=1, maxsize=10)
+        release = threading.Event()
+        calls = []
+
+        def download(key):
+            release.wait()
+            calls.append(key)
+
+        assert media_queue.submit('a', download, 'a')
+        assert not media_queue.submit('a', download, 'a')
+        assert media_queue.submit('b', download, 'b')
+
+        release.set()
+        media_queue.join()
+
+        # done, so it can be queued again
+        assert media_queue.submit('a', download, 'a')
+        media_queue.join()
+        media_queue.shutdown()
+
+        assert calls == ['a', 'b', 'a']
+
+    def test_failed_download_keeps_worker(self):
+        media_queue = MediaQueue(workers=1, maxsize=10)
+        calls = []
+
+        media_queue.submit('a', lambda: 1 / 0)
+        media_queue.submit('b', lambda: calls.append('b'))
+        media_queue.join()
+        media_queue.shutdown()
+
+        assert calls == ['b']
+        assert media_queue.get_stats()['errors'] == 1
+
+    def test_shutdown_drops_queued(self):
+        media_queue = MediaQueue(workers=1, maxsize=10)
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def download(key):
+            started.set()
+            release.wait()
+            calls.append(key)
+
+        for key in 'abc':
+            media_queue.submit(key, download, key)
+        started.wait()
+
+        threading.Timer(0.05, release.set).start()
+        assert media_queue.shutdown() == 2
+        assert calls == ['a']
+
+    def test_stats(self):
+        media_queue = MediaQueue(workers=0, maxsize=10)
+        media_queue.submit('a', media_queue.record_download, 600)
+
+        stats = media_queue.get_stats()
+        assert stats['queue_depth'] == 0
+        assert stats['in_flight'] == 0
+        assert stats['bytes_per_sec'] == 600 / media_queue.rate_window_s
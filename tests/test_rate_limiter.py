@@ -0,0 +1,59 @@
+import pytest
+
+from rate_limiter import RateLimiter, TokenBucket
+
+
+class TestTokenBucket:
+    def test_burst_does_not_wait(self):
+        bucket = TokenBucket(rate=1.0, burst=3)
+
+        assert bucket.reserve() == 0.0
+        assert bucket.reserve() == 0.0
+        assert bucket.reserve() == 0.0
+
+    def test_waits_once_burst_is_spent(self):
+        bucket = TokenBucket(rate=2.0, burst=1)
+
+        assert bucket.reserve() == 0.0
+        assert bucket.reserve() == pytest.approx(0.5, abs=0.05)
+        # debt is paid back in order
+        assert bucket.reserve() == pytest.approx(1.0, abs=0.05)
+
+    def test_tokens_cost(self):
+        bucket = TokenBucket(rate=1.0, burst=1)
+
+        assert bucket.reserve(tokens=1.0) == 0.0
+        assert bucket.reserve(tokens=2.0) == pytest.approx(2.0, abs=0.05)
+
+    def test_invalid_limits(self):
+        with pytest.raises(ValueError):
+            TokenBucket(rate=0, burst=1)
+
+
+class TestRateLimiter:
+    def test_buckets_are_per_host(self):
+        limiter = RateLimiter({'a.4cdn.org': {'rate': 100.0, 'burst': 1}, 'i.4cdn.org': {'rate': 100.0, 'burst': 1}})
+
+        assert limiter.acquire('https://a.4cdn.org/po/catalog.json') == 0.0
+        assert limiter.acquire('https://i.4cdn.org/po/1.jpg') == 0.0
+        assert set(limiter.host_2_bucket) == {'a.4cdn.org', 'i.4cdn.org'}
+
+    def test_unknown_host_uses_default(self):
+        limiter = RateLimiter({}, default_limit={'rate': 100.0, 'burst': 1})
+        limiter.acquire('https://lainchan.org/g/catalog.json')
+
+        assert 'lainchan.org' in limiter.host_2_bucket
+
+    def test_unknown_host_unlimited(self):
+        limiter = RateLimiter({}, default_limit=None)
+
+        assert limiter.acquire('https://lainchan.org/g/catalog.json') == 0.0
+        assert limiter.acquire('https://lainchan.org/g/catalog.json') == 0.0
+        assert limiter.host_2_bucket == {}
+
+    def test_acquire_sleeps(self):
+        limiter = RateLimiter({'a.4cdn.org': {'rate': 20.0, 'burst': 1}})
+        limiter.acquire('https://a.4cdn.org/po/catalog.json')
+
+        waited = limiter.acquire('https://a.4cdn.org/po/catalog.json')
+        assert waited == pytest.approx(0.05, abs=0.02)
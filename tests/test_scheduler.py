@@ -0,0 +1,138 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from loop import Loop
+from scheduler import BoardScheduler, ThreadScheduler
+from state import State
+
+
+@pytest.fixture
+def mock_configs(monkeypatch):
+    cfg = SimpleNamespace(
+        logger=SimpleNamespace(info=lambda s: None, warning=lambda s: None, error=lambda s: None),
+        thread_priority_last_pages=2,
+        thread_priority_lookahead_min=10,
+        thread_bump_limit=300,
+        thread_fetch_budget=None,
+        board_poll_min_sec=30.0,
+        board_poll_max_sec=600.0,
+        board_poll_target_new_posts=50,
+    )
+    monkeypatch.setattr('scheduler.configs', cfg)
+    return cfg
+
+
+@pytest.fixture
+def state():
+    return State(Loop())
+
+
+def make_catalog(tid_2_page: dict[int, int]):
+    return SimpleNamespace(tid_2_page=tid_2_page)
+
+
+class TestThreadScheduler:
+    def test_last_pages_first(self, mock_configs, state):
+        now = time.time()
+        tid_2_thread = {
+            1: {'no': 1, 'replies': 5, 'time': now - 3600},
+            2: {'no': 2, 'replies': 5, 'time': now - 3600},
+            3: {'no': 3, 'replies': 5, 'time': now - 3600},
+        }
+        scheduler = ThreadScheduler('po', state, make_catalog({1: 1, 2: 10, 3: 9}))
+
+        tids, deferred = scheduler.schedule([1, 2, 3], tid_2_thread)
+
+        assert tids == [2, 3, 1]
+        assert deferred == []
+
+    def test_bump_limit_first(self, mock_configs, state):
+        now = time.time()
+        tid_2_thread = {
+            1: {'no': 1, 'replies': 50, 'time': now - 3600},
+            2: {'no': 2, 'replies': 310, 'time': now - 36000, 'bumplimit': 1},
+            # ~290 posts/hour, will hit the bump limit within 10 minutes
+            3: {'no': 3, 'replies': 280, 'time': now - 3600},
+        }
+        scheduler = ThreadScheduler('po', state, make_catalog({1: 1, 2: 1, 3: 1, 4: 10}))
+
+        tids, _ = scheduler.schedule([1, 2, 3], tid_2_thread)
+
+        assert tids[-1] == 1
+
+    def test_unseen_replies_order(self, mock_configs, state):
+        now = time.time()
+        state.set_thread_stats('po', 1, replies=10, images=0, most_recent_reply_no=100)
+        state.set_thread_stats('po', 2, replies=10, images=0, most_recent_reply_no=200)
+        tid_2_thread = {
+            1: {'no': 1, 'replies': 11, 'time': now - 3600},
+            2: {'no': 2, 'replies': 20, 'time': now - 3600},
+        }
+        scheduler = ThreadScheduler('po', state, make_catalog({1: 1, 2: 1, 4: 10}))
+
+        tids, _ = scheduler.schedule([1, 2], tid_2_thread)
+
+        assert tids == [2, 1]
+
+    def test_budget_defers_idle_threads(self, mock_configs, state):
+        mock_configs.thread_fetch_budget = 1
+        now = time.time()
+        state.thread_cache['po'] = {1: 100, 2: 100, 3: 100, 4: 100}
+        tid_2_thread = {
+            1: {'no': 1, 'replies': 5, 'time': now - 3600},
+            2: {'no': 2, 'replies': 9, 'time': now - 3600},
+            3: {'no': 3, 'replies': 5, 'time': now - 3600},
+            4: {'no': 4, 'replies': 5, 'time': now - 3600},
+        }
+        scheduler = ThreadScheduler('po', state, make_catalog({1: 1, 2: 1, 3: 10, 4: 9}))
+
+        tids, deferred = scheduler.schedule([1, 2, 3, 4], tid_2_thread)
+
+        # at risk threads are kept, even past the budget
+        assert tids == [3, 4]
+        assert deferred == [2, 1]
+        assert 1 not in state.thread_cache['po']
+        assert state.is_thread_modified_cache_update('po', {'no': 1, 'last_modified': 100})
+
+
+class TestBoardScheduler:
+    def test_all_boards_due_at_start(self, mock_configs):
+        scheduler = BoardScheduler(['po', 'g'])
+
+        assert set(scheduler.get_due_boards()) == {'po', 'g'}
+
+    def test_quiet_board_slows_down(self, mock_configs):
+        scheduler = BoardScheduler(['po'])
+
+        for _ in range(10):
+            scheduler.board_2_polled_at['po'] = time.time() - scheduler.board_2_interval['po']
+            scheduler.update('po', new_post_count=0, missing_thread_count=0)
+
+        assert scheduler.board_2_interval['po'] == 600.0
+        assert scheduler.get_due_boards() == []
+
+    def test_fast_board_speeds_up(self, mock_configs):
+        scheduler = BoardScheduler(['g'])
+        scheduler.board_2_interval['g'] = 300.0
+
+        scheduler.board_2_polled_at['g'] = time.time() - 300.0
+        scheduler.update('g', new_post_count=500, missing_thread_count=2)
+
+        assert scheduler.board_2_interval['g'] < 300.0
+
+        for _ in range(10):
+            scheduler.board_2_polled_at['g'] = time.time() - scheduler.board_2_interval['g']
+            scheduler.update('g', new_post_count=500, missing_thread_count=2)
+
+        assert scheduler.board_2_interval['g'] == 30.0
+
+    def test_failed_poll_keeps_interval(self, mock_configs):
+        scheduler = BoardScheduler(['po'])
+        scheduler.board_2_interval['po'] = 120.0
+
+        scheduler.update('po', None, None)
+
+        assert scheduler.board_2_interval['po'] == 120.0
+        assert 'po' not in scheduler.get_due_boards()
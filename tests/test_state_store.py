@@ -0,0 +1,106 @@
+import json
+from functools import partial
+
+import pytest
+
+import state as state_module
+from loop import Loop
+from state import State
+from state_store import SqliteStateStore
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / 'state.db')
+
+
+@pytest.fixture
+def make_state(monkeypatch, db_path):
+    monkeypatch.setattr(state_module.configs, 'state_backend', 'sqlite')
+    monkeypatch.setattr(state_module, 'SqliteStateStore', partial(SqliteStateStore, db_path))
+    return lambda: State(Loop())
+
+
+class TestSqliteStateStore:
+    def test_round_trip(self, make_state):
+        state = make_state()
+        state.is_thread_modified_cache_update('po', {'no': 1, 'last_modified': 100})
+        state.set_thread_stats('po', 1, replies=10, images=None, most_recent_reply_no=100)
+        state.update_thread_meta('po', {1: 3}, {1: {'no': 1, 'last_modified': 100}})
+        state.set_http_last_modified('https://a.4cdn.org/po/thread/1.json', 'Wed, 21 Oct 2015 07:28:00 GMT')
+        state.save()
+
+        state = make_state()
+
+        assert state.thread_cache == {'po': {1: 100}}
+        assert state.get_thread_stats('po', 1) == {'replies': 10, 'most_recent_reply_no': 100}
+        assert state.get_thread_meta('po', 1) == [3, 100]
+        assert state.get_thread_url_last_modified('po', 1) == 'Wed, 21 Oct 2015 07:28:00 GMT'
+
+    def test_saves_only_changes(self, make_state, db_path):
+        state = make_state()
+        for tid in range(1, 4):
+            state.is_thread_modified_cache_update('po', {'no': tid, 'last_modified': 100})
+        state.save()
+
+        assert not state.dirty_thread_cache
+
+        state.is_thread_modified_cache_update('po', {'no': 1, 'last_modified': 100})
+        state.is_thread_modified_cache_update('po', {'no': 2, 'last_modified': 200})
+        state.remove_thread_cache('po', 3)
+
+        assert state.dirty_thread_cache == {'po': {2, 3}}
+
+        state.save()
+        assert make_state().thread_cache == {'po': {1: 100, 2: 200}}
+
+    def test_http_cache_keeps_eviction_order(self, make_state):
+        state = make_state()
+        for i in range(510):
+            state.set_http_last_modified(f'https://a.4cdn.org/po/thread/{i}.json', 'Wed, 21 Oct 2015 07:28:00 GMT')
+        state.save()
+
+        http_cache = make_state().http_cache
+
+        assert len(http_cache) == 500
+        assert list(http_cache) == list(state.http_cache)
+
+    def test_carries_over_json_caches(self, make_state, tmp_path):
+        thread_cache_filepath = tmp_path / 'thread_cache.json'
+        with open(thread_cache_filepath, 'w') as f:
+            json.dump({'po': {'1': 100, '2': 200}}, f)
+
+        state = make_state()
+        state.thread_cache_filepath = str(thread_cache_filepath)
+        state.read()
+        state.save()
+
+        assert make_state().thread_cache == {'po': {1: 100, 2: 200}}
+
+    def test_checkpoint_writes_only_its_board(self, make_state):
+        state = make_state()
+        for board in ('po', 'g'):
+            state.is_thread_modified_cache_update(board, {'no': 1, 'last_modified': 100})
+            state.set_http_last_modified(f'https://a.4cdn.org/{board}/thread/1.json', 'Wed, 21 Oct 2015 07:28:00 GMT', board=board)
+
+        state.checkpoint('po')
+
+        saved = make_state()
+        assert saved.thread_cache == {'po': {1: 100}}
+        assert list(saved.http_cache) == ['https://a.4cdn.org/po/thread/1.json']
+        assert state.dirty_thread_cache == {'g': {1}}
+
+    def test_discard_board_changes(self, make_state):
+        state = make_state()
+        state.is_thread_modified_cache_update('po', {'no': 1, 'last_modified': 100})
+        state.save()
+
+        state.is_thread_modified_cache_update('po', {'no': 1, 'last_modified': 200})
+        state.set_thread_stats('po', 1, replies=10, images=None, most_recent_reply_no=100)
+        state.set_http_last_modified('https://a.4cdn.org/po/thread/1.json', 'Wed, 21 Oct 2015 07:28:00 GMT', board='po')
+        state.discard_board_changes('po')
+
+        # seen as a new thread, so it's fetched again in full
+        assert state.is_thread_modified_cache_update('po', {'no': 1, 'last_modified': 200})
+        assert state.get_thread_stats('po', 1) is None
+        assert state.get_thread_url_last_modified('po', 1) is None
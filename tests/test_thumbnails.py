@@ -0,0 +1,153 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import thumbnails
+from thumbnails import ThumbnailQueue
+
+
+@pytest.fixture(autouse=True)
+def mock_configs(monkeypatch):
+    cfg = SimpleNamespace(logger=SimpleNamespace(info=lambda s: None, error=lambda s: None))
+    monkeypatch.setattr('thumbnails.configs', cfg)
+    return cfg
+
+
+class TestThumbnailQueue:
+    def test_submit_does_not_wait(self, monkeypatch):
+        release = threading.Event()
+        made = []
+
+        def make_thumbnail(job):
+            release.wait()
+            made.append(job.full_path)
+
+        monkeypatch.setattr(thumbnails, 'make_thumbnail', make_thumbnail)
+        thumbnail_queue = ThumbnailQueue(workers=1, max_pending=2, backlog_size=100, max_attempts=1, retry_delay_s=0)
+
+        for i in range(5):
+            thumbnail_queue.submit(f'{i}.webm', f'{i}.jpg')
+
+        stats = thumbnail_queue.get_stats()
+        assert stats['pending'] == 2
+        assert stats['backlog'] == 3
+
+        release.set()
+        thumbnail_queue.join()
+        thumbnail_queue.shutdown()
+
+        assert sorted(made) == [f'{i}.webm' for i in range(5)]
+        assert thumbnail_queue.get_stats()['created'] == 5
+
+    def test_retries_failures(self, monkeypatch):
+        attempts = []
+
+        def make_thumbnail(job):
+            attempts.append(job.full_path)
+            if job.attempts < 3:
+                raise RuntimeError('convert failed')
+
+        monkeypatch.setattr(thumbnails, 'make_thumbnail', make_thumbnail)
+        thumbnail_queue = ThumbnailQueue(workers=1, max_pending=1, backlog_size=100, max_attempts=3, retry_delay_s=0)
+
+        thumbnail_queue.submit('1.png', '1.jpg')
+        thumbnail_queue.join()
+        thumbnail_queue.shutdown()
+
+        stats = thumbnail_queue.get_stats()
+        assert attempts == ['1.png'] * 3
+        assert stats['errors'] == 2
+        assert stats['created'] == 1
+
+    def test_gives_up_after_max_attempts(self, monkeypatch):
+        def make_thumbnail(job):
+            raise RuntimeError('convert failed')
+
+        monkeypatch.setattr(thumbnails, 'make_thumbnail', make_thumbnail)
+        thumbnail_queue = ThumbnailQueue(workers=2, max_pending=2, backlog_size=100, max_attempts=2, retry_delay_s=0)
+
+        thumbnail_queue.submit('1.png', '1.jpg')
+        thumbnail_queue.join()
+        thumbnail_queue.shutdown()
+
+        assert thumbnail_queue.get_stats() == dict(pending=0, backlog=0, retrying=0, created=0, errors=2, dropped=0, rejected=0)
+
+    def test_drops_oldest_when_backlog_is_full(self, monkeypatch):
+        release = threading.Event()
+        monkeypatch.setattr(thumbnails, 'make_thumbnail', lambda job: release.wait())
+        thumbnail_queue = ThumbnailQueue(workers=1, max_pending=1, backlog_size=2, max_attempts=1, retry_delay_s=0)
+
+        for i in range(4):
+            thumbnail_queue.submit(f'{i}.png', f'{i}.jpg')
+
+        assert [job.full_path for job in thumbnail_queue.backlog] == ['2.png', '3.png']
+        assert thumbnail_queue.get_stats()['dropped'] == 1
+
+        release.set()
+        thumbnail_queue.join()
+        thumbnail_queue.shutdown()
+
+    def test_retries_back_off(self, monkeypatch):
+        attempt_times = []
+
+        def make_thumbnail(job):
+            attempt_times.append(time.monotonic())
+            raise RuntimeError('convert failed')
+
+        monkeypatch.setattr(thumbnails, 'make_thumbnail', make_thumbnail)
+        thumbnail_queue = ThumbnailQueue(workers=1, max_pending=1, backlog_size=100, max_attempts=3, retry_delay_s=0.05)
+
+        thumbnail_queue.submit('1.png', '1.jpg')
+        thumbnail_queue.join()
+        thumbnail_queue.shutdown()
+
+        assert len(attempt_times) == 3
+        assert attempt_times[1] - attempt_times[0] >= 0.05
+        assert attempt_times[2] - attempt_times[1] >= 0.1
+
+    def test_retry_does_not_hold_a_worker(self, monkeypatch):
+        made = []
+
+        def make_thumbnail(job):
+            if job.full_path == 'bad.png':
+                raise RuntimeError('convert failed')
+            made.append(job.full_path)
+
+        monkeypatch.setattr(thumbnails, 'make_thumbnail', make_thumbnail)
+        thumbnail_queue = ThumbnailQueue(workers=1, max_pending=1, backlog_size=100, max_attempts=2, retry_delay_s=60)
+
+        thumbnail_queue.submit('bad.png', 'bad.jpg')
+        for i in range(3):
+            thumbnail_queue.submit(f'{i}.png', f'{i}.jpg')
+
+        # the others are made while bad.png waits to be retried
+        while len(made) < 3:
+            time.sleep(0.01)
+
+        stats = thumbnail_queue.get_stats()
+        assert stats['retrying'] == 1
+        assert stats['pending'] == 0
+
+        thumbnail_queue.shutdown()
+        assert thumbnail_queue.get_stats()['retrying'] == 0
+
+    def test_missing_source_fails(self, tmp_path):
+        thumbnail_queue = ThumbnailQueue(workers=0, max_pending=1, backlog_size=100, max_attempts=1, retry_delay_s=0)
+        thumbnail_queue.submit(str(tmp_path / '1.png'), str(tmp_path / '1s.jpg'))
+
+        stats = thumbnail_queue.get_stats()
+        assert stats['created'] == 0
+        assert stats['errors'] == 1
+
+    def test_rejects_after_shutdown(self, monkeypatch):
+        made = []
+        monkeypatch.setattr(thumbnails, 'make_thumbnail', lambda job: made.append(job.full_path))
+        thumbnail_queue = ThumbnailQueue(workers=1, max_pending=1, backlog_size=100, max_attempts=1, retry_delay_s=0)
+        thumbnail_queue.shutdown()
+
+        thumbnail_queue.submit('1.png', '1.jpg')
+
+        assert not made
+        assert thumbnail_queue.get_stats()['rejected'] == 1
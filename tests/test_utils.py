@@ -0,0 +1,223 @@
+import html
+import os
+import random
+import re
+
+import pytest
+
+from utils import (
+    convert_to_asagi_comment,
+    extract_text_from_html,
+    extract_text_from_html_stdlib,
+    fetch_media_to_file,
+    get_md5_b64_hash,
+    html_to_text
+)
+
+
+def get_fixture_texts(catalog_json: list[dict], thread_json: dict) -> list[str]:
+    threads = [thread for page in catalog_json for thread in page['threads']]
+    posts = threads + [reply for thread in threads for reply in thread.get('last_replies', [])] + thread_json['posts']
+    return [post[key] for post in posts for key in ('sub', 'com') if post.get(key)]
+
+
+class TestHtmlToText:
+    def test_matches_stdlib_on_fixtures(self, catalog_json, thread_json):
+        texts = get_fixture_texts(catalog_json, thread_json)
+
+        assert texts
+        for text in texts:
+            assert html_to_text(text) == extract_text_from_html_stdlib(text), text
+
+    @pytest.mark.parametrize('html_str', [
+        '',
+        '<a href="#p123" class="quotelink">&gt;&gt;123</a><br>based',
+        '<span class="quote">&gt;implying</span><br><br><s>spoiler</s>',
+        '<pre class="prettyprint">if (a &lt; b &amp;&amp; c)<br>  return;</pre>',
+        'long<wbr>url',
+        '&amp;lt;double escaped&amp;gt;',
+        # html.parser holds back a trailing unterminated `&`
+        'salt & pepper<br>fish&chips',
+        'fish&chips',
+        'fish & chips',
+    ])
+    def test_matches_stdlib(self, html_str):
+        assert html_to_text(html_str) == extract_text_from_html_stdlib(html_str)
+
+    def test_matches_stdlib_on_random_markup(self):
+        # like 4chan's sub and com, every `<` starts a tag
+        fragments = [
+            'text', ' ', '\n', '>', '&', '&gt;', '&lt;', '&amp;', '&#039;', '&quot;', 'fish&chips',
+            '<br>', '<wbr>', '<s>', '</s>', '</span>', '</a>', '</pre>', '<span class="quote">',
+            '<a href="#p123" class="quotelink">', '<pre class="prettyprint">', '<!-- comment -->',
+        ]
+        rng = random.Random(12)
+        for _ in range(2000):
+            html_str = ''.join(rng.choice(fragments) for _ in range(rng.randint(0, 12)))
+            assert html_to_text(html_str) == extract_text_from_html_stdlib(html_str), html_str
+
+    @pytest.mark.parametrize('html_str, expected, expected_stdlib', [
+        ('a<b', 'a<b', 'a'),
+        ('<p', '<p', ''),
+        ('a < b', 'a < b', 'a  <  b'),
+        ('a<!--b', 'a<!--b', 'a'),
+    ])
+    def test_unescaped_lt_differs_from_stdlib(self, html_str, expected, expected_stdlib):
+        # out of scope, 4chan escapes `<` that doesn't start a tag
+        assert html_to_text(html_str) == expected
+        assert extract_text_from_html_stdlib(html_str) == expected_stdlib
+
+    def test_cached(self):
+        extract_text_from_html.cache_clear()
+        extract_text_from_html('<br>cached')
+        extract_text_from_html('<br>cached')
+
+        assert extract_text_from_html.cache_info().hits == 1
+
+
+def convert_to_asagi_comment_legacy(a):
+    """`convert_to_asagi_comment()` before it was optimized, kept to test against."""
+    if not a:
+        return a
+
+    if "[" in a:
+        a = re.sub(
+            "\\[(/?(spoiler|code|math|eqn|sub|sup|b|i|o|s|u|banned|info|fortune|shiftjis|sjis|qstcolor))\\]",
+            "[\\1:lit]",
+            a
+        )
+
+    if "\"abbr" in a: a = re.sub("((<br>){0-2})?<span class=\"abbr\">(.*?)</span>", "", a)
+    if "\"exif" in a: a = re.sub("((<br>)+)?<table class=\"exif\"(.*?)</table>", "", a)
+    if ">Oek" in a: a = re.sub("((<br>)+)?<small><b>Oekaki(.*?)</small>", "", a)
+
+    if "<stro" in a:
+        a = re.sub("<strong style=\"color: ?red;?\">(.*?)</strong>", "[banned]\\1[/banned]", a)
+
+    if "\"fortu" in a:
+        a = re.sub(
+            "<span class=\"fortune\" style=\"color:(.+?)\"><br><br><b>(.*?)</b></span>",
+            "\n\n[fortune color=\"\\1\"]\\2[/fortune]",
+            a
+        )
+
+    if "<b>" in a:
+        a = re.sub("<b>(Roll(.*?))</b>", "[b]\\1[/b]", a)
+
+    if "<pre" in a:
+        a = re.sub("<pre[^>]*>", "[code]", a)
+        a = a.replace("</pre>", "[/code]")
+
+    if "\"math" in a:
+        a = re.sub("<span class=\"math\">(.*?)</span>", "[math]\\1[/math]", a)
+        a = re.sub("<div class=\"math\">(.*?)</div>", "[eqn]\\1[/eqn]", a)
+
+    if "\"sjis" in a:
+        a = re.sub("<span class=\"sjis\">(.*?)</span>", "[shiftjis]\\1[/shiftjis]", a)
+
+    if "<span" in a:
+        a = re.sub("<span class=\"quote\">(.*?)</span>", "\\1", a)
+
+        for idx in range(3):
+            if not "deadli" in a: break
+            a = re.sub("<span class=\"(?:[^\"]*)?deadlink\">(.*?)</span>", "\\1", a)
+
+    if "<a" in a:
+        a = re.sub("<a(?:[^>]*)>(.*?)</a>", "\\1", a)
+
+    a = a.replace("<s>", "[spoiler]")
+    a = a.replace("</s>", "[/spoiler]")
+
+    a = a.replace("<br>", "\n")
+    a = a.replace("<br/>", "\n")
+    a = a.replace("<wbr>", "")
+
+    a = html.unescape(a)
+
+    return a
+
+
+COMMENT_FRAGMENTS = [
+    'text', ' ', '&gt;', '&lt;', '&amp;', '&#039;', '&quot;', '[b]', '[/spoiler]', '\n', '<', '>',
+    '<br>', '<br/>', '<wbr>', '<s>', '</s>', '<b>', '</b>', '<b>Roll', '</span>', '</a>', '</pre>',
+    '<span class="quote">', '<span class="deadlink">', '<span class="quote deadlink">', '<span class="sjis">',
+    '<a href="#p123" class="quotelink">', '<a href="/g/thread/1#p2" class="quotelink">', '<abbr>',
+    '<pre class="prettyprint">', '<span class="math">', '<div class="math">', '</div>',
+    '<strong style="color: red;">', '</strong>', '<span class="abbr">', '<small><b>Oekaki', '</small>',
+    '<span class="fortune" style="color:#ff0000"><br><br><b>', 'Your fortune: Good Luck',
+]
+
+# quotes, links, spoilers, and line breaks, mostly converted in one pass
+SINGLE_PASS_FRAGMENTS = [
+    'text', ' ', '&gt;', '&amp;', '&#039;', '[s]', '<', '<br>', '<wbr>', '<s>', '</s>', '</span>', '</a>',
+    '<span class="quote">', '<span class="deadlink">', '<a href="#p123" class="quotelink">', '<a>', '<abbr>',
+]
+
+
+
+class TestConvertToAsagiComment:
+    def test_matches_legacy_on_fixtures(self, catalog_json, thread_json):
+        comments = [text for text in get_fixture_texts(catalog_json, thread_json) if '<' in text]
+
+        assert comments
+        for comment in comments:
+            assert convert_to_asagi_comment(comment) == convert_to_asagi_comment_legacy(comment), comment
+
+    @pytest.mark.parametrize('fragments', [COMMENT_FRAGMENTS, SINGLE_PASS_FRAGMENTS])
+    def test_matches_legacy_on_generated_comments(self, fragments):
+        rng = random.Random(0)
+        for _ in range(20_000):
+            comment = ''.join(rng.choice(fragments) for _ in range(rng.randint(0, 16)))
+            assert convert_to_asagi_comment(comment) == convert_to_asagi_comment_legacy(comment), comment
+
+    @pytest.mark.parametrize('comment', [None, '', 'no markup'])
+    def test_passthrough(self, comment):
+        assert convert_to_asagi_comment(comment) == comment
+
+
+class FakeResponse:
+    def __init__(self, content: bytes, status_code: int=200):
+        self.content = content
+        self.status_code = status_code
+        self.headers = {}
+
+    def iter_content(self, chunk_size: int):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+
+class FakeSession:
+    def __init__(self, resp: FakeResponse):
+        self.resp = resp
+
+    def get(self, url, headers=None, stream=False):
+        return self.resp
+
+
+class TestFetchMediaToFile:
+    def test_streams_and_hashes(self, tmp_path):
+        content = os.urandom(10_000)
+        session = FakeSession(FakeResponse(content))
+
+        tmp_filepath, fsize, md5_b64 = fetch_media_to_file('url', str(tmp_path), '1.webm', session=session, chunk_size=1024)
+
+        assert os.path.dirname(tmp_filepath) == str(tmp_path)
+        assert fsize == len(content)
+        assert md5_b64 == get_md5_b64_hash(content)
+        with open(tmp_filepath, 'rb') as f:
+            assert f.read() == content
+
+    def test_removes_temp_file_over_max_bytes(self, tmp_path):
+        session = FakeSession(FakeResponse(b'x' * 5000))
+
+        assert fetch_media_to_file('url', str(tmp_path), '1.webm', session=session, max_bytes=4096, chunk_size=1024) is None
+        assert os.listdir(tmp_path) == []
+
+    def test_bad_status(self, tmp_path):
+        session = FakeSession(FakeResponse(b'x', status_code=404))
+
+        assert fetch_media_to_file('url', str(tmp_path), '1.webm', session=session) is None
+        assert os.listdir(tmp_path) == []
@@ -0,0 +1,232 @@
+import heapq
+import itertools
+import os
+import threading
+import time
+import traceback
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import configs
+from utils import (
+    create_thumbnail_from_image,
+    create_thumbnail_from_video,
+    is_image_path,
+    is_video_path,
+    makedir_p,
+)
+
+
+class ThumbnailJob:
+    __slots__ = ('full_path', 'thumb_path', 'attempts', 'retry_at')
+
+    def __init__(self, full_path: str, thumb_path: str):
+        self.full_path = full_path
+        self.thumb_path = thumb_path
+        self.attempts = 0
+
+        # monotonic, a failed thumbnail isn't tried again before then
+        self.retry_at = 0.0
+
+
+def make_thumbnail(job: ThumbnailJob):
+    """Raises if ffmpeg or convert fail, or the full media is missing."""
+    if not os.path.isfile(job.full_path):
+        raise FileNotFoundError(job.full_path)
+
+    makedir_p(os.path.dirname(job.thumb_path))
+
+    if is_video_path(job.full_path):
+        create_thumbnail_from_video(job.full_path, job.thumb_path, logger=configs.logger, raise_errors=True)
+    elif is_image_path(job.full_path):
+        create_thumbnail_from_image(job.full_path, job.thumb_path, logger=configs.logger, raise_errors=True)
+
+
+class ThumbnailQueue:
+    """
+    Makes thumbnails on `workers` threads, each waiting on its own ffmpeg/convert process, so saving media never does.
+
+    - At most `max_pending` thumbnails are handed to the workers at once, like `migrations/create_thumbs.py`.
+    - `submit()` never blocks. Past `max_pending`, thumbnails wait in a backlog, and workers take from it as they finish.
+      Once the backlog holds `backlog_size`, the oldest are dropped, `migrations/create_thumbs.py` can make them later.
+    - A failed thumbnail is tried up to `max_attempts` times. It waits `retry_delay_s` before the 2nd attempt,
+      doubling for each one after, apart from the backlog, so no worker waits on it. Once due, it goes before the backlog.
+    - With `workers=0`, thumbnails are made in `submit()`, and aren't retried.
+    - After `shutdown()`, submitted thumbnails are counted as rejected, and not made.
+    """
+    def __init__(self, workers: int, max_pending: int, backlog_size: int, max_attempts: int, retry_delay_s: float):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.retry_delay_s = retry_delay_s
+
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='thumb') if workers else None
+
+        self.lock = threading.Lock()
+        self.backlog: deque[ThumbnailJob] = deque(maxlen=backlog_size)
+        self.pending_count = 0
+        self.created_count = 0
+        self.error_count = 0
+        self.dropped_count = 0
+        self.rejected_count = 0
+        self.closed = False
+
+        # failed thumbnails, (retry_at, order, job), started once due, see `add_retry()`
+        self.retries: list[tuple[float, int, ThumbnailJob]] = []
+        self.retry_order = itertools.count()
+        self.retry_timers: set[threading.Timer] = set()
+
+
+    def submit(self, full_path: str, thumb_path: str):
+        job = ThumbnailJob(full_path, thumb_path)
+
+        if not self.pool:
+            self.run(job)
+            return
+
+        with self.lock:
+            if self.closed:
+                self.rejected_count += 1
+                configs.logger.info(f'Thumbnail rejected, the queue is shut down: {full_path}')
+                return
+            if self.pending_count >= self.max_pending:
+                self.add_to_backlog(job)
+                return
+            self.pending_count += 1
+
+        self.start(job)
+
+
+    def add_to_backlog(self, job: ThumbnailJob):
+        if len(self.backlog) == self.backlog.maxlen:
+            self.dropped_count += 1
+        self.backlog.append(job)
+
+
+    def add_retry(self, job: ThumbnailJob):
+        """Called with the lock held. A timer starts the retry once it's due, if a worker is free by then."""
+        if len(self.retries) >= self.backlog.maxlen:
+            self.dropped_count += 1
+            return
+
+        delay = self.retry_delay_s * 2 ** (job.attempts - 1)
+        job.retry_at = time.monotonic() + delay
+        heapq.heappush(self.retries, (job.retry_at, next(self.retry_order), job))
+
+        timer = threading.Timer(delay, self.start_due_retries)
+        timer.daemon = True
+        self.retry_timers.add(timer)
+        timer.start()
+
+
+    def start_due_retries(self):
+        """Runs on a retry's timer. Retries that don't get a worker here are taken by workers as they finish."""
+        jobs = []
+        with self.lock:
+            self.retry_timers.discard(threading.current_thread())
+            while not self.closed and self.pending_count < self.max_pending and self.retries and self.retries[0][0] <= time.monotonic():
+                jobs.append(heapq.heappop(self.retries)[2])
+                self.pending_count += 1
+
+        for job in jobs:
+            self.start(job)
+
+
+    def take_next_job(self) -> ThumbnailJob | None:
+        """Called with the lock held. A due retry, or else the oldest thumbnail in the backlog."""
+        if self.closed:
+            return None
+        if self.retries and self.retries[0][0] <= time.monotonic():
+            return heapq.heappop(self.retries)[2]
+        if self.backlog:
+            return self.backlog.popleft()
+        return None
+
+
+    def start(self, job: ThumbnailJob):
+        try:
+            future = self.pool.submit(self.run, job)
+        except RuntimeError:
+            # shut down while starting the next thumbnail
+            with self.lock:
+                self.pending_count -= 1
+            return
+        future.add_done_callback(lambda f: self.on_done(f, job))
+
+
+    def run(self, job: ThumbnailJob) -> bool:
+        job.attempts += 1
+        try:
+            make_thumbnail(job)
+            with self.lock:
+                self.created_count += 1
+            return True
+        except Exception as e:
+            with self.lock:
+                self.error_count += 1
+            configs.logger.error(f'Thumbnail failed, attempt {job.attempts}/{self.max_attempts}: {job.full_path} - {e}')
+            configs.logger.error(traceback.format_exc())
+            return False
+
+
+    def on_done(self, future: Future, job: ThumbnailJob):
+        """Runs on the worker that finished `job`, and starts the next thumbnail in the backlog."""
+        failed = future.cancelled() or not future.result()
+
+        with self.lock:
+            if failed and not future.cancelled() and not self.closed and job.attempts < self.max_attempts:
+                self.add_retry(job)
+
+            next_job = self.take_next_job()
+            if not next_job:
+                self.pending_count -= 1
+
+        if next_job:
+            self.start(next_job)
+
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return dict(
+                pending=self.pending_count,
+                backlog=len(self.backlog),
+                retrying=len(self.retries),
+                created=self.created_count,
+                errors=self.error_count,
+                dropped=self.dropped_count,
+                rejected=self.rejected_count,
+            )
+
+
+    def log_stats(self):
+        stats = self.get_stats()
+        configs.logger.info(
+            f'Thumbnails: {stats["pending"]} pending, {stats["backlog"]} in backlog, {stats["retrying"]} waiting to retry, '
+            f'{stats["created"]} created, {stats["errors"]} failed, {stats["dropped"]} dropped, {stats["rejected"]} rejected'
+        )
+
+
+    def join(self):
+        """Waits for every thumbnail, including the backlog and retries. New ones can still be submitted meanwhile."""
+        while True:
+            with self.lock:
+                if not self.pending_count and not self.retries:
+                    return
+            time.sleep(0.05)
+
+
+    def shutdown(self):
+        """Lets running thumbnails finish, and drops the backlog. Only for exiting, the queue can't be restarted."""
+        with self.lock:
+            self.closed = True
+            for timer in self.retry_timers:
+                timer.cancel()
+            self.retry_timers.clear()
+
+            if queued_count := len(self.backlog) + len(self.retries):
+                configs.logger.info(f'Dropping {queued_count} queued thumbnail(s)')
+            self.backlog.clear()
+            self.retries.clear()
+
+        if self.pool:
+            self.pool.shutdown(wait=True)
@@ -10,8 +10,9 @@ import re
 import secrets
 import string
 import subprocess
+import tempfile
 import time
-from collections import OrderedDict
+from functools import lru_cache
 from logging.handlers import RotatingFileHandler
 from typing import Annotated, Literal
 
@@ -21,6 +22,7 @@ from requests import get as requests_get
 
 from enums import MediaType
 from logging import Logger
+from rate_limiter import RateLimiter
 
 
 def is_post_media_file_video(post):
@@ -46,69 +48,155 @@ def convert_to_asagi_capcode(a):
     return "N"
 
 
+# compiled once, `convert_to_asagi_comment()` runs on every post of every upsert
+asagi_lit_re = re.compile("\\[(/?(spoiler|code|math|eqn|sub|sup|b|i|o|s|u|banned|info|fortune|shiftjis|sjis|qstcolor))\\]")
+asagi_abbr_re = re.compile("((<br>){0-2})?<span class=\"abbr\">(.*?)</span>")
+asagi_exif_re = re.compile("((<br>)+)?<table class=\"exif\"(.*?)</table>")
+asagi_oekaki_re = re.compile("((<br>)+)?<small><b>Oekaki(.*?)</small>")
+asagi_banned_re = re.compile("<strong style=\"color: ?red;?\">(.*?)</strong>")
+asagi_fortune_re = re.compile("<span class=\"fortune\" style=\"color:(.+?)\"><br><br><b>(.*?)</b></span>")
+asagi_dice_re = re.compile("<b>(Roll(.*?))</b>")
+asagi_code_re = re.compile("<pre[^>]*>")
+asagi_math_re = re.compile("<span class=\"math\">(.*?)</span>")
+asagi_eqn_re = re.compile("<div class=\"math\">(.*?)</div>")
+asagi_sjis_re = re.compile("<span class=\"sjis\">(.*?)</span>")
+asagi_quote_re = re.compile("<span class=\"quote\">(.*?)</span>")
+asagi_deadlink_re = re.compile("<span class=\"(?:[^\"]*)?deadlink\">(.*?)</span>")
+asagi_link_re = re.compile("<a(?:[^>]*)>(.*?)</a>")
+
+asagi_tag_2_bbcode = {
+    "<s>": "[spoiler]",
+    "</s>": "[/spoiler]",
+    "<br>": "\n",
+    "<br/>": "\n",
+    "<wbr>": "",
+}
+
+# single pass conversion, see `convert_to_asagi_comment()`
+asagi_tag_split_re = re.compile("(<[^>]*>)")
+asagi_span_open_re = re.compile("<span class=\"(?:quote|[^\"]*deadlink)\">")
+asagi_link_open_re = re.compile("<a(?: [^>]*)?>")
+# comments with any of these go through every rule, `.` in the rules doesn't match newlines
+asagi_full_rule_markers = ("\"abbr", "\"exif", ">Oek", "<stro", "\"fortu", "<b>", "<pre", "\"math", "\"sjis", "\n")
+
+
+def convert_to_asagi_comment_single_pass(a: str) -> str | None:
+    """
+    Converts comments made of only quotes, links, spoilers, and line breaks, i.e. most comments, in one pass over their tags.
+    Returns `None` for anything else, to be converted with every rule.
+
+    For these comments the rules come down to dropping span and link tags, as long as spans don't nest, and links don't nest.
+    4chan escapes `<` in text, so any other `<` is left for the full rules.
+    """
+    for marker in asagi_full_rule_markers:
+        if marker in a:
+            return None
+
+    parts = asagi_tag_split_re.split(a)
+
+    # a `<` outside of a tag
+    if a.count("<") != len(parts) // 2:
+        return None
+
+    in_span = False
+    in_link = False
+
+    for i in range(1, len(parts), 2):
+        tag = parts[i]
+
+        if tag in asagi_tag_2_bbcode:
+            parts[i] = asagi_tag_2_bbcode[tag]
+        elif tag == "</span>":
+            if not in_span:
+                return None
+            in_span = False
+            parts[i] = ""
+        elif tag == "</a>":
+            if not in_link:
+                return None
+            in_link = False
+            parts[i] = ""
+        elif asagi_span_open_re.fullmatch(tag):
+            if in_span:
+                return None
+            in_span = True
+            parts[i] = ""
+        elif asagi_link_open_re.fullmatch(tag):
+            if in_link:
+                return None
+            in_link = True
+            parts[i] = ""
+        else:
+            return None
+
+    if in_span or in_link:
+        return None
+
+    return "".join(parts)
+
+
 def convert_to_asagi_comment(a):
     if not a:
         return a
 
     # literal tags
     if "[" in a:
-        a = re.sub(
-            "\\[(/?(spoiler|code|math|eqn|sub|sup|b|i|o|s|u|banned|info|fortune|shiftjis|sjis|qstcolor))\\]",
-            "[\\1:lit]",
-            a
-        )
+        a = asagi_lit_re.sub("[\\1:lit]", a)
+
+    # every conversion below starts at a tag
+    if "<" in a:
+        converted = convert_to_asagi_comment_single_pass(a)
+        a = converted if converted is not None else convert_asagi_tags(a)
+
+    a = html.unescape(a)
+
+    return a
+
 
+def convert_asagi_tags(a: str) -> str:
     # abbr, exif, oekaki
-    if "\"abbr" in a: a = re.sub("((<br>){0-2})?<span class=\"abbr\">(.*?)</span>", "", a)
-    if "\"exif" in a: a = re.sub("((<br>)+)?<table class=\"exif\"(.*?)</table>", "", a)
-    if ">Oek" in a: a = re.sub("((<br>)+)?<small><b>Oekaki(.*?)</small>", "", a)
+    if "\"abbr" in a: a = asagi_abbr_re.sub("", a)
+    if "\"exif" in a: a = asagi_exif_re.sub("", a)
+    if ">Oek" in a: a = asagi_oekaki_re.sub("", a)
 
     # banned
     if "<stro" in a:
-        a = re.sub("<strong style=\"color: ?red;?\">(.*?)</strong>", "[banned]\\1[/banned]", a)
+        a = asagi_banned_re.sub("[banned]\\1[/banned]", a)
 
     # fortune
     if "\"fortu" in a:
-        a = re.sub(
-            "<span class=\"fortune\" style=\"color:(.+?)\"><br><br><b>(.*?)</b></span>",
-            "\n\n[fortune color=\"\\1\"]\\2[/fortune]",
-            a
-        )
+        a = asagi_fortune_re.sub("\n\n[fortune color=\"\\1\"]\\2[/fortune]", a)
 
     # dice roll
     if "<b>" in a:
-        a = re.sub(
-            "<b>(Roll(.*?))</b>",
-            "[b]\\1[/b]",
-            a
-        )
+        a = asagi_dice_re.sub("[b]\\1[/b]", a)
 
     # code tags
     if "<pre" in a:
-        a = re.sub("<pre[^>]*>", "[code]", a)
+        a = asagi_code_re.sub("[code]", a)
         a = a.replace("</pre>", "[/code]")
 
     # math tags
     if "\"math" in a:
-        a = re.sub("<span class=\"math\">(.*?)</span>", "[math]\\1[/math]", a)
-        a = re.sub("<div class=\"math\">(.*?)</div>", "[eqn]\\1[/eqn]", a)
+        a = asagi_math_re.sub("[math]\\1[/math]", a)
+        a = asagi_eqn_re.sub("[eqn]\\1[/eqn]", a)
 
     # sjis tags
     if "\"sjis" in a:
-        a = re.sub("<span class=\"sjis\">(.*?)</span>", "[shiftjis]\\1[/shiftjis]", a) # use [sjis] maybe?
+        a = asagi_sjis_re.sub("[shiftjis]\\1[/shiftjis]", a) # use [sjis] maybe?
 
     # quotes & deadlinks
     if "<span" in a:
-        a = re.sub("<span class=\"quote\">(.*?)</span>", "\\1", a)
+        a = asagi_quote_re.sub("\\1", a)
 
         # hacky fix for deadlinks inside quotes
         for idx in range(3):
             if not "deadli" in a: break
-            a = re.sub("<span class=\"(?:[^\"]*)?deadlink\">(.*?)</span>", "\\1", a)
+            a = asagi_deadlink_re.sub("\\1", a)
 
     # other links
     if "<a" in a:
-        a = re.sub("<a(?:[^>]*)>(.*?)</a>", "\\1", a)
+        a = asagi_link_re.sub("\\1", a)
 
     # spoilers
     a = a.replace("<s>", "[spoiler]")
@@ -119,8 +207,6 @@ def convert_to_asagi_comment(a):
     a = a.replace("<br/>", "\n")
     a = a.replace("<wbr>", "")
 
-    a = html.unescape(a)
-
     return a
 
 
@@ -186,6 +272,19 @@ def get_d_board(post: dict, media_id: int | None = None, unescape_data_b4_db_wri
     }
 
 
+def get_post_fingerprint(post: dict) -> int:
+    """Changes when any field the API can change on an existing post, and that `get_d_board()` writes, changes."""
+    return hash((
+        post.get('com'),
+        post.get('filedeleted'),
+        post.get('sticky'),
+        post.get('closed'),
+        post.get('archived_on'),
+        post.get('unique_ips'),
+        post.get('spoiler'),
+    ))
+
+
 def get_thread_id_2_last_replies(catalog):
     thread_id_2_last_replies = {}
     for page in catalog:
@@ -218,7 +317,26 @@ ShortStr = Annotated[str, msgspec.Meta(min_length=0, max_length=512)]
 LongStr = Annotated[str, msgspec.Meta(min_length=0, max_length=16_384)]
 
 
-class BasePost(msgspec.Struct, kw_only=True):
+class DictLikeStruct(msgspec.Struct, gc=False):
+    """
+    Lets decoded structs stand in for API dicts, e.g. `post.get('com')`, `post['no']`, `'tim' in post`.
+    `None` fields act like missing keys, so `post.get('replies', 0)` still returns `0`.
+    """
+    def get(self, key: str, default=None):
+        value = getattr(self, key, None)
+        return default if value is None else value
+
+    def __getitem__(self, key: str):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __contains__(self, key: str) -> bool:
+        return getattr(self, key, None) is not None
+
+
+class BasePost(DictLikeStruct, kw_only=True):
     no: PositiveInt
     resto: NonNegativeInt
     sticky: ZeroOrOne | None = None
@@ -273,6 +391,22 @@ class ChanThread(BasePost):
     last_replies: list[ChanPost] | None = None
 
 
+class CatalogPage(DictLikeStruct, kw_only=True):
+    '''https://github.com/4chan/4chan-API/blob/master/pages/Catalog.md'''
+    page: PositiveInt | None = None
+    threads: list[ChanThread]
+
+
+class ThreadResponse(DictLikeStruct):
+    '''https://github.com/4chan/4chan-API/blob/master/pages/Threads.md'''
+    posts: list[ChanPost]
+
+
+# decode and validate response bytes straight into structs, instead of json -> dicts -> msgspec.convert()
+catalog_decoder = msgspec.json.Decoder(list[CatalogPage])
+thread_decoder = msgspec.json.Decoder(ThreadResponse)
+
+
 def assert_thumbnail_deps(logger: Logger):
     ffmpeg_path = subprocess.run(['which', 'ffmpeg'], capture_output=True, text=True).stdout.strip()
     convert_path = subprocess.run(['which', 'convert'], capture_output=True, text=True).stdout.strip()
@@ -306,9 +440,21 @@ def setup_logger(logger_name, log_file=False, stdout=True, file_rotate_size=1 *
 
 
 def write_json_obj_to_file(filepath: str, obj):
-    os.makedirs(os.path.dirname(filepath), exist_ok=True)
-    with open(filepath, mode='w', encoding='utf-8') as f:
-        json.dump(obj, f)
+    """Writes to a temp file, then renames it over `filepath`, so a crash mid-write leaves the previous file intact."""
+    dirpath = os.path.dirname(filepath)
+    os.makedirs(dirpath, exist_ok=True)
+
+    fd, tmp_filepath = tempfile.mkstemp(dir=dirpath, prefix=os.path.basename(filepath), suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode='w', encoding='utf-8') as f:
+            json.dump(obj, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filepath, filepath)
+    except BaseException:
+        if os.path.isfile(tmp_filepath):
+            os.remove(tmp_filepath)
+        raise
 
 
 def read_json(fpath) -> dict:
@@ -345,7 +491,8 @@ class TextExtractor(html.parser.HTMLParser):
         return ' '.join(self.text)
 
 
-def extract_text_from_html(html_str: str) -> str:
+def extract_text_from_html_stdlib(html_str: str) -> str:
+    """Reference implementation for `extract_text_from_html()`, see tests."""
     if not html_str:
         return ''
     parser = TextExtractor()
@@ -353,19 +500,75 @@ def extract_text_from_html(html_str: str) -> str:
     return html.unescape(parser.get_text())
 
 
-def fullmatch_sub_and_com(post: dict, pattern: str) -> bool:
-    """Compares a post's raw api data to patterns."""
+# tags as html.parser sees them, 4chan escapes every other `<` in comments
+html_tag_re = re.compile(r'<[a-zA-Z/!?][^>]*>')
+html_charref_end_re = re.compile(r'[\s;]')
+
+
+def html_to_text(html_str: str) -> str:
+    """
+    Matches `extract_text_from_html_stdlib()` for 4chan's comment markup (`<br>`, `<wbr>`, `<span>`, `<a>`, `<s>`, `<pre>`), including its quirks,
+    - text between tags is unescaped, joined with spaces, then unescaped again
+    - the text after the last tag is dropped when it has an `&` in the last 34 chars, not followed by whitespace or `;`.
+      html.parser holds it back, waiting for the rest of a charref, and nothing calls `close()`.
+
+    Input with an unescaped `<` that doesn't start a complete tag, e.g. `a<b`, `<p` or `a < b`, is out of scope.
+    4chan escapes it in sub and com, and html.parser's handling of it isn't reproduced.
+    """
+    if not html_str:
+        return ''
+
+    chunks = html_tag_re.split(html_str)
+
+    if tail := chunks[-1]:
+        n = len(html_str)
+        amppos = html_str.rfind('&', max(n - len(tail), n - 34))
+        if amppos >= 0 and not html_charref_end_re.search(html_str, amppos):
+            chunks[-1] = ''
+
+    return html.unescape(' '.join([html.unescape(chunk) for chunk in chunks if chunk]))
+
+
+@lru_cache(maxsize=8192)
+def extract_text_from_html(html_str: str) -> str:
+    """
+    Cached on the comment itself, whose hash python keeps on the str,
+    so the same comment seen in the catalog and its thread is only converted once.
+    """
+    return html_to_text(html_str)
+
+
+def compile_rule(pattern_or_bool: str | bool | None) -> re.Pattern | bool | None:
+    """Compiles a board config pattern, case-insensitive. Bools pass through, and empty patterns are `None`."""
+    if isinstance(pattern_or_bool, bool):
+        return pattern_or_bool
+
+    if isinstance(pattern_or_bool, str) and pattern_or_bool:
+        return re.compile(pattern_or_bool, re.IGNORECASE)
+
+    return None
+
+
+def fullmatch_sub_and_com(post: dict, pattern: str | re.Pattern, com_text: str | None=None) -> bool:
+    """
+    Compares a post's raw api data to patterns.
+    Pass `com_text`, the comment's `extract_text_from_html()`, if it's already known.
+    """
+    if isinstance(pattern, str):
+        pattern = compile_rule(pattern)
+
     sub = post.get('sub')
     com = post.get('com')
 
     if sub:
         sub_text = html.unescape(sub)
-        if re.fullmatch(pattern, sub_text, re.IGNORECASE):
+        if pattern.fullmatch(sub_text):
             return True
 
     if com:
-        com_text = extract_text_from_html(com)
-        if re.fullmatch(pattern, com_text, re.IGNORECASE):
+        if com_text is None:
+            com_text = extract_text_from_html(com)
+        if pattern.fullmatch(com_text):
             return True
 
     return False
@@ -413,20 +616,29 @@ def download_to_memory(url: str, session: Session, headers: dict | None) -> byte
     return resp.content
 
 
-def fetch_media_bytes(
+def fetch_media_to_file(
     url: str,
-    ext: str,
-    video_cooldown_sec: float=3.2,
-    image_cooldown_sec: float=2.2,
+    dirpath: str,
+    filename: str,
     headers: dict | None=None,
     logger: Logger | None=None,
     session: Session | None=None,
     max_bytes: int | None=None,
-) -> bytes | None:
-    """Handles sleeping after requests"""
+    rate_limiter: RateLimiter | None=None,
+    tokens: float=1.0,
+    chunk_size: int=65_536,
+) -> tuple[str, int, str] | None:
+    """
+    Waits on `rate_limiter`, if given, before the request. Streams the response into a temp file in `dirpath`,
+    one chunk at a time, and hashes it as it goes. Returns `(tmp_filepath, fsize, md5_b64)`, and the caller renames or removes the file.
+    Nothing is left behind when the download fails.
+    """
+    if rate_limiter:
+        rate_limiter.acquire(url, tokens=tokens)
 
     resp = (session.get if session else requests_get)(url, headers=headers, stream=True)
 
+    tmp_filepath = None
     try:
         if resp.status_code != 200:
             log_util(logger, f'{url=} {resp.status_code=}')
@@ -435,33 +647,41 @@ def fetch_media_bytes(
         length = resp.headers.get('content-length')
         if max_bytes is not None and length and int(length) > max_bytes:
             log_util(logger, f'Download stopped: {url=} bytes={length} > {max_bytes=}')
-            sleep(2.0)
             return
 
-        data = bytearray()
+        makedir_p(dirpath)
+        fd, tmp_filepath = tempfile.mkstemp(dir=dirpath, prefix=filename, suffix='.tmp')
+        # mkstemp() creates the file 0600, media is served by other processes
+        os.fchmod(fd, 0o664)
 
-        for chunk in resp.iter_content(65_536):
-            if not chunk:
-                continue
+        md5 = hashlib.md5()
+        fsize = 0
+        with os.fdopen(fd, mode='wb') as f:
+            for chunk in resp.iter_content(chunk_size):
+                if not chunk:
+                    continue
 
-            data.extend(chunk)
+                fsize += len(chunk)
+                if max_bytes is not None and fsize > max_bytes:
+                    log_util(logger, f'Download stopped: {url=} bytes={fsize} > {max_bytes=}')
+                    return
 
-            if max_bytes is not None and len(data) > max_bytes:
-                log_util(logger, f'Download stopped: {url=} bytes={len(data)} > {max_bytes=}')
-                return
+                md5.update(chunk)
+                f.write(chunk)
 
-        if not data:
+        if not fsize:
             return
 
+        result = (tmp_filepath, fsize, base64.b64encode(md5.digest()).decode('ascii'))
+        tmp_filepath = None
+        return result
+
     finally:
         # always return connection to session pool
         resp.close()
 
-    # We only sleep if we decide to download a file
-    time_to_sleep = video_cooldown_sec if is_video_path(ext) else image_cooldown_sec if is_image_path(ext) else 2.0
-    sleep(time_to_sleep)
-
-    return bytes(data)
+        if tmp_filepath and os.path.isfile(tmp_filepath):
+            os.remove(tmp_filepath)
 
 
 video_exts = ('webm', 'mp4', 'gif')
@@ -479,37 +699,7 @@ def makedir_p(dir: str):
         os.makedirs(dir, mode=0o775, exist_ok=True)
 
 
-class MaxQueue:
-    def __init__(self, boards, max_items_per_board=150*151*2):
-        """
-        threads_per_catalog = 150
-        images_per_thread = 151
-        """
-
-        # use OrderedDict for lookup speed, rather than a list
-        self.items = {b: OrderedDict() for b in boards}
-
-        self.max_items_per_board = max_items_per_board
-
-    def add(self, board: str, filepath: str):
-        board_items = self.items[board]
-
-        if filepath in board_items:
-            return
-
-        while len(board_items) >= self.max_items_per_board:
-            board_items.popitem(last=False)
-
-        board_items[filepath] = 1
-
-    def __contains__(self, filepath: str) -> bool:
-        return any(filepath in board_items for board_items in self.items.values())
-
-    def __getitem__(self, board: str) -> OrderedDict:
-        return self.items[board]
-
-
-def create_thumbnail_from_video(video_path: str, out_path: str, width: int=400, height: int=400, quality: int=25, logger=None):
+def create_thumbnail_from_video(video_path: str, out_path: str, width: int=400, height: int=400, quality: int=25, logger=None, raise_errors: bool=False):
     """width and height form the max box boundary for the resulting image"""
 
     if not is_video_path(video_path):
@@ -522,11 +712,13 @@ def create_thumbnail_from_video(video_path: str, out_path: str, width: int=400,
         if logger:
             logger.info(f'    Created thumb {os.path.getsize(video_path) / 1024:.1f}kb -> {os.path.getsize(out_path) / 1024:.1f}kb')
     except Exception as e:
+        if raise_errors:
+            raise
         if logger:
             logger.error(f'Error creating thumbnail from {video_path}\n{str(e)}')
 
 
-def create_thumbnail_from_image(image_path: str, out_path: str, width: int=400, height: int=400, quality: int=25, logger=None):
+def create_thumbnail_from_image(image_path: str, out_path: str, width: int=400, height: int=400, quality: int=25, logger=None, raise_errors: bool=False):
     """width and height form the max box boundary for the resulting image"""
 
     if not is_image_path(image_path):
@@ -539,6 +731,8 @@ def create_thumbnail_from_image(image_path: str, out_path: str, width: int=400,
         if logger:
             logger.info(f'    Created thumb {os.path.getsize(image_path) / 1024:.1f}kb -> {os.path.getsize(out_path) / 1024:.1f}kb')
     except Exception as e:
+        if raise_errors:
+            raise
         if logger:
             logger.error(f'    Error creating thumbnail from {image_path}\n{str(e)}')
 